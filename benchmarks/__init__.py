@@ -0,0 +1,33 @@
+"""Benchmarks of Pantomath, and their baselines."""
+import json
+import os
+import platform
+
+from rich.console import Console
+
+
+def load_baseline(path: str) -> dict:
+    """Return the baseline stored in a file, or an empty one."""
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_baseline(path: str, baseline: dict) -> None:
+    """Store a baseline in a file, with a description of the machine."""
+    baseline = dict(
+        baseline,
+        machine=f"{platform.machine()}, {os.cpu_count()} CPUs,"
+        f" Python {platform.python_version()}",
+    )
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def get_console() -> Console:
+    """Return a console for the results, wide enough for their tables."""
+    console = Console()
+    return console if console.is_terminal else Console(width=160)
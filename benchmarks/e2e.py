@@ -0,0 +1,402 @@
+"""End-to-end benchmark of the collection, against a fake AWS API and a database.
+
+Each data source is collected by :meth:`pantomath.Pantomath.collect`, in a new
+process so that its peak memory usage is its own, from the fake AWS API of
+:mod:`benchmarks.fake_aws` into a PostgreSQL database. Only the data sources the
+fake API serves are benchmarked, i.e. ``aws_ebs_snapshots`` and
+``aws_lambda_functions``, whose functions are enriched with their tags by
+``ListTags`` calls. The results are compared to a baseline, and the benchmark
+fails when a data source regressed::
+
+    python -m benchmarks.e2e --db-host localhost --db-name pantomath
+
+The throughput and the memory usage depend on the machine, so the baseline must
+be recorded on the machine it is compared on, with ``--update-baseline``. The CI
+records it on its runner, from the base commit of the changes.
+"""
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from multiprocessing import get_context
+from pathlib import Path
+from typing import List, Optional
+
+import click
+import yaml
+from loguru import logger
+from rich.table import Table
+
+from benchmarks import get_console, load_baseline, write_baseline
+from benchmarks.fake_aws import FakeAws, Scale, get_profiles
+from benchmarks.faults import Faults
+from pantomath import Pantomath
+from pantomath.cli import group_options
+from pantomath.metrics import metrics
+
+SOURCES = ("aws_ebs_snapshots", "aws_lambda_functions")
+
+BASELINE_PATH = Path(__file__).parent / "baselines" / "e2e.json"
+
+# Measures whose best value across runs is the lowest, the others being the highest
+_BEST_WHEN_LOWER = {"duration", "peak_rss_mib", "rows"}
+
+
+@dataclass(frozen=True)
+class Database:
+    """Database the data sources are loaded into.
+
+    :param db_host: Host of the database server.
+    :param db_port: Port of the database server.
+    :param db_user: User to connect as.
+    :param db_password: Password of the user.
+    :param db_name: Name of the database.
+    """
+
+    db_host: str
+    db_port: int
+    db_user: str
+    db_password: str
+    db_name: str
+
+    def to_config(self) -> dict:
+        """Return the ``db`` block of the configuration."""
+        return {name[len("db_") :]: value for name, value in asdict(self).items()}
+
+
+@dataclass(frozen=True)
+class Comparison:
+    """How the results are compared to the baseline.
+
+    :param tolerance: Ratio the throughput and the peak memory usage may regress
+        by.
+    :param baseline_path: Path of the file holding the baseline.
+    :param update_baseline: Record the results as the baseline, instead of
+        comparing them to it.
+    """
+
+    tolerance: float
+    baseline_path: str
+    update_baseline: bool
+
+
+def _collect(config_path: str) -> dict:
+    """Collect, and return the measures of the process."""
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    started_at = time.perf_counter()
+    failed = False
+    try:
+        Pantomath(config_path).collect()
+    except click.ClickException as error:
+        logger.error(error.format_message())
+        failed = True
+    duration = time.perf_counter() - started_at
+
+    snapshot = metrics.snapshot()
+    rows = sum(snapshot.get("pantomath_rows_total", {}).values())
+    # Kibibytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss /= 1024
+    return {
+        "duration": round(duration, 3),
+        "failed": failed,
+        "peak_rss_mib": round(peak_rss / 1024, 1),
+        "retries": int(sum(snapshot.get("pantomath_api_retries_total", {}).values())),
+        "rows": int(rows),
+        "rows_per_second": round(rows / duration, 1),
+        "throttles": int(
+            sum(snapshot.get("pantomath_api_throttles_total", {}).values())
+        ),
+    }
+
+
+def _write_config(
+    directory: str, source: str, profiles: List[str], endpoint_url: str, db: dict
+) -> str:
+    path = os.path.join(directory, f"{source}.yaml")
+    with open(path, "w") as file:
+        yaml.safe_dump(
+            {
+                "version": "0.1.0",
+                "db": db,
+                "providers": {
+                    "aws": {
+                        "settings": {
+                            "accounts": [{"profile": profile} for profile in profiles],
+                            # Every run must collect the same regions
+                            "empty_region_probe_interval": 0,
+                            "endpoint_url": endpoint_url,
+                        },
+                        "sources": [source],
+                    }
+                },
+            },
+            file,
+        )
+    return path
+
+
+async def run(
+    scale: Scale,
+    sources: List[str],
+    repeat: int,
+    db: dict,
+    faults: Optional[Faults] = None,
+) -> dict:
+    """Benchmark the data sources, and return the best measures of each one.
+
+    The faults injected are counted in the measures, when there are some.
+    """
+    fake_aws = FakeAws(scale, faults)
+    endpoint_url = await fake_aws.start()
+    loop = asyncio.get_running_loop()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, content in get_profiles(fake_aws.account_ids).items():
+                with open(os.path.join(directory, name), "w") as file:
+                    file.write(content)
+            os.environ["AWS_CONFIG_FILE"] = os.path.join(directory, "config")
+            os.environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(
+                directory, "credentials"
+            )
+            os.environ["AWS_EC2_METADATA_DISABLED"] = "true"
+
+            for source in sources:
+                config_path = _write_config(
+                    directory, source, fake_aws.account_ids, endpoint_url, db
+                )
+                runs = []
+                for _ in range(repeat):
+                    fake_aws.api_calls.clear()
+                    if faults is not None:
+                        faults.injected.clear()
+                    # A new process for each run, so that the peak memory usage
+                    # is the one of the run
+                    with ProcessPoolExecutor(
+                        max_workers=1, mp_context=get_context("spawn")
+                    ) as executor:
+                        measures = await loop.run_in_executor(
+                            executor, _collect, config_path
+                        )
+                    measures["api_calls"] = sum(fake_aws.api_calls.values())
+                    if faults is not None:
+                        measures["faults"] = sum(faults.injected.values())
+                    runs.append(measures)
+                results[source] = {
+                    name: (min if name in _BEST_WHEN_LOWER else max)(
+                        measures[name] for measures in runs
+                    )
+                    for name in runs[0]
+                }
+    finally:
+        await fake_aws.stop()
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Return the regressions of the results from the baseline.
+
+    The rows and the API calls must be the same, the throughput and the peak
+    memory usage may be worse by ``tolerance``, as a ratio.
+    """
+    regressions = []
+    for source, measures in results.items():
+        expected = baseline["sources"].get(source)
+        if expected is None:
+            continue
+
+        if measures["failed"]:
+            regressions.append(f"{source}: the collection failed")
+        if measures["rows"] != expected["rows"]:
+            regressions.append(
+                f"{source}: {measures['rows']} rows instead of {expected['rows']}"
+            )
+        if measures["api_calls"] > expected["api_calls"]:
+            regressions.append(
+                f"{source}: {measures['api_calls']} API calls instead of"
+                f" {expected['api_calls']}"
+            )
+        if measures["rows_per_second"] < expected["rows_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{source}: {measures['rows_per_second']:.0f} rows/s instead of"
+                f" {expected['rows_per_second']:.0f}"
+            )
+        if measures["peak_rss_mib"] > expected["peak_rss_mib"] * (1 + tolerance):
+            regressions.append(
+                f"{source}: {measures['peak_rss_mib']:.0f} MiB peak RSS instead of"
+                f" {expected['peak_rss_mib']:.0f}"
+            )
+
+    return regressions
+
+
+def _print_results(results: dict, baseline: dict) -> None:
+    table = Table(
+        "Data source",
+        "Rows",
+        "Rows/s",
+        "API calls",
+        "Retries",
+        "Throttles",
+        "Wall time",
+        "Peak RSS",
+        title="End-to-end benchmark",
+    )
+    injected = any("faults" in measures for measures in results.values())
+    if injected:
+        table.add_column("Faults")
+    for source, measures in results.items():
+        expected = baseline.get("sources", {}).get(source)
+        change = ""
+        if expected:
+            change = f" ({measures['rows_per_second'] / expected['rows_per_second'] - 1:+.0%})"  # noqa: E501
+        table.add_row(
+            source,
+            f"{measures['rows']}{' (failed)' if measures['failed'] else ''}",
+            f"{measures['rows_per_second']:.0f}{change}",
+            str(measures["api_calls"]),
+            str(measures["retries"]),
+            str(measures["throttles"]),
+            f"{measures['duration']:.2f}s",
+            f"{measures['peak_rss_mib']:.0f} MiB",
+            *([str(measures["faults"])] if injected else []),
+        )
+    get_console().print(table)
+
+
+@click.command()
+@group_options(
+    "scale",
+    Scale,
+    click.option("--accounts", default=Scale.accounts, show_default=True, type=int),
+    click.option("--regions", default=Scale.regions, show_default=True, type=int),
+    click.option("--snapshots", default=Scale.snapshots, show_default=True, type=int),
+    click.option("--functions", default=Scale.functions, show_default=True, type=int),
+    click.option("--page-size", default=Scale.page_size, show_default=True, type=int),
+    click.option(
+        "--latency",
+        default=Scale.latency,
+        help="Number of seconds each API call takes.",
+        show_default=True,
+        type=float,
+    ),
+)
+@click.option(
+    "--source",
+    "sources",
+    default=SOURCES,
+    help="Data source to benchmark. Can be passed multiple times.",
+    multiple=True,
+    show_default=True,
+    type=click.Choice(SOURCES),
+)
+@click.option(
+    "--faults",
+    "faults_path",
+    default=None,
+    help="Inject the faults of a YAML file into the API calls."
+    " The results are then not compared to the baseline.",
+    metavar="FILE",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--repeat",
+    default=3,
+    help="Number of runs of each data source. The best one is kept.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@group_options(
+    "comparison",
+    Comparison,
+    click.option(
+        "--tolerance",
+        default=0.25,
+        help="Ratio the throughput and the peak memory usage may regress by.",
+        show_default=True,
+        type=click.FloatRange(min=0),
+    ),
+    click.option(
+        "--baseline",
+        "baseline_path",
+        default=str(BASELINE_PATH),
+        show_default=True,
+        type=click.Path(dir_okay=False),
+    ),
+    click.option(
+        "--update-baseline",
+        is_flag=True,
+        help="Record the results as the baseline, instead of comparing them to it.",
+    ),
+)
+@group_options(
+    "database",
+    Database,
+    click.option("--db-host", default="localhost", show_default=True),
+    click.option("--db-port", default=5432, show_default=True, type=int),
+    click.option("--db-user", default="pantomath", show_default=True),
+    click.option("--db-password", default="pantomath", show_default=True),
+    click.option("--db-name", default="pantomath", show_default=True),
+)
+def main(
+    scale: Scale,
+    sources: tuple,
+    faults_path: Optional[str],
+    repeat: int,
+    comparison: Comparison,
+    database: Database,
+) -> None:
+    """Benchmark the collection of data sources from a fake AWS API."""
+    if faults_path and comparison.update_baseline:
+        raise click.UsageError("--update-baseline cannot be used with --faults")
+
+    faults = Faults.load(faults_path) if faults_path else None
+    results = asyncio.run(
+        run(scale, list(sources), repeat, database.to_config(), faults)
+    )
+
+    baseline_path = comparison.baseline_path
+    baseline = load_baseline(baseline_path)
+    _print_results(
+        results, baseline if baseline.get("scale") == scale.to_dict() else {}
+    )
+    if faults is not None:
+        click.echo("Faults were injected, so the results are not compared")
+        return
+
+    if comparison.update_baseline:
+        sources_baseline = baseline.get("sources", {})
+        if baseline.get("scale") != scale.to_dict():
+            sources_baseline = {}
+        sources_baseline.update(results)
+        write_baseline(
+            baseline_path, {"scale": scale.to_dict(), "sources": sources_baseline}
+        )
+        click.echo(f"Baseline written to {baseline_path}")
+        return
+
+    if not baseline:
+        raise click.ClickException(f"No baseline in {baseline_path}")
+    if baseline["scale"] != scale.to_dict():
+        raise click.ClickException(
+            f"The baseline was recorded at another scale: {baseline['scale']}"
+        )
+    regressions = compare(results, baseline, comparison.tolerance)
+    if regressions:
+        raise click.ClickException(
+            "Regressions from the baseline:\n" + "\n".join(regressions)
+        )
+    click.echo("No regression from the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""Fake AWS API, serving generated resources for the benchmarks.
+
+The clients reach it through the ``endpoint_url`` setting of the AWS provider.
+The account, the region and the service of a call are read from the scope of its
+signature, the account being the access key. Only the API calls needed by the
+benchmarked data sources are served.
+"""
+import asyncio
+import re
+import socket
+import struct
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from aiohttp import web
+
+from benchmarks.faults import RESET, THROTTLING, Faults
+
+# Regions enabled in the accounts, in order. EC2 and Lambda are available in all.
+REGIONS = (
+    "us-east-1",
+    "eu-west-1",
+    "us-west-2",
+    "ap-southeast-1",
+    "eu-central-1",
+    "us-east-2",
+    "ap-northeast-1",
+    "eu-west-2",
+    "us-west-1",
+    "ap-southeast-2",
+    "ca-central-1",
+    "eu-north-1",
+    "ap-south-1",
+    "eu-west-3",
+    "sa-east-1",
+    "ap-northeast-2",
+)
+
+_CREDENTIAL_SCOPE = re.compile(r"Credential=([^/]+)/[^/]+/([^/]+)/([^/]+)/")
+
+_EC2_NAMESPACE = "http://ec2.amazonaws.com/doc/2016-11-15/"
+_STS_NAMESPACE = "https://sts.amazonaws.com/doc/2011-06-15/"
+_LAMBDA_FUNCTIONS_PATH = "/2015-03-31/functions/"
+_LAMBDA_TAGS_PATH = "/2017-03-31/tags/"
+
+_SNAPSHOT_ITEM = (
+    "<item><snapshotId>snap-{id}</snapshotId><volumeId>vol-{id}</volumeId>"
+    "<status>completed</status><startTime>2021-09-21T12:34:56.000Z</startTime>"
+    "<progress>100%</progress><ownerId>{account_id}</ownerId>"
+    "<volumeSize>{size}</volumeSize><description>Snapshot {index} of {region}"
+    "</description><encrypted>{encrypted}</encrypted><tagSet>"
+    "<item><key>Name</key><value>snapshot-{index}</value></item>"
+    "<item><key>team</key><value>team-{team}</value></item></tagSet></item>"
+)
+
+
+def get_access_key(account_id: str) -> str:
+    """Return the access key of an account."""
+    return f"AKIA{account_id}"
+
+
+@dataclass(frozen=True)
+class Scale:
+    """Number of resources served, and how fast.
+
+    The resources are shared evenly between the regions of the accounts.
+
+    :param accounts: Number of accounts.
+    :param regions: Number of regions enabled in each account.
+    :param snapshots: Number of EBS snapshots.
+    :param functions: Number of Lambda functions.
+    :param page_size: Number of resources in each page of results.
+    :param latency: Number of seconds each API call takes.
+    """
+
+    accounts: int = 10
+    regions: int = 4
+    snapshots: int = 50_000
+    functions: int = 1_000
+    page_size: int = 1_000
+    latency: float = 0.02
+
+    def to_dict(self) -> dict:
+        """Return the scale as a dictionary."""
+        return asdict(self)
+
+
+class FakeAws:
+    """Fake AWS API, serving the resources of a scale.
+
+    :param scale: Number of resources served, and how fast.
+    :param faults: Faults injected into the API calls, if any.
+    """
+
+    def __init__(self, scale: Scale, faults: Optional[Faults] = None) -> None:
+        """Initialize the object."""
+        if scale.regions > len(REGIONS):
+            raise ValueError(f"At most {len(REGIONS)} regions are supported")
+
+        self.scale = scale
+        self.faults = faults
+        self.account_ids = [
+            f"{index + 100000000000:012d}" for index in range(scale.accounts)
+        ]
+        self.regions = list(REGIONS[: scale.regions])
+        self._account_ids = {get_access_key(id_): id_ for id_ in self.account_ids}
+        self._runner: Optional[web.AppRunner] = None
+        # Number of API calls served, by service and operation
+        self.api_calls: Dict[Tuple[str, str], int] = {}
+        self._operations: Dict[str, Callable] = {
+            "DescribeRegions": self._describe_regions,
+            "DescribeSnapshots": self._describe_snapshots,
+            "GetCallerIdentity": self._get_caller_identity,
+            "ListFunctions": self._list_functions,
+            "ListTags": self._list_tags,
+        }
+
+    def _count(self, service_name: str, index: int, region: str) -> int:
+        """Return the number of resources of a service in a unit."""
+        total = getattr(self.scale, service_name)
+        units = len(self.account_ids) * len(self.regions)
+        unit_index = index * len(self.regions) + self.regions.index(region)
+        return total // units + (unit_index < total % units)
+
+    @staticmethod
+    def _xml(namespace: str, action: str, body: str) -> web.Response:
+        return web.Response(
+            text=(
+                f'<?xml version="1.0" encoding="UTF-8"?>\n<{action}Response'
+                f' xmlns="{namespace}"><requestId>0</requestId>{body}'
+                f"</{action}Response>"
+            ),
+            content_type="text/xml",
+        )
+
+    @staticmethod
+    def _error(status: int, code: str, message: str) -> web.Response:
+        return web.Response(
+            status=status,
+            text=(
+                f"<Response><Errors><Error><Code>{code}</Code>"
+                f"<Message>{message}</Message></Error></Errors>"
+                f"<RequestID>0</RequestID></Response>"
+            ),
+            content_type="text/xml",
+        )
+
+    @staticmethod
+    def _throttle(service_name: str) -> web.Response:
+        """Return the throttling error of a service, in the format of its protocol."""
+        if service_name == "ec2":
+            return FakeAws._error(
+                503, "RequestLimitExceeded", "Request limit exceeded."
+            )
+        if service_name == "lambda":
+            return web.json_response(
+                {"message": "Rate exceeded"},
+                status=429,
+                headers={"x-amzn-ErrorType": "Throttling"},
+            )
+        return web.Response(
+            status=400,
+            text=(
+                "<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>"
+                "<Message>Rate exceeded</Message></Error>"
+                "<RequestId>0</RequestId></ErrorResponse>"
+            ),
+            content_type="text/xml",
+        )
+
+    @staticmethod
+    def _reset(request: web.Request) -> web.Response:
+        """Reset the connection of a request, instead of answering it."""
+        transport = request.transport
+        if transport is not None:
+            sock = transport.get_extra_info("socket")
+            # Closing the socket at once sends a TCP reset
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+            transport.abort()
+        return web.Response(status=500)
+
+    def _get_caller_identity(
+        self, account_id: str, region: str, params
+    ) -> web.Response:
+        return self._xml(
+            _STS_NAMESPACE,
+            "GetCallerIdentity",
+            f"<GetCallerIdentityResult><Account>{account_id}</Account>"
+            f"<Arn>arn:aws:iam::{account_id}:user/benchmark</Arn>"
+            f"<UserId>AIDA{account_id}</UserId></GetCallerIdentityResult>",
+        )
+
+    def _describe_regions(self, account_id: str, region: str, params) -> web.Response:
+        items = "".join(
+            f"<item><regionName>{name}</regionName>"
+            f"<regionEndpoint>ec2.{name}.amazonaws.com</regionEndpoint>"
+            f"<optInStatus>opt-in-not-required</optInStatus></item>"
+            for name in self.regions
+        )
+        return self._xml(
+            _EC2_NAMESPACE, "DescribeRegions", f"<regionInfo>{items}</regionInfo>"
+        )
+
+    def _describe_snapshots(self, account_id: str, region: str, params) -> web.Response:
+        index = self.account_ids.index(account_id)
+        count = self._count("snapshots", index, region)
+        start = int(params.get("NextToken") or 0)
+        end = min(start + self.scale.page_size, count)
+        items = "".join(
+            _SNAPSHOT_ITEM.format(
+                id=f"{index:05x}{self.regions.index(region):02x}{item:010x}",
+                account_id=account_id,
+                index=item,
+                region=region,
+                size=8 + item % 500,
+                encrypted=str(item % 2 == 0).lower(),
+                team=item % 7,
+            )
+            for item in range(start, end)
+        )
+        next_token = f"<nextToken>{end}</nextToken>" if end < count else ""
+        return self._xml(
+            _EC2_NAMESPACE,
+            "DescribeSnapshots",
+            f"<snapshotSet>{items}</snapshotSet>{next_token}",
+        )
+
+    def _list_functions(self, account_id: str, region: str, params) -> web.Response:
+        index = self.account_ids.index(account_id)
+        count = self._count("functions", index, region)
+        start = int(params.get("Marker") or 0)
+        end = min(start + min(self.scale.page_size, 50), count)
+        functions = [
+            {
+                "Architectures": ["x86_64"],
+                "CodeSize": 1024 * (item + 1),
+                "Description": f"Function {item} of {region}",
+                "FunctionArn": (
+                    f"arn:aws:lambda:{region}:{account_id}:function:function-{item}"
+                ),
+                "FunctionName": f"function-{item}",
+                "LastModified": "2021-09-21T12:34:56.789+0000",
+                "MemorySize": 128 * (1 + item % 8),
+                "PackageType": "Zip",
+                "Runtime": "python3.9",
+                "State": "Active",
+                "Timeout": 3 + item % 60,
+                "VpcConfig": {"SecurityGroupIds": [], "SubnetIds": []},
+            }
+            for item in range(start, end)
+        ]
+        response: Dict[str, object] = {"Functions": functions}
+        if end < count:
+            response["NextMarker"] = str(end)
+        return web.json_response(response)
+
+    def _list_tags(self, account_id: str, region: str, params) -> web.Response:
+        name = params["arn"].rpartition(":")[2]
+        return web.json_response({"Tags": {"Name": name, "team": "finops"}})
+
+    async def _handle(self, request: web.Request) -> web.Response:  # noqa: CFQ004
+        match = _CREDENTIAL_SCOPE.search(request.headers.get("Authorization", ""))
+        if match is None:
+            return self._error(403, "MissingAuthenticationToken", "Not signed")
+        access_key, region, service_name = match.groups()
+        if access_key not in self._account_ids:
+            return self._error(403, "InvalidClientTokenId", "Unknown access key")
+
+        if service_name == "lambda" and request.path.startswith(_LAMBDA_TAGS_PATH):
+            operation = "ListTags"
+            params = {"arn": unquote(request.path[len(_LAMBDA_TAGS_PATH) :])}
+        elif service_name == "lambda" and request.path == _LAMBDA_FUNCTIONS_PATH:
+            operation = "ListFunctions"
+            params = dict(request.query)
+        elif service_name in ("ec2", "sts"):
+            params = {
+                name: str(value) for name, value in (await request.post()).items()
+            }
+            operation = params.get("Action", "")
+        else:
+            operation, params = request.path, {}
+        if operation not in self._operations:
+            return self._error(400, "InvalidAction", f"{operation} is not supported")
+
+        key = (service_name, operation)
+        self.api_calls[key] = self.api_calls.get(key, 0) + 1
+        if self.faults is None:
+            await asyncio.sleep(self.scale.latency)
+        else:
+            await asyncio.sleep(
+                self.faults.get_latency(service_name, region, self.scale.latency)
+            )
+            fault = self.faults.get_fault(service_name, region)
+            if fault == RESET:
+                return self._reset(request)
+            if fault == THROTTLING:
+                return self._throttle(service_name)
+
+        return self._operations[operation](
+            self._account_ids[access_key], region, params
+        )
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving, and return the URL of the API."""
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        self._runner = runner
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        """Stop serving."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def get_profiles(account_ids: List[str]) -> Dict[str, str]:
+    """Return the AWS configuration and credentials files of the accounts.
+
+    The profiles are named after the accounts.
+    """
+    config = "".join(
+        f"[profile {account_id}]\nregion = us-east-1\n" for account_id in account_ids
+    )
+    credentials = "".join(
+        f"[{account_id}]\naws_access_key_id = {get_access_key(account_id)}\n"
+        f"aws_secret_access_key = benchmark\n"
+        for account_id in account_ids
+    )
+    return {"config": config, "credentials": credentials}
@@ -0,0 +1,133 @@
+"""Faults injected into the API calls of the fake AWS API.
+
+They reproduce the pressure AWS puts on a collection: throttling errors, latency
+varying from call to call, slow pages and connection resets. Rules set their
+rates for the services and regions matching glob patterns, e.g.::
+
+    seed: 1
+    rules:
+      - service: ec2
+        region: us-*
+        throttling_rate: 0.3
+      - latency_sigma: 1
+        reset_rate: 0.01
+        slow_page_rate: 0.02
+        slow_page_delay: 5
+
+The first rule matching an API call applies to it.
+"""
+import fnmatch
+import math
+import random
+from collections import Counter
+from dataclasses import dataclass, fields
+from typing import List, Optional, Sequence
+
+import yaml
+
+# Kinds of faults, as counted by :attr:`Faults.injected`
+THROTTLING = "throttling"
+RESET = "reset"
+SLOW_PAGE = "slow_page"
+
+
+@dataclass(frozen=True)
+class FaultRule:
+    """Rates of the faults injected into the API calls matching glob patterns.
+
+    :param service: Glob pattern of the services, e.g. ``ec2``.
+    :param region: Glob pattern of the regions, e.g. ``eu-*``.
+    :param throttling_rate: Ratio of the calls answered with a throttling error,
+        ``RequestLimitExceeded`` for EC2 and ``Throttling`` for the other services.
+    :param reset_rate: Ratio of the calls whose connection is reset instead.
+    :param slow_page_rate: Ratio of the calls delayed by ``slow_page_delay``.
+    :param slow_page_delay: Number of seconds slow pages are delayed by.
+    :param latency_sigma: Spread of the latency of the calls, which follows a
+        log-normal distribution whose median is the latency of the scale.
+        The latency is constant when it is 0.
+    """
+
+    service: str = "*"
+    region: str = "*"
+    throttling_rate: float = 0.0
+    reset_rate: float = 0.0
+    slow_page_rate: float = 0.0
+    slow_page_delay: float = 5.0
+    latency_sigma: float = 0.0
+
+    def matches(self, service_name: str, region: str) -> bool:
+        """Return whether the rule applies to the calls to a service in a region."""
+        return fnmatch.fnmatchcase(service_name, self.service) and fnmatch.fnmatchcase(
+            region, self.region
+        )
+
+
+class Faults:
+    """Faults injected into the API calls, drawn at random by rule.
+
+    :param rules: Rules of the faults. The first one matching a call applies.
+    :param seed: Seed of the random draws, so that a run can be reproduced.
+    """
+
+    def __init__(self, rules: Sequence[FaultRule], seed: Optional[int] = None):
+        """Initialize the object."""
+        self.rules = list(rules)
+        self._random = random.Random(seed)
+        # Number of faults injected, by service and kind
+        self.injected: Counter = Counter()
+
+    @classmethod
+    def load(cls, path: str) -> "Faults":
+        """Load faults from a YAML file."""
+        with open(path) as file:
+            config = yaml.safe_load(file) or {}
+
+        names = {field.name for field in fields(FaultRule)}
+        rules: List[FaultRule] = []
+        for rule in config.get("rules", []):
+            unknown = set(rule) - names
+            if unknown:
+                raise ValueError(
+                    f"Unknown fault settings: {', '.join(sorted(unknown))}"
+                )
+            rules.append(FaultRule(**rule))
+
+        return cls(rules, config.get("seed"))
+
+    def _get_rule(self, service_name: str, region: str) -> Optional[FaultRule]:
+        return next(
+            (rule for rule in self.rules if rule.matches(service_name, region)), None
+        )
+
+    def _draw(self, rate: float, service_name: str, kind: str) -> bool:
+        if rate <= 0 or self._random.random() >= rate:
+            return False
+
+        self.injected[(service_name, kind)] += 1
+        return True
+
+    def get_latency(self, service_name: str, region: str, latency: float) -> float:
+        """Return the number of seconds an API call takes, slow pages included."""
+        rule = self._get_rule(service_name, region)
+        if rule is None:
+            return latency
+
+        if rule.latency_sigma and latency > 0:
+            latency = self._random.lognormvariate(math.log(latency), rule.latency_sigma)
+        if self._draw(rule.slow_page_rate, service_name, SLOW_PAGE):
+            latency += rule.slow_page_delay
+        return latency
+
+    def get_fault(self, service_name: str, region: str) -> Optional[str]:
+        """Return the fault an API call fails with, if any."""
+        rule = self._get_rule(service_name, region)
+        if rule is None:
+            return None
+
+        for fault, rate in (
+            (RESET, rule.reset_rate),
+            (THROTTLING, rule.throttling_rate),
+        ):
+            if self._draw(rate, service_name, fault):
+                return fault
+        return None
@@ -0,0 +1,132 @@
+"""Items of the AWS data sources, generated from the botocore service models.
+
+The items are deterministic, and shaped like the ones the data sources receive
+from the AWS APIs, so that the benchmarks do not depend on recorded responses.
+"""
+import datetime
+import functools
+from typing import Dict, List
+
+import botocore.session
+import jmespath
+from botocore import xform_name
+
+from pantomath.provider.aws import AwsDataSource, _project
+
+# Number of members of the lists and maps
+LIST_LENGTH = 2
+
+# Nesting below which structures, lists and maps are left empty
+MAX_DEPTH = 6
+
+_STARTED_AT = datetime.datetime(2021, 9, 21, 12, 34, 56, tzinfo=datetime.timezone.utc)
+
+# Values of the string members the results filters depend on, by member name
+_STRING_VALUES = {"Engine": ("docdb", "mysql", "postgres")}
+
+_session = botocore.session.get_session()
+
+
+def _generate(shape, name: str, index: int, depth: int = 0):  # noqa: CFQ004
+    """Return a value for a shape, varying with ``index``."""
+    type_name = shape.type_name
+    if type_name == "structure":
+        if depth > MAX_DEPTH:
+            return {}
+        return {
+            member_name: _generate(member_shape, member_name, index, depth + 1)
+            for member_name, member_shape in shape.members.items()
+        }
+    if type_name == "list":
+        if depth > MAX_DEPTH:
+            return []
+        return [
+            _generate(shape.member, name, index * LIST_LENGTH + offset, depth + 1)
+            for offset in range(LIST_LENGTH)
+        ]
+    if type_name == "map":
+        if depth > MAX_DEPTH:
+            return {}
+        return {
+            f"{name}-key-{offset}": _generate(
+                shape.value, name, index * LIST_LENGTH + offset, depth + 1
+            )
+            for offset in range(LIST_LENGTH)
+        }
+    if type_name == "string":
+        if shape.enum:
+            return shape.enum[index % len(shape.enum)]
+        if name in _STRING_VALUES:
+            return _STRING_VALUES[name][index % len(_STRING_VALUES[name])]
+        if name.endswith(("Date", "Time", "Modified")):
+            timestamp = _STARTED_AT + datetime.timedelta(seconds=index)
+            return timestamp.strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+        return f"{name}-{index}"
+    if type_name == "timestamp":
+        return _STARTED_AT + datetime.timedelta(seconds=index)
+    if type_name in ("integer", "long"):
+        return index
+    if type_name in ("double", "float"):
+        return index / 4
+    if type_name == "boolean":
+        return index % 2 == 0
+    if type_name == "blob":
+        return f"{name}-{index}".encode()
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_output_shape(service_name: str, method_name: str):
+    service_model = _session.get_service_model(service_name)
+    operation_names = {
+        xform_name(operation_name): operation_name
+        for operation_name in service_model.operation_names
+    }
+    return service_model.operation_model(operation_names[method_name]).output_shape
+
+
+def generate_response(service_name: str, method_name: str, index: int) -> dict:
+    """Return a response of a botocore method."""
+    return _generate(_get_output_shape(service_name, method_name), method_name, index)
+
+
+def generate_items(data_source: AwsDataSource, count: int) -> List[dict]:
+    """Return items of a data source, as they are before being transformed.
+
+    They are projected on the fields of the data source, and enriched.
+
+    :param data_source: Data source to generate the items of.
+    :param count: Number of items.
+    """
+    config = data_source.extract_config
+    items: List[dict] = []
+    for index in range(count * 10):
+        response = generate_response(
+            config["service_name"], config["method_name"], index
+        )
+        items.extend(jmespath.search(config["results_filter"], response) or [])
+        if len(items) >= count:
+            break
+    else:
+        raise ValueError(f"The results filter of {data_source.type} keeps no items")
+
+    items = items[:count]
+    if data_source.fields is not None:
+        items = _project(items, data_source.fields)
+
+    enrichers = data_source.execution_plan.enrichers
+    if not enrichers:
+        return items
+
+    enriched_items = []
+    for index, item in enumerate(items):
+        enriched_item: Dict[str, object] = {"resource": item}
+        for enricher in enrichers:
+            response = generate_response(
+                enricher.config["service_name"], enricher.config["method_name"], index
+            )
+            pages = jmespath.search(enricher.config["results_filter"], response)
+            enriched_item[enricher.name] = pages[0] if pages else None
+        enriched_items.append(enriched_item)
+
+    return enriched_items
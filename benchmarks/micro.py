@@ -0,0 +1,309 @@
+"""Microbenchmarks of the stages of the collection.
+
+Each microbenchmark times a function of the hot path over items generated by
+:mod:`benchmarks.fixtures`, and reports its cost per item. The results are
+compared to a baseline, and the benchmark fails when one of them regressed::
+
+    python -m benchmarks.micro --filter "transform:*"
+
+The costs depend on the machine, so the baseline must be recorded on the machine
+it is compared on, with ``--update-baseline``.
+"""
+import asyncio
+import fnmatch
+import functools
+import statistics
+import timeit
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+import click
+from aiostream import stream
+from rich.table import Table
+
+from benchmarks import get_console, load_baseline, write_baseline
+from benchmarks.fixtures import generate_items
+from pantomath.datasource.codec import serialize_to_json
+from pantomath.provider import to_sqlalchemy
+from pantomath.provider.aws import AwsResourceBatch, beautify_tags, data_sources
+
+BASELINE_PATH = Path(__file__).parent / "baselines" / "micro.json"
+
+# Number of items returned by each page of results
+PAGE_SIZE = 100
+
+_ACCOUNT_ID = "123456789012"
+_REGION = "eu-west-1"
+
+
+@dataclass(frozen=True)
+class Microbenchmark:
+    """Function timed over a number of items.
+
+    :param name: Name of the microbenchmark.
+    :param run: Function processing the items once.
+    :param items: Number of items processed by each call of the function.
+    """
+
+    name: str
+    run: Callable[..., Any]
+    items: int
+
+
+class _NullConnection:
+    """Connection discarding the inserts, so that only their chunking is timed."""
+
+    async def execute(self, statement, parameters) -> None:
+        """Discard an insert."""
+
+
+def _transform_benchmarks(count: int) -> Iterator[Microbenchmark]:
+    for name in data_sources.names():
+        data_source = data_sources.get(name)
+        batch = AwsResourceBatch(
+            _ACCOUNT_ID, _REGION, None, generate_items(data_source, count)
+        )
+        yield Microbenchmark(
+            f"transform:{name}", functools.partial(data_source.transform, batch), count
+        )
+
+
+def _render_parameters(enrichers: tuple, resources: List[dict]) -> list:
+    """Render the parameters of the enrichers, as the enrichment does."""
+    metadata = {"account_id": _ACCOUNT_ID, "region": _REGION}
+    return [
+        enricher.render_parameters(source)
+        for source in (dict(item, metadata=metadata) for item in resources)
+        for enricher in enrichers
+    ]
+
+
+def _enrich_parameters_benchmarks(count: int) -> Iterator[Microbenchmark]:
+    for name in data_sources.names():
+        data_source = data_sources.get(name)
+        enrichers = data_source.execution_plan.enrichers
+        if not enrichers:
+            continue
+
+        resources = [item["resource"] for item in generate_items(data_source, count)]
+        yield Microbenchmark(
+            f"enrich_parameters:{name}",
+            functools.partial(_render_parameters, enrichers, resources),
+            count,
+        )
+
+
+def _codec_benchmarks(count: int) -> Iterator[Microbenchmark]:
+    tags = [
+        [{"Key": f"key-{tag}", "Value": f"value-{item}-{tag}"} for tag in range(10)]
+        for item in range(count)
+    ]
+    yield Microbenchmark(
+        "beautify_tags", lambda: [beautify_tags(value) for value in tags], count
+    )
+
+    resources = generate_items(data_sources.get("aws_ec2_instances"), count)
+    yield Microbenchmark(
+        "serialize_to_json",
+        lambda: [serialize_to_json(resource) for resource in resources],
+        count,
+    )
+
+
+def _load_benchmarks(count: int) -> Iterator[Microbenchmark]:
+    data_source = data_sources.get("aws_ebs_snapshots")
+    rows = data_source.transform(
+        AwsResourceBatch(_ACCOUNT_ID, _REGION, None, generate_items(data_source, count))
+    )
+    pages = [rows[start : start + PAGE_SIZE] for start in range(0, count, PAGE_SIZE)]
+    table = data_source.execution_plan.table
+    loop = asyncio.new_event_loop()
+
+    async def _load() -> None:
+        loads = stream.iterate(pages) | to_sqlalchemy(_NullConnection(), table)
+        async with loads.stream() as streamer:
+            async for _ in streamer:
+                pass
+
+    yield Microbenchmark(
+        "to_sqlalchemy", lambda: loop.run_until_complete(_load()), count
+    )
+
+
+def _calibrate(count: int) -> list:
+    """Run a fixed workload, close to a transform, to measure the machine."""
+    return [
+        dict(
+            zip(
+                ("id", "name", "size", "tags"),
+                (index, f"name-{index}", index / 2, [index]),
+            )
+        )
+        for index in range(count)
+    ]
+
+
+def get_microbenchmarks(count: int, patterns: List[str]) -> List[Microbenchmark]:
+    """Return the microbenchmarks whose name matches any of the glob patterns.
+
+    :param count: Number of items processed by each microbenchmark.
+    :param patterns: Glob patterns. All the microbenchmarks match when empty.
+    """
+    microbenchmarks: List[Microbenchmark] = []
+    for factory in (
+        _transform_benchmarks,
+        _enrich_parameters_benchmarks,
+        _codec_benchmarks,
+        _load_benchmarks,
+    ):
+        microbenchmarks.extend(factory(count))
+
+    return [
+        microbenchmark
+        for microbenchmark in microbenchmarks
+        if not patterns
+        or any(fnmatch.fnmatchcase(microbenchmark.name, p) for p in patterns)
+    ]
+
+
+def measure(microbenchmark: Microbenchmark, repeat: int) -> float:
+    """Return the best cost per item of a microbenchmark, in microseconds.
+
+    The function is called enough times for each measure to last 0.2s at least.
+    """
+    timer = timeit.Timer(microbenchmark.run)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat, number)) / number
+    return round(seconds / microbenchmark.items * 1e6, 3)
+
+
+def compare(results: Dict[str, float], baseline: dict, tolerance: float) -> List[str]:
+    """Return the regressions of the results from the baseline.
+
+    A cost per item may be worse by ``tolerance``, as a ratio. Microbenchmarks
+    missing from the baseline are ignored.
+    """
+    return [
+        f"{name}: {cost:.3f}us per item instead of {baseline['costs'][name]:.3f}"
+        for name, cost in results.items()
+        if name in baseline["costs"]
+        and cost > baseline["costs"][name] * (1 + tolerance)
+    ]
+
+
+def _print_results(results: Dict[str, float], baseline: dict) -> None:
+    table = Table(
+        "Microbenchmark", "us per item", "Baseline", "Change", title="Microbenchmarks"
+    )
+    costs = baseline.get("costs", {})
+    for name, cost in results.items():
+        expected = costs.get(name)
+        table.add_row(
+            name,
+            f"{cost:.3f}",
+            "-" if expected is None else f"{expected:.3f}",
+            "-" if expected is None else f"{cost / expected - 1:+.0%}",
+        )
+    get_console().print(table)
+
+
+@click.command()
+@click.option(
+    "--filter",
+    "patterns",
+    help="Only run the microbenchmarks matching a glob pattern. Can be passed multiple times.",  # noqa: E501
+    metavar="PATTERN",
+    multiple=True,
+)
+@click.option(
+    "--items",
+    default=1000,
+    help="Number of items processed by each microbenchmark.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--repeat",
+    default=5,
+    help="Number of measures of each microbenchmark. The best one is kept.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--tolerance",
+    default=0.3,
+    help="Ratio the cost per item may regress by.",
+    show_default=True,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--baseline",
+    "baseline_path",
+    default=str(BASELINE_PATH),
+    show_default=True,
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    "--update-baseline",
+    is_flag=True,
+    help="Record the results as the baseline, instead of comparing them to it.",
+)
+def main(
+    patterns: tuple,
+    items: int,
+    repeat: int,
+    tolerance: float,
+    baseline_path: str,
+    update_baseline: bool,
+) -> None:
+    """Time the stages of the collection, item by item."""
+    microbenchmarks = get_microbenchmarks(items, list(patterns))
+    if not microbenchmarks:
+        raise click.ClickException("No microbenchmark matches the patterns")
+
+    baseline = load_baseline(baseline_path)
+    if baseline.get("items") != items:
+        baseline = {}
+
+    # The speed of the machine varies over time, so it is measured right after
+    # each microbenchmark, and the costs are scaled to the same speed
+    calibration = Microbenchmark(
+        "calibration", functools.partial(_calibrate, items), items
+    )
+    measures = {
+        microbenchmark.name: (
+            measure(microbenchmark, repeat),
+            measure(calibration, repeat),
+        )
+        for microbenchmark in microbenchmarks
+    }
+    reference = baseline.get(
+        "calibration", statistics.median(speed for _, speed in measures.values())
+    )
+    results = {
+        name: round(cost * reference / speed, 3)
+        for name, (cost, speed) in measures.items()
+    }
+    _print_results(results, baseline)
+
+    if update_baseline:
+        costs = dict(baseline.get("costs", {}), **results)
+        write_baseline(
+            baseline_path, {"calibration": reference, "costs": costs, "items": items}
+        )
+        click.echo(f"Baseline written to {baseline_path}")
+        return
+
+    if not baseline:
+        raise click.ClickException(f"No baseline for {items} items in {baseline_path}")
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        raise click.ClickException(
+            "Regressions from the baseline:\n" + "\n".join(regressions)
+        )
+    click.echo("No regression from the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,69 @@
 """Base elements."""
 import asyncio
-import json
+import contextlib
 import logging
+from dataclasses import dataclass
+from typing import Awaitable, Dict, Optional, Sequence
 
 import click
 import confuse
 import pkg_resources
-from sqlalchemy.ext.asyncio import create_async_engine
+from loguru import logger
 
-from pantomath.provider import providers
+from pantomath import profiling, tracing
+from pantomath.db import MAX_LOADS, create_engine
+from pantomath.loopmonitor import LoopMonitor
+from pantomath.metrics import metrics
+from pantomath.progress import ProgressReporter
+from pantomath.provider import Estimate, Filters, providers
+from pantomath.scheduler import describe_tail
+from pantomath.workqueue import COMPLETED, PUBLISHED, WorkQueue, get_worker_id
 
 __version__ = pkg_resources.get_distribution(__name__).version
 
+# Methods of the providers required by the optional capabilities, by capability
+_CAPABILITIES = {
+    "distributed collections": ("plan", "collect_unit", "publish"),
+    "plan mode": ("estimate",),
+    "serve mode": ("serve",),
+}
+
+
+@dataclass(frozen=True)
+class Instruments:
+    """Instruments reporting how a collection runs.
+
+    :param trace_file: Path of a file to write a trace of the collection to,
+        in the Chrome trace event format.
+    :param profile_dir: Path of a directory to write CPU and memory profiles of
+        the data sources to. The data sources are then collected one at a time,
+        in a single process.
+    :param progress: Whether to report the progress of the collection on the
+        standard error, live when it is a terminal. The collections shared with
+        other processes cannot be followed.
+    :param loop_monitor_threshold: Number of seconds after which the callbacks
+        blocking the event loop are reported, with their data source and stage.
+        See :class:`pantomath.loopmonitor.LoopMonitor`.
+    """
+
+    trace_file: Optional[str] = None
+    profile_dir: Optional[str] = None
+    progress: bool = False
+    loop_monitor_threshold: Optional[float] = None
+
+
+async def _run_alongside(main: Awaitable, background: Sequence[Awaitable]):
+    """Run a coroutine, with others running in the background until it ends."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in background]
+    try:
+        return await main
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
 
 class Pantomath:
     """Main class that coordinates all the other classes."""
@@ -41,6 +93,13 @@ class Pantomath:
                 "password": confuse.Optional(""),
                 "name": str,
             },
+            "metrics": confuse.Optional(
+                {
+                    "prometheus_file": confuse.Optional(str),
+                    "json_file": confuse.Optional(str),
+                    "interval": confuse.Optional(int, default=60),
+                }
+            ),
             "providers": {
                 "aws": confuse.Optional(
                     {
@@ -49,10 +108,24 @@ class Pantomath:
                                 {
                                     "assume_role": confuse.Optional(None),
                                     "profile": str,
+                                    "regions": confuse.Optional(confuse.StrSeq()),
                                 }
                             ),
+                            "enrich_concurrency": confuse.Optional(int),
+                            "plan_concurrency": confuse.Optional(int),
+                            "empty_region_probe_interval": confuse.Optional(int),
+                            "endpoint_url": confuse.Optional(str),
+                            "rate_limit_store": confuse.Optional(str),
+                            "rate_limits": confuse.Optional(
+                                confuse.MappingValues(float), default={}
+                            ),
+                            "call_deadline": confuse.Optional(float),
+                            "unit_deadline": confuse.Optional(float),
                         },
                         "sources": list,
+                        "refresh_intervals": confuse.Optional(
+                            confuse.MappingValues(int), default={}
+                        ),
                     }
                 ),
             },
@@ -67,26 +140,319 @@ class Pantomath:
             **self._config["db"]
         )
 
-    async def _async_collect(self) -> None:
-        def serialize_to_json(obj):
-            # To avoid empty values being serialized as the string "null"
-            if obj is None:
-                return None
+    def _write_metrics(self) -> None:
+        config = self._config["metrics"]
+        if config:
+            metrics.write(config["prometheus_file"], config["json_file"])
 
-            return json.dumps(obj, indent=1, sort_keys=True, default=str)
+    async def _write_metrics_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self._config["metrics"]["interval"])
+            self._write_metrics()
 
-        dsn = self._get_db_dsn()
-        engine = create_async_engine(dsn, echo=False, json_serializer=serialize_to_json)
+    def _get_providers(self, engine, capability: str = None, **kwargs) -> dict:
+        """Return the providers, by name.
 
-        for provider_name, provider_config in self._config["providers"].items():
-            provider = providers.get(
+        :param capability: Optional capability the providers must have, as named
+            in ``_CAPABILITIES``. A usage error is raised when one does not.
+        """
+        available_providers = {
+            provider_name: providers.get(
                 provider_name,
                 config=provider_config,
                 db_engine=engine,
                 log_level=self.log_level,
+                **kwargs,
+            )
+            for provider_name, provider_config in self._config["providers"].items()
+        }
+        if capability is not None:
+            for provider_name, provider in available_providers.items():
+                if not all(
+                    callable(getattr(provider, method_name, None))
+                    for method_name in _CAPABILITIES[capability]
+                ):
+                    raise click.UsageError(
+                        f"Provider {provider_name} does not support {capability}"
+                    )
+
+        return available_providers
+
+    async def _collect_provider(self, provider_name: str, provider) -> bool:
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        try:
+            with tracing.span(provider_name, "provider"):
+                await provider.collect()
+        except Exception:  # noqa: B902
+            logger.exception(
+                f"Provider {provider_name} failed"
+                f" after {loop.time() - started_at:.1f}s"
+            )
+            return False
+
+        logger.info(
+            f"Provider {provider_name} collected in {loop.time() - started_at:.1f}s"
+        )
+        return True
+
+    async def _async_collect(self, workers: int, filters: Filters) -> None:
+        dsn = self._get_db_dsn()
+        engine = create_engine(dsn)
+
+        # The providers are collected at the same time, sharing the loads budget.
+        # A provider that fails does not interrupt the others.
+        available_providers = self._get_providers(
+            engine, workers=workers, filters=filters, loads=asyncio.Semaphore(MAX_LOADS)
+        )
+        try:
+            succeeded = await asyncio.gather(
+                *[
+                    self._collect_provider(provider_name, provider)
+                    for provider_name, provider in available_providers.items()
+                ]
+            )
+        finally:
+            await engine.dispose()
+
+        failed = [
+            provider_name
+            for provider_name, success in zip(available_providers, succeeded)
+            if not success
+        ]
+        if failed:
+            raise click.ClickException(
+                f"Collection failed for providers: {', '.join(failed)}"
+            )
+
+    async def _async_estimate(self, workers: int, filters: Filters) -> dict:
+        engine = create_engine(self._get_db_dsn())
+        try:
+            return {
+                provider_name: await provider.estimate()
+                for provider_name, provider in self._get_providers(
+                    engine, "plan mode", workers=workers, filters=filters
+                ).items()
+            }
+        finally:
+            await engine.dispose()
+
+    async def _async_work(self, queue: WorkQueue, run_id: str, engine) -> str:
+        available_providers = self._get_providers(engine, "distributed collections")
+
+        async def _collect_unit(conn, unit):
+            return await available_providers[unit["provider"]].collect_unit(conn, unit)
+
+        try:
+            return await queue.work(
+                run_id=run_id,
+                worker_id=get_worker_id(),
+                collect_unit=_collect_unit,
+                concurrency=10,
+            )
+        finally:
+            for provider in available_providers.values():
+                await provider.close()
+
+    async def _async_run_and_publish(self, queue: WorkQueue, run_id: str, engine):
+        # The coordinator processes units as well, alongside the worker nodes
+        status = await self._async_work(queue, run_id, engine)
+        logger.info(
+            f"Units of run {run_id} took "
+            + describe_tail(await queue.get_unit_durations(run_id))
+        )
+        if status != COMPLETED:
+            raise click.ClickException(
+                f"Run {run_id} {status}. Resume it with: collect --resume {run_id}"
             )
-            await provider.collect()
 
-    def collect(self) -> None:
-        """Extract, transform and load from data sources into the database."""
-        asyncio.run(self._async_collect())
+        async def _publish(conn):
+            for provider in self._get_providers(
+                engine, "distributed collections"
+            ).values():
+                await provider.publish(conn, run_id)
+
+        if await queue.publish(run_id, _publish):
+            logger.info(f"Run {run_id} published")
+        else:
+            logger.info(f"Run {run_id} was already published")
+
+    async def _async_start_run(self, queue: WorkQueue, available_providers) -> str:
+        units = []
+        for provider_name, provider in available_providers.items():
+            units += [
+                dict(unit, provider=provider_name) for unit in await provider.plan()
+            ]
+
+        run_id = await queue.create_run(units)
+        logger.info(f"Run {run_id} started with {len(units)} units")
+        return run_id
+
+    async def _async_resume_run(self, queue: WorkQueue, run_id: str) -> None:
+        status = await queue.get_run_status(run_id)
+        if status is None:
+            raise click.UsageError(f"Distributed run {run_id} does not exist")
+        if status == PUBLISHED:
+            raise click.UsageError(f"Run {run_id} is already published")
+
+        await queue.resume_run(run_id)
+        logger.info(f"Run {run_id} resumed")
+
+    async def _async_collect_distributed(self, resume: Optional[str]) -> None:
+        engine = create_engine(self._get_db_dsn())
+        available_providers = self._get_providers(engine, "distributed collections")
+        try:
+            queue = WorkQueue(engine)
+            await queue.setup()
+            if resume is not None:
+                await self._async_resume_run(queue, resume)
+                run_id = resume
+            else:
+                run_id = await self._async_start_run(queue, available_providers)
+            await self._async_run_and_publish(queue, run_id, engine)
+        finally:
+            for provider in available_providers.values():
+                await provider.close()
+            await engine.dispose()
+
+    async def _async_work_distributed(self, run_id: Optional[str]) -> None:
+        engine = create_engine(self._get_db_dsn())
+        try:
+            queue = WorkQueue(engine)
+            await queue.setup()
+            if run_id is None:
+                run_id = await queue.get_latest_run_id()
+                if run_id is None:
+                    raise click.UsageError("There is no running collection to work on")
+
+            await self._async_work(queue, run_id, engine)
+        finally:
+            await engine.dispose()
+
+    async def _async_serve(self) -> None:
+        engine = create_engine(self._get_db_dsn())
+        loads = asyncio.Semaphore(MAX_LOADS)
+        tasks = [
+            provider.serve()
+            for provider in self._get_providers(
+                engine, "serve mode", loads=loads
+            ).values()
+        ]
+        if self._config["metrics"]:
+            tasks.append(self._write_metrics_periodically())
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await engine.dispose()
+
+    def collect(
+        self,
+        workers: int = 1,
+        distributed: bool = False,
+        resume: str = None,
+        filters: Filters = None,
+        instruments: Instruments = None,
+    ) -> None:
+        """Extract, transform and load from data sources into the database.
+
+        :param workers: Number of worker processes to share the collection between.
+        :param distributed: Whether to share the collection with other worker nodes
+            through a work queue in the database. See :meth:`work`. The progress
+            of such collections is recorded so that they can be resumed.
+        :param resume: ID of an interrupted distributed collection to resume.
+            Only the units that did not complete are collected again.
+        :param filters: Patterns restricting the collection to some data sources,
+            accounts and regions. When accounts or regions are restricted, only
+            the matching rows of the tables are replaced.
+        :param instruments: Instruments reporting how the collection runs.
+        """
+        if filters is None:
+            filters = Filters()
+        if instruments is None:
+            instruments = Instruments()
+        shared = workers > 1 or distributed or resume
+        if instruments.profile_dir and shared:
+            raise ValueError("Collections shared between processes cannot be profiled")
+        if instruments.progress and shared:
+            raise ValueError("Collections shared between processes cannot be followed")
+
+        if instruments.trace_file:
+            tracing.start_tracing()
+        if instruments.profile_dir:
+            profiling.start_profiling()
+        background = []
+        if instruments.progress:
+            background.append(ProgressReporter().run())
+        if instruments.loop_monitor_threshold is not None:
+            background.append(LoopMonitor(instruments.loop_monitor_threshold).run())
+        try:
+            with tracing.span("collect", "run"):
+                if distributed or resume:
+                    run = self._async_collect_distributed(resume=resume)
+                else:
+                    run = self._async_collect(workers=workers, filters=filters)
+                asyncio.run(_run_alongside(run, background))
+        finally:
+            self._write_metrics()
+            tracer = tracing.stop_tracing()
+            if tracer is not None and instruments.trace_file is not None:
+                tracer.write(instruments.trace_file)
+                logger.info(f"Trace written to {instruments.trace_file}")
+            profiler = profiling.stop_profiling()
+            if profiler is not None and instruments.profile_dir is not None:
+                profiler.write(instruments.profile_dir)
+                logger.info(f"Profiles written to {instruments.profile_dir}")
+
+    def estimate(
+        self, workers: int = 1, filters: Filters = None
+    ) -> Dict[str, Estimate]:
+        """Estimate the cost of a collection from the previous runs, by provider.
+
+        Nothing is collected and no list nor describe APIs are called.
+
+        :param workers: Number of worker processes to share the collection between.
+        :param filters: Patterns restricting the collection to some data sources,
+            accounts and regions.
+        """
+        if filters is None:
+            filters = Filters()
+
+        return asyncio.run(self._async_estimate(workers=workers, filters=filters))
+
+    def serve(self, loop_monitor_threshold: float = None) -> None:
+        """Keep refreshing the data sources, each one on its own interval.
+
+        The intervals are set in seconds by the ``refresh_intervals`` setting
+        of the providers, with a ``default`` one for the other data sources.
+        Sessions and database connections are kept between refreshes.
+        The metrics are written every ``interval`` seconds of the ``metrics``
+        setting.
+
+        :param loop_monitor_threshold: Number of seconds after which the callbacks
+            blocking the event loop are reported. See :meth:`collect`.
+        """
+        background = []
+        if loop_monitor_threshold is not None:
+            background.append(LoopMonitor(loop_monitor_threshold).run())
+        try:
+            asyncio.run(_run_alongside(self._async_serve(), background))
+        finally:
+            self._write_metrics()
+
+    def work(self, run_id: str = None, loop_monitor_threshold: float = None) -> None:
+        """Process units of a distributed collection until none is left.
+
+        :param run_id: ID of the run to work on. Default is the latest running one.
+        :param loop_monitor_threshold: Number of seconds after which the callbacks
+            blocking the event loop are reported. See :meth:`collect`.
+        """
+        background = []
+        if loop_monitor_threshold is not None:
+            background.append(LoopMonitor(loop_monitor_threshold).run())
+        try:
+            asyncio.run(
+                _run_alongside(self._async_work_distributed(run_id=run_id), background)
+            )
+        finally:
+            self._write_metrics()
@@ -1,34 +1,87 @@
 """CLI commands."""
+import dataclasses
+import functools
 import logging
-import sys
+from typing import Callable, Optional
 
 import click
-from loguru import logger
 from rich.traceback import install
 
-from pantomath import Pantomath, __version__
+from pantomath import Instruments, Pantomath, __version__, logs, loopmonitor, profiling
+from pantomath.provider import Estimate, Filters
 
 
-class _InterceptHandler(logging.Handler):
-    def emit(self, record: logging.LogRecord) -> None:
-        # Get corresponding Loguru level if it exists
-        try:
-            level = logger.level(record.levelname).name  # noqa: SC200
-        except ValueError:
-            level = record.levelno  # type: ignore # noqa: SC200
+def _print_estimate(provider_name: str, estimate: Estimate) -> None:
+    units = estimate.units
+    click.echo(
+        f"{provider_name}: {len(units)} units"
+        f" in {len({unit['account_id'] for unit in units})} accounts,"
+        f" {len({unit['region'] for unit in units})} regions"
+        f" and {len({unit['source'] for unit in units})} data sources"
+    )
+    click.echo(f"  Estimated duration: {estimate.duration:.1f}s")
+    click.echo(f"  Estimated API calls: {sum(estimate.api_calls.values())}")
+    for service_name, api_calls in sorted(estimate.api_calls.items()):
+        click.echo(f"    {service_name}: {api_calls}")
+    if estimate.unknown_units:
+        click.echo(
+            f"  Units left out of the estimate, as never collected before:"
+            f" {estimate.unknown_units}"
+        )
+    click.echo("  Skipped regions:")
+    for account_id, regions in sorted(estimate.skipped_regions.items()):
+        click.echo(f"    {account_id}: {', '.join(regions) or '-'}")
 
-        # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2  # noqa: SC200
-        while frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back  # type: ignore
-            depth += 1
 
-        logger.opt(depth=depth, exception=record.exc_info).log(  # noqa: SC200
-            level, record.getMessage()
-        )
+def _get_pantomath() -> Pantomath:
+    """Return the main object, set up by the options of the root group."""
+    obj = click.get_current_context().obj
+    return Pantomath(config_path=obj["config_path"], log_level=obj["log_level"])
+
+
+def group_options(argument: str, cls, *options: Callable) -> Callable:
+    """Add options to a command, passed to it as a single dataclass argument.
+
+    :param argument: Name of the argument of the command.
+    :param cls: Dataclass whose fields are named after the options.
+    :param options: Option decorators.
+    """
+
+    def _decorator(command: Callable) -> Callable:
+        @functools.wraps(command)
+        def _command(*args, **kwargs):
+            values = {
+                field.name: kwargs.pop(field.name) for field in dataclasses.fields(cls)
+            }
+            return command(*args, **kwargs, **{argument: cls(**values)})
+
+        for option in reversed(options):
+            _command = option(_command)
+        return _command
 
+    return _decorator
+
+
+def _check_loop_monitor(
+    ctx: click.Context, param: click.Parameter, value: Optional[float]
+) -> Optional[float]:
+    if value is not None and not loopmonitor.is_supported():
+        raise click.BadParameter("not supported on this platform", ctx, param)
+    return value
+
+
+# Option shared by the commands that collect
+_monitor_loop_option = click.option(
+    "--monitor-loop",
+    "loop_monitor_threshold",
+    callback=_check_loop_monitor,
+    default=None,
+    help="Measure the event loop lag, and report the data sources and stages"
+    " that block the loop for longer than a number of seconds.",
+    metavar="SECONDS",
+    type=click.FloatRange(min=0.001),
+)
 
-logging.basicConfig(handlers=[_InterceptHandler()], level=0)
 
 install(show_locals=True)
 
@@ -55,8 +108,27 @@ Written by Jean-Marc Fontaine (jm@jmfontaine.net).
     count=True,
     help="Set output verbosity. Can be passed multiple times to increase verbosity.",
 )
+@click.option(
+    "--log-format",
+    default="text",
+    help="Set the format of the log messages. JSON writes one object per line.",
+    show_default=True,
+    type=click.Choice(["text", "json"]),
+)
+@click.option(
+    "--log-queue",
+    is_flag=True,
+    help="Write the log messages from a background thread, so that logging"
+    " does not wait for the standard error.",
+)
 @click.pass_context
-def cli(ctx: click.Context, config_path: str, verbosity: int) -> None:
+def cli(
+    ctx: click.Context,
+    config_path: str,
+    verbosity: int,
+    log_format: str,
+    log_queue: bool,
+) -> None:
     """Root group for the CLI commands.
 
     Initializes some settings based on the provided options.
@@ -73,27 +145,174 @@ def cli(ctx: click.Context, config_path: str, verbosity: int) -> None:
         level = logging.INFO
     elif verbosity > 2:
         level = logging.DEBUG
-    logger.remove()
-    logger.add(
-        sys.stderr,
-        colorize=True,
-        format="<level>{level}</level> - <cyan>{name}</cyan> - {message}",
-        level=level,
-    )
+    logs.configure(level, serialize=log_format == "json", enqueue=log_queue)
     ctx.obj["log_level"] = level
 
 
 @cli.command(
     short_help="Extract, transform and load from data sources into the database."
 )
-@click.pass_context
-def collect(ctx: click.Context) -> None:
+@click.option(
+    "-w",
+    "--workers",
+    default=1,
+    help="Set the number of worker processes to share the collection between.",
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--distributed",
+    is_flag=True,
+    help="Share the collection with worker nodes through a work queue in the"
+    " database. Progress is recorded so that the collection can be resumed.",
+)
+@click.option(
+    "--resume",
+    "resume",
+    default=None,
+    help="Resume an interrupted distributed collection, given its run ID.",
+    metavar="RUN_ID",
+)
+@group_options(
+    "filters",
+    Filters,
+    click.option(
+        "--source",
+        "sources",
+        help="Only collect the data sources matching a glob pattern."
+        " Can be passed multiple times.",
+        metavar="PATTERN",
+        multiple=True,
+    ),
+    click.option(
+        "--account",
+        "accounts",
+        help="Only collect the accounts whose ID or profile matches a glob pattern."
+        " Can be passed multiple times.",
+        metavar="PATTERN",
+        multiple=True,
+    ),
+    click.option(
+        "--region",
+        "regions",
+        help="Only collect the regions matching a glob pattern."
+        " Can be passed multiple times.",
+        metavar="PATTERN",
+        multiple=True,
+    ),
+)
+@click.option(
+    "--plan",
+    "plan",
+    is_flag=True,
+    help="Estimate the API calls and the duration of the collection from the"
+    " previous runs, without collecting anything.",
+)
+@group_options(
+    "instruments",
+    Instruments,
+    click.option(
+        "--trace",
+        "trace_file",
+        default=None,
+        help="Write a trace of the collection to a file in the Chrome trace event"
+        " format, which https://ui.perfetto.dev opens.",
+        metavar="FILE",
+        type=click.Path(dir_okay=False, writable=True),
+    ),
+    click.option(
+        "--profile",
+        "profile_dir",
+        default=None,
+        help="Write CPU and memory profiles of each data source to a directory:"
+        " folded stacks for flame graphs and a summary of the top allocators."
+        " Data sources are then collected one at a time.",
+        metavar="DIR",
+        type=click.Path(file_okay=False, writable=True),
+    ),
+    click.option(
+        "--progress",
+        "progress",
+        is_flag=True,
+        help="Show the progress of the collection, live in a terminal and as"
+        " periodic one-line summaries otherwise.",
+    ),
+    _monitor_loop_option,
+)
+def collect(
+    workers: int,
+    distributed: bool,
+    resume: str,
+    filters: Filters,
+    plan: bool,
+    instruments: Instruments,
+) -> None:
     """Wrap the :meth:`pantomath.Pantomath.collect` function."""
-    pantomath = Pantomath(
-        config_path=ctx.obj["config_path"],
-        log_level=ctx.obj["log_level"],
+    shared = distributed or resume
+    if shared and workers > 1:
+        raise click.UsageError(
+            "--workers cannot be used with --distributed or --resume"
+        )
+    if shared and (filters.sources or filters.accounts or filters.regions):
+        raise click.UsageError(
+            "--source, --account and --region cannot be used"
+            " with --distributed or --resume"
+        )
+    if shared and plan:
+        raise click.UsageError("--plan cannot be used with --distributed or --resume")
+    if plan and instruments.trace_file:
+        raise click.UsageError("--trace cannot be used with --plan")
+    if plan and instruments.loop_monitor_threshold is not None:
+        raise click.UsageError("--monitor-loop cannot be used with --plan")
+    if instruments.profile_dir and not profiling.is_supported():
+        raise click.UsageError("--profile is not supported on this platform")
+    if instruments.profile_dir and (plan or shared or workers > 1):
+        raise click.UsageError(
+            "--profile cannot be used with --plan, --workers, --distributed"
+            " or --resume"
+        )
+    if instruments.progress and (plan or shared or workers > 1):
+        raise click.UsageError(
+            "--progress cannot be used with --plan, --workers, --distributed"
+            " or --resume"
+        )
+
+    pantomath = _get_pantomath()
+    if plan:
+        for provider_name, estimate in pantomath.estimate(
+            workers=workers, filters=filters
+        ).items():
+            _print_estimate(provider_name, estimate)
+        return
+
+    pantomath.collect(
+        workers=workers,
+        distributed=distributed,
+        resume=resume,
+        filters=filters,
+        instruments=instruments,
     )
-    pantomath.collect()
+
+
+@cli.command(
+    short_help="Keep the data sources up to date, each one on its own interval."
+)
+@_monitor_loop_option
+def serve(loop_monitor_threshold: Optional[float]) -> None:
+    """Wrap the :meth:`pantomath.Pantomath.serve` function."""
+    _get_pantomath().serve(loop_monitor_threshold=loop_monitor_threshold)
+
+
+@cli.command(short_help="Process the work units of a distributed collection.")
+@click.option(
+    "--run-id",
+    default=None,
+    help="Set the ID of the run to work on. Default is the latest running one.",
+)
+@_monitor_loop_option
+def work(run_id: str, loop_monitor_threshold: Optional[float]) -> None:
+    """Wrap the :meth:`pantomath.Pantomath.work` function."""
+    _get_pantomath().work(run_id=run_id, loop_monitor_threshold=loop_monitor_threshold)
 
 
 @cli.command()
@@ -1,7 +1,7 @@
 """Elements shared by data sources."""
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Callable, List, Union
+from typing import Any, Callable, ClassVar, List, Union
 
 import sqlalchemy
 
@@ -34,6 +34,9 @@ class DataSource(ABC):
     :param excluded_default_columns: List of default columns to be omitted.
     """
 
+    # Name the data source is registered under
+    type: ClassVar[str]  # noqa: A003
+
     columns: List[DataSourceColumn] = field(default=False, init=False)  # type: ignore
     excluded_default_columns: List[str] = field(default=False, init=False)  # type: ignore # noqa: E501
 
@@ -42,6 +45,6 @@ class DataSource(ABC):
         """Extract raw data from the data source."""
         pass
 
-    async def transform(self, item):
-        """Refine raw data from the data source."""
-        yield item
+    def transform(self, items: Any) -> List:
+        """Refine a batch of raw data from the data source."""
+        return items
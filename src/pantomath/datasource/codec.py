@@ -0,0 +1,178 @@
+"""Codecs that turn hydrated column values into values ready to be loaded."""
+import datetime
+import functools
+import json
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+import dateutil.parser
+import sqlalchemy
+
+from pantomath.datasource import DataSourceColumn
+
+ColumnCodec = Callable[[List], List]
+CodecKey = Tuple[type, Optional[Callable]]
+
+# Timestamps returned by AWS APIs, in ISO 8601 with optional fractions and offsets
+_ISO_8601_PATTERN = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?"
+    r"(?:(Z)|([+-])(\d\d):?(\d\d))?$"
+)
+
+
+class EncodedJson(str):
+    """JSON document that has already been serialized."""
+
+
+def serialize_to_json(obj) -> Optional[str]:
+    """Serialize a value for a JSON column.
+
+    Values already encoded by a codec are passed through as is.
+    """
+    # To avoid empty values being serialized as the string "null"
+    if obj is None:
+        return None
+
+    if isinstance(obj, EncodedJson):
+        return obj
+
+    return json.dumps(obj, indent=1, sort_keys=True, default=str)
+
+
+def encode_json(value) -> EncodedJson:
+    """Serialize a value for a JSON column ahead of the load."""
+    return EncodedJson(json.dumps(value, indent=1, sort_keys=True, default=str))
+
+
+def encode_row(row: dict) -> EncodedJson:
+    """Serialize a row as a JSON object, keeping values already encoded as is."""
+    return EncodedJson(
+        "{%s}"
+        % ", ".join(
+            f"{json.dumps(name)}: "
+            + (
+                value
+                if isinstance(value, EncodedJson)
+                else json.dumps(value, default=str)
+            )
+            for name, value in row.items()
+        )
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(value: str) -> datetime.datetime:
+    """Parse a timestamp, with a fast path for ISO-8601 timestamps.
+
+    Other formats are delegated to :meth:`dateutil.parser.parse`.
+    """
+    match = _ISO_8601_PATTERN.match(value)
+    if match is None:
+        return dateutil.parser.parse(value)
+
+    (
+        year,
+        month,
+        day,
+        hour,
+        minute,
+        second,
+        fraction,
+        utc,
+        sign,
+        offset_hours,
+        offset_minutes,
+    ) = match.groups()
+
+    if utc:
+        tzinfo: Optional[datetime.tzinfo] = datetime.timezone.utc
+    elif sign:
+        offset = datetime.timedelta(
+            hours=int(offset_hours), minutes=int(offset_minutes)
+        )
+        tzinfo = datetime.timezone(-offset if sign == "-" else offset)
+    else:
+        tzinfo = None
+
+    return datetime.datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        int(fraction.ljust(6, "0")) if fraction else 0,
+        tzinfo=tzinfo,
+    )
+
+
+class CodecRegistry:
+    """Registry of value codecs keyed by column SQL type and transform."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self._codecs: Dict[CodecKey, Callable] = {}
+        self._column_codecs: Dict[CodecKey, Optional[ColumnCodec]] = {}
+
+    def register(self, sql_type: type, transform: Callable = None):
+        """Register a codec for a SQL type, optionally combined with a transform.
+
+        The codec receives a single non-null value and returns the value to load.
+        """
+
+        def _register_codec(codec: Callable) -> Callable:
+            self._codecs[(sql_type, transform)] = codec
+            self._column_codecs.clear()
+            return codec
+
+        return _register_codec
+
+    def _lookup(self, sql_type: type, transform: Optional[Callable]):
+        for cls in sql_type.__mro__:
+            if (cls, transform) in self._codecs:
+                return self._codecs[(cls, transform)]
+
+        return None
+
+    @staticmethod
+    def _compose(transform: Optional[Callable], encode: Optional[Callable]):
+        if transform is None or encode is None:
+            return transform or encode
+
+        def _transform_and_encode(value):
+            value = transform(value)
+            return None if value is None else encode(value)
+
+        return _transform_and_encode
+
+    def _build(self, sql_type: type, transform: Optional[Callable]):
+        codec = self._lookup(sql_type, transform)
+        if codec is None:
+            codec = self._compose(transform, self._lookup(sql_type, None))
+
+        if codec is None:
+            return None
+
+        def _encode_column(values: List) -> List:
+            return [None if value is None else codec(value) for value in values]
+
+        return _encode_column
+
+    def get(self, column: DataSourceColumn) -> Optional[ColumnCodec]:
+        """Return the codec for a column.
+
+        The codec maps a list of hydrated values to a list of values to load.
+        ``None`` is returned when the values can be loaded as they are.
+        """
+        sql_type = column.type if isinstance(column.type, type) else type(column.type)
+        key = (sql_type, column.transform)
+        if key not in self._column_codecs:
+            self._column_codecs[key] = self._build(*key)
+
+        return self._column_codecs[key]
+
+
+codecs = CodecRegistry()
+
+codecs.register(sqlalchemy.types.DateTime, dateutil.parser.parse)(parse_timestamp)
+codecs.register(sqlalchemy.types.JSON)(encode_json)
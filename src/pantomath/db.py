@@ -0,0 +1,24 @@
+"""Database helpers."""
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio.engine import AsyncEngine
+
+from pantomath.datasource.codec import serialize_to_json
+
+# Number of data sources loaded at the same time, each one in its own transaction
+MAX_LOADS = 20
+
+
+def create_engine(dsn: str) -> AsyncEngine:
+    """Create the database engine used to load data into the database.
+
+    The connection pool holds a connection for each of the :data:`MAX_LOADS`
+    data sources loaded at the same time, plus some for the bookkeeping.
+
+    :param dsn: Database connection string.
+    """
+    return create_async_engine(
+        dsn,
+        echo=False,
+        json_serializer=serialize_to_json,
+        pool_size=MAX_LOADS,
+    )
@@ -0,0 +1,69 @@
+"""Configuration of the log messages, of Pantomath and of the libraries it uses.
+
+The messages of the standard :mod:`logging` module, which botocore, aiobotocore
+and SQLAlchemy use, are sent to loguru. The level is set on the root logger so
+that the messages below it are discarded before their records are even created,
+which keeps the cost of the debug messages of the hot path close to zero.
+"""
+import logging
+import sys
+
+from loguru import logger
+
+_FORMAT = "<level>{level}</level> - <cyan>{name}</cyan> - {message}"
+
+# Options of the sink, also applied to the worker processes
+_sink_options = {"serialize": False, "enqueue": False}
+
+
+class _InterceptHandler(logging.Handler):
+    def emit(self, record: logging.LogRecord) -> None:
+        # Get corresponding Loguru level if it exists
+        try:
+            level = logger.level(record.levelname).name  # noqa: SC200
+        except ValueError:
+            level = record.levelno  # type: ignore # noqa: SC200
+
+        # Find caller from where originated the logged message
+        frame, depth = logging.currentframe(), 2  # noqa: SC200
+        while frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back  # type: ignore
+            depth += 1
+
+        logger.opt(depth=depth, exception=record.exc_info).log(  # noqa: SC200
+            level, record.getMessage()
+        )
+
+
+def _write(message: str) -> None:
+    # The standard error is looked up for each message, so that the messages
+    # go through its redirection by the live progress display
+    sys.stderr.write(message)
+
+
+def configure(level: int, serialize: bool = False, enqueue: bool = False) -> None:
+    """Write the log messages of a level and above to the standard error.
+
+    :param level: Level of the messages, from the :mod:`logging` module.
+    :param serialize: Write the messages as JSON objects, one per line, with their
+        level, logger, time, process and exception as fields.
+    :param enqueue: Write the messages from a background thread, through a queue,
+        so that the code logging them does not wait for the standard error.
+    """
+    _sink_options.update(serialize=serialize, enqueue=enqueue)
+
+    root_logger = logging.getLogger()
+    if not any(isinstance(h, _InterceptHandler) for h in root_logger.handlers):
+        root_logger.addHandler(_InterceptHandler())
+    root_logger.setLevel(level)
+
+    logger.remove()
+    if serialize:
+        logger.add(_write, enqueue=enqueue, level=level, serialize=True)
+    else:
+        logger.add(_write, colorize=True, enqueue=enqueue, format=_FORMAT, level=level)
+
+
+def get_sink_options() -> dict:
+    """Return the options of the sink, to configure a worker process the same way."""
+    return dict(_sink_options)
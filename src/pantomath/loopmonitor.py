@@ -0,0 +1,166 @@
+"""Monitoring of the lag of the event loop and of the callbacks blocking it.
+
+Nothing is monitored unless a :class:`LoopMonitor` runs.
+"""
+import asyncio
+import signal
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from pantomath.metrics import metrics
+
+_LOOP_LAG = metrics.histogram(
+    "pantomath_event_loop_lag_seconds",
+    "Delay of the callbacks scheduled on the event loop.",
+)
+_LOOP_BLOCKS = metrics.counter(
+    "pantomath_event_loop_blocks_total",
+    "Number of times a callback blocked the event loop, by data source and stage.",
+    ("source", "stage"),
+)
+_LOOP_BLOCKED_SECONDS = metrics.counter(
+    "pantomath_event_loop_blocked_seconds_total",
+    "Number of seconds callbacks blocked the event loop, by data source and stage.",
+    ("source", "stage"),
+)
+
+# Stages of the collection, by the code of the functions running them
+_stages: Dict[object, str] = {}
+
+# Context variables naming the data source a task works for
+_source_variables: List[ContextVar] = []
+
+
+def stage(name: str) -> Callable:
+    """Name the stage run by a function, reported when it blocks the event loop.
+
+    The function is returned as is, so that naming it costs nothing.
+    """
+
+    def _register(function: Callable) -> Callable:
+        _stages[function.__code__] = name
+        return function
+
+    return _register
+
+
+def add_source_variable(variable: ContextVar) -> None:
+    """Add a context variable naming the data source a task works for."""
+    _source_variables.append(variable)
+
+
+def _describe(frame) -> Tuple[str, str, str]:
+    """Return the data source, the stage and the location of the running code."""
+    sources = [variable.get(None) for variable in _source_variables]
+    source = next((name for name in sources if name is not None), "(none)")
+    location = "?"
+    if frame is not None:
+        location = (
+            f"{frame.f_globals.get('__name__')}:{frame.f_code.co_name}"
+            f":{frame.f_lineno}"
+        )
+    while frame is not None:
+        if frame.f_code in _stages:
+            return source, _stages[frame.f_code], location
+        frame = frame.f_back
+
+    return source, "(other)", location
+
+
+def is_supported() -> bool:
+    """Return whether monitoring the event loop is supported, i.e. thread signals."""
+    return hasattr(signal, "pthread_kill") and hasattr(signal, "SIGUSR2")
+
+
+class LoopMonitor:
+    """Measure the lag of the event loop and report the callbacks blocking it.
+
+    A task measures how late the loop wakes it up. A thread watches the task,
+    and interrupts the main thread, which runs the loop, with ``SIGUSR2`` when
+    the task is late by more than ``threshold`` seconds. The signal handler runs
+    in the blocking callback, so it reads the data source and the stage of the
+    callback. They are reported once the loop is unblocked, with the lag.
+
+    :param threshold: Number of seconds a callback must block the loop to be
+        reported.
+    :param interval: Number of seconds between two measures of the lag.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05) -> None:
+        """Initialize the object."""
+        self.threshold = threshold
+        self.interval = interval
+        self._woken_at = time.monotonic()
+        self._blocker: Optional[Tuple[str, str, str]] = None
+        self._stopped = threading.Event()
+        # Number of seconds the loop was blocked, by data source and stage
+        self.blocked: Dict[Tuple[str, str], float] = defaultdict(float)
+
+    def _interrupt(self, signum, frame) -> None:
+        self._blocker = _describe(frame)
+
+    def _watch(self, thread_id: int) -> None:
+        interrupted_at = None
+        while not self._stopped.wait(self.threshold / 2):
+            woken_at = self._woken_at
+            late = time.monotonic() - woken_at - self.interval
+            if late > self.threshold and interrupted_at != woken_at:
+                interrupted_at = woken_at
+                signal.pthread_kill(thread_id, signal.SIGUSR2)
+
+    def _record(self, lag: float) -> None:
+        _LOOP_LAG.observe(lag)
+        blocker, self._blocker = self._blocker, None
+        if blocker is None or lag < self.threshold:
+            return
+
+        source, stage_name, location = blocker
+        _LOOP_BLOCKS.inc(source=source, stage=stage_name)
+        _LOOP_BLOCKED_SECONDS.inc(lag, source=source, stage=stage_name)
+        self.blocked[(source, stage_name)] += lag
+        logger.warning(
+            f"Event loop blocked for {lag:.3f}s by {source} ({stage_name})"
+            f" at {location}"
+        )
+
+    async def run(self) -> None:
+        """Monitor the event loop until cancelled.
+
+        This must run in the main thread.
+        """
+        if not is_supported():
+            raise RuntimeError("Monitoring the event loop is not supported here")
+
+        previous_handler = signal.signal(signal.SIGUSR2, self._interrupt)
+        watcher = threading.Thread(
+            target=self._watch, args=(threading.get_ident(),), daemon=True
+        )
+        self._stopped.clear()
+        self._woken_at = time.monotonic()
+        watcher.start()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                woken_at = time.monotonic()
+                lag = woken_at - self._woken_at - self.interval
+                self._woken_at = woken_at
+                self._record(max(lag, 0.0))
+        finally:
+            self._stopped.set()
+            watcher.join()
+            signal.signal(signal.SIGUSR2, previous_handler)
+            if self.blocked:
+                logger.info(
+                    "Event loop blocked by "
+                    + ", ".join(
+                        f"{source} ({stage_name}): {seconds:.1f}s"
+                        for (source, stage_name), seconds in sorted(
+                            self.blocked.items(), key=lambda item: item[1], reverse=True
+                        )[:5]
+                    )
+                )
@@ -0,0 +1,256 @@
+"""Metrics of the runs, exported as Prometheus text and JSON."""
+import bisect
+import contextlib
+import json
+import math
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+# Upper bounds, in seconds, of the buckets of the duration histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """Metric whose values are recorded by label values.
+
+    :param name: Name of the metric.
+    :param description: Description of the metric.
+    :param label_names: Names of the labels the values are recorded by.
+    """
+
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, description: str, label_names: Sequence[str] = ()
+    ) -> None:
+        """Initialize the object."""
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values: dict = {}
+
+    def _get_key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        """Yield the name suffix, the labels and the value of each sample."""
+        for key, value in sorted(self._values.items()):
+            yield "", dict(zip(self.label_names, key)), value
+
+    def summarize(self) -> List[dict]:
+        """Return the values of the metric by labels, in a JSON serializable form."""
+        return [
+            {"labels": dict(zip(self.label_names, key)), "value": value}
+            for key, value in sorted(self._values.items())
+        ]
+
+    def snapshot(self) -> dict:
+        """Return the values of the metric, to be merged in another process."""
+        return dict(self._values)
+
+    def merge(self, snapshot: dict) -> None:
+        """Add the values of a snapshot taken in another process."""
+        for key, value in snapshot.items():
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Counter(Metric):
+    """Metric whose values only increase."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increase the value of some labels."""
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """Metric whose values go up and down."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        """Decrease the value of some labels."""
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:  # noqa: A003
+        """Set the value of some labels."""
+        self._values[self._get_key(labels)] = value
+
+
+class Histogram(Metric):
+    """Metric counting observations in buckets, e.g. of durations.
+
+    :param buckets: Upper bounds of the buckets, in increasing order.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialize the object."""
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        """Record an observation for some labels."""
+        key = self._get_key(labels)
+        if key not in self._values:
+            # Count of each bucket, then count and sum of all the observations
+            values: List[float] = [0] * (len(self.buckets) + 1)
+            self._values[key] = values + [0.0]
+        counts = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the number of seconds the context takes."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        """Yield the cumulative buckets, then the count and the sum, by labels."""
+        for key, counts in sorted(self._values.items()):
+            labels = dict(zip(self.label_names, key))
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                yield "_bucket", dict(labels, le=_format_value(bound)), total
+            yield "_count", labels, total
+            yield "_sum", labels, counts[-1]
+
+    def summarize(self) -> List[dict]:
+        """Return the count and the sum of the observations by labels."""
+        return [
+            {
+                "labels": dict(zip(self.label_names, key)),
+                "count": sum(counts[:-1]),
+                "sum": counts[-1],
+            }
+            for key, counts in sorted(self._values.items())
+        ]
+
+    def merge(self, snapshot: dict) -> None:
+        """Add the observations of a snapshot taken in another process."""
+        for key, counts in snapshot.items():
+            current = self._values.get(key, [0] * len(counts))
+            self._values[key] = [a + b for a, b in zip(current, counts)]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _write_atomically(path: str, content: str) -> None:
+    # Readers such as the textfile collector never see a partially written file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+
+
+class MetricsRegistry:
+    """Registry of the metrics recorded by a process."""
+
+    def __init__(self) -> None:
+        """Initialize the object."""
+        self._metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric):
+        registered = self._metrics.get(metric.name)
+        if registered is None:
+            self._metrics[metric.name] = metric
+            return metric
+
+        # Modules imported again, e.g. by tests, get the metric they registered
+        if (
+            type(registered) is not type(metric)
+            or registered.label_names != metric.label_names
+            or getattr(registered, "buckets", None) != getattr(metric, "buckets", None)
+        ):
+            raise ValueError(f"Metric {metric.name} is already registered")
+        return registered
+
+    def counter(self, name: str, description: str, label_names=()) -> Counter:
+        """Register a counter, or return the same one if it is registered."""
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names=()) -> Gauge:
+        """Register a gauge, or return the same one if it is registered."""
+        return self._register(Gauge(name, description, label_names))
+
+    def histogram(
+        self, name: str, description: str, label_names=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        """Register a histogram, or return the same one if it is registered."""
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def render_prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.description)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                label_text = ",".join(
+                    f'{name}="{_escape(label)}"' for name, label in labels.items()
+                )
+                if label_text:
+                    label_text = f"{{{label_text}}}"
+                lines.append(
+                    f"{metric.name}{suffix}{label_text} {_format_value(value)}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def summarize(self) -> dict:
+        """Return the metrics that have values, in a JSON serializable form."""
+        return {
+            name: {
+                "description": metric.description,
+                "type": metric.kind,
+                "values": metric.summarize(),
+            }
+            for name, metric in self._metrics.items()
+            if metric._values
+        }
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Return the values of the metrics, to be merged in another process."""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def merge(self, snapshot: Dict[str, dict]) -> None:
+        """Add the values of a snapshot taken in another process."""
+        for name, values in snapshot.items():
+            self._metrics[name].merge(values)
+
+    def write(
+        self, prometheus_file: Optional[str] = None, json_file: Optional[str] = None
+    ) -> None:
+        """Write the metrics to a Prometheus textfile and a JSON summary file."""
+        if prometheus_file:
+            _write_atomically(prometheus_file, self.render_prometheus())
+        if json_file:
+            _write_atomically(json_file, json.dumps(self.summarize(), indent=2) + "\n")
+
+
+metrics = MetricsRegistry()
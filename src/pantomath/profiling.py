@@ -0,0 +1,201 @@
+"""CPU and memory profiling of the collection of data sources.
+
+Nothing is profiled unless profiling is started with :func:`start_profiling`.
+"""
+import asyncio
+import asyncio.events
+import contextlib
+import os
+import signal
+import tracemalloc
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional
+
+# Data source being collected, which the CPU samples are attributed to
+_source: ContextVar[str] = ContextVar("profiled_source", default="(other)")
+
+# Number of allocation sites reported for each data source
+TOP_ALLOCATORS = 10
+
+# Files whose allocations are made by the profiling itself
+_IGNORED_FILES = {tracemalloc.__file__, __file__}
+
+
+class Profiler:
+    """Sample the CPU usage and trace the memory allocations of the data sources.
+
+    The CPU is sampled every ``interval`` seconds of CPU time by a ``SIGPROF``
+    handler, which runs in the main thread, in the context of the task using the
+    CPU. Samples are thus attributed to the data source of the task, and their
+    stacks start at the coroutine run by the task rather than at the event loop.
+
+    Memory is traced with :mod:`tracemalloc`, whose traces are cleared when a data
+    source starts. Data sources must thus be profiled one at a time. The top
+    allocation sites are taken from a snapshot of the memory close to its peak.
+
+    :param interval: Number of seconds of CPU time between two samples.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """Initialize the object."""
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.sources: Dict[str, dict] = {}
+
+    def _sample(self, signum, frame) -> None:
+        stack: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            name = f"{frame.f_globals.get('__name__')}:{code.co_name}"
+            # The frames below the task are the ones of the event loop, of which
+            # only the callback is kept when the sample lands there
+            if code.co_name == "_run" and code.co_filename == asyncio.events.__file__:
+                stack = stack or [name]
+                break
+            stack.append(name)
+            frame = frame.f_back
+        stack.append(_source.get())
+        self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        """Start sampling the CPU and tracing the memory."""
+        if not is_supported():
+            raise RuntimeError("Profiling is not supported on this platform")
+
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        tracemalloc.start()
+
+    def stop(self) -> None:
+        """Stop sampling the CPU and tracing the memory."""
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        tracemalloc.stop()
+
+    @contextlib.asynccontextmanager
+    async def profile_source(self, name: str) -> AsyncIterator[None]:
+        """Profile the collection of a data source, run in the context."""
+        peak_snapshot = None
+        snapshot_size = 0
+
+        def _take_snapshot_if_grown():
+            nonlocal peak_snapshot, snapshot_size
+            size, _ = tracemalloc.get_traced_memory()
+            if size > snapshot_size * 1.1:
+                peak_snapshot = tracemalloc.take_snapshot()
+                snapshot_size = size
+
+        async def _watch_memory():
+            while True:
+                _take_snapshot_if_grown()
+                await asyncio.sleep(0.25)
+
+        tracemalloc.clear_traces()
+        # The snapshots are taken outside of the data source context,
+        # so that their CPU usage is not attributed to it
+        watcher = asyncio.ensure_future(_watch_memory())
+        token = _source.set(name)
+        try:
+            yield
+        finally:
+            _source.reset(token)
+            watcher.cancel()
+            _take_snapshot_if_grown()
+            allocators = []
+            if peak_snapshot is not None:
+                # Filtering the statistics is much faster than filtering the traces
+                allocators = [
+                    statistic
+                    for statistic in peak_snapshot.statistics("lineno")
+                    if statistic.traceback[0].filename not in _IGNORED_FILES
+                ][:TOP_ALLOCATORS]
+            self.sources[name] = {
+                "peak": tracemalloc.get_traced_memory()[1],
+                "allocators": allocators,
+            }
+
+    def get_cpu_times(self) -> Dict[str, float]:
+        """Return the number of seconds of CPU time sampled, by data source."""
+        cpu_times: Dict[str, float] = defaultdict(float)
+        for stack, count in self.samples.items():
+            cpu_times[stack.split(";", 1)[0]] += count * self.interval
+
+        return dict(cpu_times)
+
+    def write(self, directory: str) -> None:
+        """Write the profiles to a directory.
+
+        ``cpu.folded`` holds the CPU samples as folded stacks, rooted at their
+        data source, which flame graph tools such as https://speedscope.app or
+        ``flamegraph.pl`` open. ``summary.txt`` ranks the data sources by CPU time,
+        with their peak memory and top allocation sites.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "cpu.folded"), "w") as file:
+            for stack, count in sorted(self.samples.items()):
+                file.write(f"{stack} {count}\n")
+
+        cpu_times = self.get_cpu_times()
+        names = sorted(
+            set(cpu_times) | set(self.sources),
+            key=lambda name: cpu_times.get(name, 0),
+            reverse=True,
+        )
+        with open(os.path.join(directory, "summary.txt"), "w") as file:
+            for name in names:
+                file.write(f"{name}: {cpu_times.get(name, 0):.2f}s of CPU")
+                source = self.sources.get(name)
+                if source is None:
+                    file.write("\n")
+                    continue
+
+                file.write(f", peak memory {source['peak'] / 2 ** 20:.1f} MiB\n")
+                for statistic in source["allocators"]:
+                    frame = statistic.traceback[0]
+                    file.write(
+                        f"    {statistic.size / 2 ** 20:.1f} MiB"
+                        f" in {statistic.count} blocks"
+                        f" at {frame.filename}:{frame.lineno}\n"
+                    )
+
+
+_profiler: Optional[Profiler] = None
+
+
+def is_supported() -> bool:
+    """Return whether profiling is supported, i.e. CPU time interval timers."""
+    return hasattr(signal, "setitimer") and hasattr(signal, "SIGPROF")
+
+
+def start_profiling() -> None:
+    """Start profiling the current process."""
+    global _profiler
+    profiler = Profiler()
+    profiler.start()
+    _profiler = profiler
+
+
+def stop_profiling() -> Optional[Profiler]:
+    """Stop profiling and return the profiler, if any."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def is_profiling() -> bool:
+    """Return whether the current process is profiled."""
+    return _profiler is not None
+
+
+@contextlib.asynccontextmanager
+async def profile_source(name: str) -> AsyncIterator[None]:
+    """Profile the collection of a data source, if profiling is started."""
+    if _profiler is None:
+        yield
+        return
+
+    async with _profiler.profile_source(name):
+        yield
@@ -0,0 +1,220 @@
+"""Display of the progress of the collections, from the metrics of the process."""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from rich.console import Console
+from rich.live import Live
+from rich.table import Table
+
+from pantomath.metrics import MetricsRegistry, metrics
+
+# Number of data sources and accounts listed by the live display
+MAX_LISTED = 15
+
+
+def _total(snapshot: dict, name: str) -> float:
+    return sum(snapshot.get(name, {}).values())
+
+
+def _by_label(snapshot: dict, name: str, index: int) -> Dict[str, float]:
+    values: Dict[str, float] = {}
+    for key, value in snapshot.get(name, {}).items():
+        values[key[index]] = values.get(key[index], 0) + value
+    return values
+
+
+@dataclass(frozen=True)
+class _Totals:
+    """Totals read from a snapshot of the metrics."""
+
+    read_at: float
+    rows: float
+    api_calls: float
+    throttles: float
+    in_flight: float
+    running: float
+    units: float
+    units_extracted: float
+    db_writes: float
+    db_write_seconds: float
+    source_rows: Dict[str, float]
+    source_units: Dict[str, float]
+    source_units_extracted: Dict[str, float]
+    account_units: Dict[str, float]
+    account_units_extracted: Dict[str, float]
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict) -> "_Totals":
+        """Read the totals from a snapshot of the metrics."""
+        # Count of each bucket, then sum of the observations, by table
+        chunks = snapshot.get("pantomath_db_chunk_duration_seconds", {}).values()
+        return cls(
+            read_at=time.monotonic(),
+            rows=_total(snapshot, "pantomath_rows_total"),
+            api_calls=_total(snapshot, "pantomath_api_calls_total"),
+            throttles=_total(snapshot, "pantomath_api_throttles_total"),
+            in_flight=_total(snapshot, "pantomath_batches_in_flight"),
+            running=_total(snapshot, "pantomath_sources_running"),
+            units=_total(snapshot, "pantomath_units_planned"),
+            units_extracted=_total(snapshot, "pantomath_units_extracted_total"),
+            db_writes=sum(sum(counts[:-1]) for counts in chunks),
+            db_write_seconds=sum(counts[-1] for counts in chunks),
+            source_rows=_by_label(snapshot, "pantomath_rows_total", 0),
+            source_units=_by_label(snapshot, "pantomath_units_planned", 0),
+            source_units_extracted=_by_label(
+                snapshot, "pantomath_units_extracted_total", 0
+            ),
+            account_units=_by_label(snapshot, "pantomath_units_planned", 1),
+            account_units_extracted=_by_label(
+                snapshot, "pantomath_units_extracted_total", 1
+            ),
+        )
+
+
+class ProgressReporter:
+    """Report the progress of a collection, from the metrics of the process.
+
+    The metrics are only read when the report is refreshed, so that collecting
+    does not do more work than recording them. The progress of other processes,
+    e.g. workers, is not known.
+
+    :param console: Console to report on. A live view is shown when it is
+        a terminal. Otherwise, a one-line summary is printed periodically.
+    :param registry: Registry of the metrics to read.
+    :param refresh_interval: Number of seconds between two refreshes of the view.
+    :param summary_interval: Number of seconds between two summaries.
+    """
+
+    def __init__(
+        self,
+        console: Optional[Console] = None,
+        registry: MetricsRegistry = metrics,
+        refresh_interval: float = 1,
+        summary_interval: float = 30,
+    ) -> None:
+        """Initialize the object."""
+        self.console = console if console is not None else Console(stderr=True)
+        self.registry = registry
+        self.refresh_interval = refresh_interval
+        self.summary_interval = summary_interval
+        self.started_at = time.monotonic()
+        self._previous = self._read()
+
+    def _read(self) -> _Totals:
+        return _Totals.from_snapshot(self.registry.snapshot())
+
+    def _measure(self) -> dict:
+        """Return the totals, and the rates since the previous measure."""
+        current, previous = self._read(), self._previous
+        self._previous = current
+        elapsed = max(current.read_at - previous.read_at, 1e-9)
+        api_calls = current.api_calls - previous.api_calls
+        db_writes = current.db_writes - previous.db_writes
+        return {
+            "totals": current,
+            "rows_per_second": (current.rows - previous.rows) / elapsed,
+            "api_calls_per_second": api_calls / elapsed,
+            "throttle_rate": (
+                (current.throttles - previous.throttles) / api_calls
+                if api_calls
+                else 0.0
+            ),
+            "db_write_latency": (
+                (current.db_write_seconds - previous.db_write_seconds) / db_writes
+                if db_writes
+                else None
+            ),
+            "source_rows_per_second": {
+                name: (rows - previous.source_rows.get(name, 0)) / elapsed
+                for name, rows in current.source_rows.items()
+            },
+        }
+
+    def summarize(self, measure: dict) -> str:
+        """Return the progress in one line."""
+        totals = measure["totals"]
+        latency = measure["db_write_latency"]
+        return (
+            f"{time.monotonic() - self.started_at:.0f}s:"
+            f" {totals.units_extracted:.0f}/{totals.units:.0f} units extracted,"
+            f" {totals.running:.0f} data sources running,"
+            f" {totals.rows:.0f} rows ({measure['rows_per_second']:.0f}/s),"
+            f" {measure['api_calls_per_second']:.1f} API calls/s"
+            f" ({measure['throttle_rate']:.1%} throttled),"
+            f" {totals.in_flight:.0f} batches in flight,"
+            + (" no DB writes" if latency is None else f" DB writes {latency:.3f}s")
+        )
+
+    def render(self, measure: dict) -> Table:
+        """Return the live view of the progress."""
+        totals = measure["totals"]
+
+        def _unfinished_first(extracted: dict, planned: dict) -> list:
+            return sorted(
+                planned,
+                key=lambda name: (extracted.get(name, 0) >= planned[name], name),
+            )
+
+        sources = Table("Data source", "Units", "Rows", "Rows/s", box=None)
+        names = _unfinished_first(totals.source_units_extracted, totals.source_units)
+        for name in names[:MAX_LISTED]:
+            sources.add_row(
+                name,
+                f"{totals.source_units_extracted.get(name, 0):.0f}"
+                f"/{totals.source_units[name]:.0f}",
+                f"{totals.source_rows.get(name, 0):.0f}",
+                f"{measure['source_rows_per_second'].get(name, 0):.0f}",
+            )
+        if len(names) > MAX_LISTED:
+            sources.add_row(f"... {len(names) - MAX_LISTED} more", "", "", "")
+
+        accounts = Table("Account", "Units", box=None)
+        account_ids = _unfinished_first(
+            totals.account_units_extracted, totals.account_units
+        )
+        for account_id in account_ids[:MAX_LISTED]:
+            accounts.add_row(
+                account_id,
+                f"{totals.account_units_extracted.get(account_id, 0):.0f}"
+                f"/{totals.account_units[account_id]:.0f}",
+            )
+        if len(account_ids) > MAX_LISTED:
+            accounts.add_row(f"... {len(account_ids) - MAX_LISTED} more", "")
+
+        view = Table.grid()
+        view.add_row(self.summarize(measure))
+        view.add_row(sources)
+        view.add_row(accounts)
+        return view
+
+    async def _show_live(self) -> None:
+        with Live(
+            self.render(self._measure()), console=self.console, auto_refresh=False
+        ) as live:
+            try:
+                while True:
+                    await asyncio.sleep(self.refresh_interval)
+                    live.update(self.render(self._measure()), refresh=True)
+            finally:
+                live.update(self.render(self._measure()), refresh=True)
+
+    async def _print_summaries(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.summary_interval)
+                self.console.print(
+                    self.summarize(self._measure()), highlight=False, soft_wrap=True
+                )
+        finally:
+            self.console.print(
+                self.summarize(self._measure()), highlight=False, soft_wrap=True
+            )
+
+    async def run(self) -> None:
+        """Report the progress until cancelled."""
+        if self.console.is_terminal:
+            await self._show_live()
+        else:
+            await self._print_summaries()
@@ -1,47 +1,145 @@
 """Elements shared by providers."""
+import asyncio
+import fnmatch
 import logging
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Callable, Iterable
+from typing import Callable, ClassVar, Dict, Iterable, List, Tuple
 
-from aiostream import operator, stream
+from aiostream import operator, streamcontext
 from sqlalchemy.ext.asyncio.engine import AsyncEngine
 
+from pantomath import loopmonitor, tracing
+from pantomath.db import MAX_LOADS
+from pantomath.metrics import metrics
 from pantomath.registry import CachedRegistry
 
 providers = CachedRegistry()
 
+_DB_CHUNK_DURATION = metrics.histogram(
+    "pantomath_db_chunk_duration_seconds",
+    "Duration of the inserts of chunks of rows, by table.",
+    ("table",),
+)
+
 
 def to_sqlalchemy(*args, **kwargs) -> Callable:
-    """Aiostream operator that loads records into the database."""
+    """Aiostream operator that loads batches of records into the database.
 
-    @operator(pipable=True)
-    def _to_sqlalchemy(source, conn, table, chunk_size: int = 1000):
-        async def run(chunk):
-            await conn.execute(table.insert(), chunk)
+    Batches are regrouped so that each insert holds at most ``chunk_size`` records.
+    """
 
-        return stream.action(stream.chunks(source, chunk_size), run)
+    @operator(pipable=True)
+    @loopmonitor.stage("load")
+    async def _to_sqlalchemy(source, conn, table, chunk_size: int = 1000):
+        chunk: list = []
+        async with streamcontext(source) as streamer:
+            async for batch in streamer:
+                chunk.extend(batch)
+                while len(chunk) >= chunk_size:
+                    head, chunk = chunk[:chunk_size], chunk[chunk_size:]
+                    with tracing.span(
+                        f"insert {table.name}", "db_chunk", rows=len(head)
+                    ), _DB_CHUNK_DURATION.time(table=table.name):
+                        await conn.execute(table.insert(), head)
+                    yield head
+
+        if chunk:
+            with tracing.span(
+                f"insert {table.name}", "db_chunk", rows=len(chunk)
+            ), _DB_CHUNK_DURATION.time(table=table.name):
+                await conn.execute(table.insert(), chunk)
+            yield chunk
 
     # KLUDGE: Trick to avoid the need for calling the pipe method in the pipeline.
     # to_sqlalchemy.pipe(arg1, arg2) becomes to_sqlalchemy(arg1, arg2)
     return _to_sqlalchemy.pipe(*args, **kwargs)
 
 
+@dataclass(frozen=True)
+class Filters:
+    """Glob patterns restricting a collection to some data sources, accounts and regions.
+
+    Each kind of pattern matches everything when there is none.
+    """
+
+    sources: Tuple[str, ...] = ()
+    accounts: Tuple[str, ...] = ()
+    regions: Tuple[str, ...] = ()
+
+    @property
+    def partial(self) -> bool:
+        """Whether only some of the rows of the data sources are collected."""
+        return bool(self.accounts or self.regions)
+
+    @staticmethod
+    def match(patterns: Tuple[str, ...], *values: str) -> bool:
+        """Return whether any of the values matches any of the patterns."""
+        if not patterns:
+            return True
+
+        return any(
+            fnmatch.fnmatchcase(value, pattern)
+            for value in values
+            if value is not None
+            for pattern in patterns
+        )
+
+
+@dataclass(frozen=True)
+class Estimate:
+    """Estimated cost of a collection, based on the previous runs.
+
+    :param units: Units of work to collect.
+    :param api_calls: Number of API calls, by service.
+    :param duration: Number of seconds the collection lasts.
+    :param unknown_units: Number of units that were never collected before
+        and are therefore left out of the estimate.
+    :param skipped_regions: Regions that are not collected, by account.
+    """
+
+    units: List[dict]
+    api_calls: Dict[str, int]
+    duration: float
+    unknown_units: int
+    skipped_regions: Dict[str, List[str]]
+
+
 @dataclass(frozen=True)  # type: ignore
 class Provider(ABC):
     """Interact with the data sources for a provider.
 
+    Besides :meth:`collect`, providers may implement optional capabilities:
+
+    - ``serve()``, to refresh their data sources periodically, for serve mode.
+    - ``estimate()``, returning an ``Estimate``, for plan mode.
+    - ``plan()``, ``collect_unit(conn, unit)`` and ``publish(conn, run_id)``, for
+      distributed collections.
+
     :param config: Block from the configuration file that is specific to the provider.
     :param db_engine: Database engine to be used to load data into the database.
     :param log_level: Log level.
+    :param workers: Number of worker processes to share the collection between.
+    :param filters: Patterns restricting the collection.
+    :param loads: Semaphore limiting the number of data sources loaded at the same
+        time. It is shared by the providers collected together.
     """
 
+    # Name the provider is registered under
+    type: ClassVar[str]  # noqa: A003
+
     config: dict = field(default_factory={})  # type: ignore
     db_engine: AsyncEngine = None
     log_level: int = field(default=logging.ERROR)
+    workers: int = 1
+    filters: Filters = field(default_factory=Filters)
+    loads: asyncio.Semaphore = None  # type: ignore
 
     def __post_init__(self):
         """Set some fields after the class initialization."""
+        if self.loads is None:
+            object.__setattr__(self, "loads", asyncio.Semaphore(MAX_LOADS))
+
         logging.getLogger("asyncio").setLevel(self.log_level)
         logging.getLogger("sqlalchemy").setLevel(self.log_level)
 
@@ -50,6 +148,10 @@ class Provider(ABC):
         """Extract, transforms and loads from the provider data sources into the database."""  # noqa: E501
         pass
 
+    async def close(self):
+        """Release the resources held by the provider, e.g. connections."""
+        pass
+
 
 class AsyncIteratorWrapper:
     """Allow to asyncronously iterate a synchronous iterator."""
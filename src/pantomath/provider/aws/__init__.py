@@ -2,39 +2,409 @@
 import asyncio
 import builtins
 import contextlib
-import dataclasses
+import functools
 import logging
+import multiprocessing
+import string
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
 from copy import Error
 from dataclasses import dataclass, field
-from typing import Union
+from datetime import datetime, timezone
+from operator import attrgetter
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import aiobotocore.session
 import aiostream
 import botocore
 import jmespath
-from aiostream import operator
-from aiostream.pipe import flatmap
+from aiobotocore.credentials import AioDeferredRefreshableCredentials
+from aiobotocore.paginate import AioPaginator
+from aiostream import operator, pipe
 from aiostream.stream import flatten
 from botocore.config import Config
-from sqlalchemy import Column, MetaData, Table
-
+from botocore.credentials import CredentialProvider
+from botocore.retries.standard import RetryContext, ThrottledRetryableChecker
+from confuse.templates import AttrDict
+from loguru import logger
+from sqlalchemy import Column, MetaData, Table, cast, select, tuple_
+from sqlalchemy.types import JSON, Enum, Text
+
+from pantomath import logs, loopmonitor, profiling, tracing
 from pantomath.datasource import DataSource, DataSourceColumn
-from pantomath.provider import AsyncIteratorWrapper, Provider, providers, to_sqlalchemy
+from pantomath.datasource.codec import ColumnCodec, codecs, encode_json
+from pantomath.db import MAX_LOADS, create_engine
+from pantomath.metrics import metrics
+from pantomath.provider import (
+    AsyncIteratorWrapper,
+    Estimate,
+    Provider,
+    providers,
+    to_sqlalchemy,
+)
+from pantomath.ratelimit import RateLimiter
 from pantomath.registry import CachedRegistry
+from pantomath.scheduler import Scheduler, describe_tail, estimate_duration
+from pantomath.workqueue import (
+    COMPLETED,
+    FAILED,
+    WorkQueue,
+    get_empty_units,
+    get_unit_history,
+    get_unit_name,
+    publish_rows,
+    run_rows,
+    stage_rows,
+)
 
 data_sources = CachedRegistry()
 
+# Number of items enriched at the same time, by data source
+DEFAULT_ENRICH_CONCURRENCY = 10
+
+# Number of accounts whose units are planned at the same time
+DEFAULT_PLAN_CONCURRENCY = 20
+
+# Number of seconds between two refreshes of a data source, in serve mode
+DEFAULT_REFRESH_INTERVAL = 3600
+
+# Number of API calls per second allowed by (account, region, service),
+# when a rate limit store is set
+DEFAULT_RATE_LIMIT = 10
+
+# Number of seconds after which regions that held no resources are collected again
+DEFAULT_EMPTY_REGION_PROBE_INTERVAL = 7 * 24 * 3600
+
+_CLIENT_CONFIG = Config(
+    retries={
+        "max_attempts": 10,
+        "mode": "adaptive",
+    }
+)
+
+# Usage of the unit being collected, which the API calls are made for
+_unit_usage: ContextVar[Optional["_UnitUsage"]] = ContextVar("unit_usage", default=None)
+
+# Number of seconds after which an API call is hedged, if any
+_call_deadline: ContextVar[Optional[float]] = ContextVar("call_deadline", default=None)
+
+# Coroutine function that waits until the rate limits allow an API call, if any
+_rate_limit: ContextVar[Optional[Callable[..., Awaitable[None]]]] = ContextVar(
+    "rate_limit", default=None
+)
+
+# Number of seconds taken by each unit, by name, for the data sources being collected
+_unit_durations: ContextVar[Optional[dict]] = ContextVar("unit_durations", default=None)
+
+
+# Name of the data source being loaded, which the API calls are made for
+_source_name: ContextVar[Optional[str]] = ContextVar("source_name", default=None)
+loopmonitor.add_source_variable(_source_name)
+
+_API_CALLS = metrics.counter(
+    "pantomath_api_calls_total",
+    "Number of AWS API calls, by service and operation. Retries are not counted.",
+    ("service", "operation"),
+)
+_API_RETRIES = metrics.counter(
+    "pantomath_api_retries_total",
+    "Number of retries of the AWS API calls that succeeded, by service and operation.",
+    ("service", "operation"),
+)
+_API_THROTTLES = metrics.counter(
+    "pantomath_api_throttles_total",
+    "Number of AWS API responses with a throttling error, by service and operation.",
+    ("service", "operation"),
+)
+_API_CALL_DURATION = metrics.histogram(
+    "pantomath_api_call_duration_seconds",
+    "Duration of the AWS API calls, retries included, by service and operation.",
+    ("service", "operation"),
+)
+_PAGES = metrics.counter(
+    "pantomath_pages_total",
+    "Number of AWS API pages fetched, by data source.",
+    ("source",),
+)
+_RESPONSE_BYTES = metrics.counter(
+    "pantomath_response_bytes_total",
+    "Number of bytes of the AWS API responses fetched, by data source.",
+    ("source",),
+)
+_ROWS = metrics.counter(
+    "pantomath_rows_total",
+    "Number of rows loaded, by data source.",
+    ("source",),
+)
+_STAGE_DURATION = metrics.histogram(
+    "pantomath_stage_duration_seconds",
+    "Duration of the processing of a batch, by data source and pipeline stage.",
+    ("source", "stage"),
+)
+_BATCHES_IN_FLIGHT = metrics.gauge(
+    "pantomath_batches_in_flight",
+    "Number of batches extracted but not transformed yet, by data source.",
+    ("source",),
+)
+_SOURCES_PENDING = metrics.gauge(
+    "pantomath_sources_pending", "Number of data sources waiting to be collected."
+)
+_SOURCES_RUNNING = metrics.gauge(
+    "pantomath_sources_running", "Number of data sources being collected."
+)
+_UNITS_PLANNED = metrics.gauge(
+    "pantomath_units_planned",
+    "Number of units to collect, by data source and account.",
+    ("source", "account_id"),
+)
+_UNITS_EXTRACTED = metrics.counter(
+    "pantomath_units_extracted_total",
+    "Number of units extracted, by data source and account.",
+    ("source", "account_id"),
+)
+
+_THROTTLING_CHECKER = ThrottledRetryableChecker()
+
+
+class _UnitUsage:
+    """Usage of the AWS APIs by a unit, and rows it loaded."""
+
+    __slots__ = (
+        "api_calls",
+        "finished_at",
+        "response_bytes",
+        "rows",
+        "started_at",
+        "throttles",
+    )
+
+    def __init__(self):
+        """Initialize the object."""
+        # Number of pages fetched by service and method
+        self.api_calls: Counter = Counter()
+        self.response_bytes = 0
+        self.rows = 0
+        self.throttles = 0
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+
+    def get_metrics(self, extract_method: Tuple[str, str]) -> dict:
+        """Return the values to record about the unit, in the run units table.
+
+        :param extract_method: Service and method that list the unit resources.
+        """
+        return {
+            "api_calls": sum(self.api_calls.values()),
+            "pages": self.api_calls[extract_method],
+            "response_bytes": self.response_bytes,
+            "rows": self.rows,
+            "throttles": self.throttles,
+        }
+
+
+def _count_throttles(response=None, operation=None, attempts=None, **kwargs):
+    """Count the throttling errors, on the needs-retry event of the clients."""
+    if response is None:
+        return
+
+    context = RetryContext(
+        attempt_number=attempts,
+        operation_model=operation,
+        http_response=response[0],
+        parsed_response=response[1],
+    )
+    if _THROTTLING_CHECKER.is_retryable(context):
+        _API_THROTTLES.inc(
+            service=operation.service_model.service_name,
+            operation=botocore.xform_name(operation.name),
+        )
+        usage = _unit_usage.get()
+        if usage is not None:
+            usage.throttles += 1
+
+
+def _measured(method: Callable, service_name: str, region_name: str) -> Callable:
+    """Wrap a client method so that its calls are measured and traced."""
+
+    @functools.wraps(method)
+    async def _measured_method(**kwargs):
+        labels = {"service": service_name, "operation": method.__name__}
+        _API_CALLS.inc(**labels)
+        with tracing.span(
+            f"{service_name}.{method.__name__}", "api_call", region=region_name
+        ) as span, _API_CALL_DURATION.time(**labels):
+            response = await method(**kwargs)
+
+            metadata = response.get("ResponseMetadata", {})
+            retries = metadata.get("RetryAttempts")
+            if span is not None:
+                span.set(
+                    retries=retries,
+                    page_bytes=metadata.get("HTTPHeaders", {}).get("content-length"),
+                )
+
+        if retries:
+            _API_RETRIES.inc(retries, **labels)
+        return response
+
+    return _measured_method
+
+
+class DeadlineExceededError(Exception):
+    """A unit was still being extracted when its deadline passed."""
+
+
+class AwsResourceBatch:
+    """Batch of resources returned by an AWS API page for an account and a region.
+
+    The account ID and the region are interned since they are shared by all batches.
+
+    :param account_id: AWS account ID.
+    :param region: AWS region.
+    :param session: Session used to fetch the resources.
+    :param items: Resources.
+    """
+
+    __slots__ = ("account_id", "items", "region", "session")
+
+    def __init__(self, account_id: str, region: str, session, items: list):
+        """Initialize the object."""
+        self.account_id = sys.intern(account_id)
+        self.region = sys.intern(region)
+        self.session = session
+        self.items = items
+
+
+def _project(items: list, fields: frozenset) -> list:
+    return [
+        {key: value for key, value in item.items() if key in fields}
+        if isinstance(item, dict)
+        else item
+        for item in items
+    ]
+
+
+async def _first_success(calls: List[asyncio.Future]):
+    """Return the result of the first call that succeeds, cancelling the others.
+
+    The error of the first call that failed is raised if they all fail. The calls
+    that end at the same time are considered in the given order.
+    """
+    pending = set(calls)
+    failures = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for call in sorted(done, key=calls.index):
+                if call.exception() is None:
+                    return call.result()
+                failures.append(call)
+
+        return failures[0].result()
+    finally:
+        for call in pending:
+            call.cancel()
+
+
+def _hedge(
+    method: Callable, create_method: Callable, deadline: float, description: str
+) -> Callable:
+    """Wrap a client method so that the calls still running after a deadline are hedged.
+
+    A late call is made again with a new client, which opens its own connections,
+    and the response of whichever call succeeds first is returned.
+
+    :param create_method: Function returning an asynchronous context manager of the
+        method of a new client, wrapped like the calls of ``method`` are.
+    """
+
+    @functools.wraps(method)
+    async def _hedged_method(**kwargs):
+        call = asyncio.ensure_future(method(**kwargs))
+        try:
+            return await asyncio.wait_for(asyncio.shield(call), deadline)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"{description} did not respond within {deadline}s, hedging it"
+            )
+        except BaseException:
+            call.cancel()
+            raise
+
+        async with create_method() as hedged_method:
+            hedged_call = asyncio.ensure_future(hedged_method(**kwargs))
+            return await _first_success([call, hedged_call])
+
+    return _hedged_method
+
+
+def _get_paginator(session, client, method_name: str, method: Callable):
+    """Return a paginator of a client method, requesting the pages with ``method``.
+
+    ``method`` is the client method, wrapped. The paginator is built as the client
+    builds it, from the pagination configuration of the service.
+    """
+    operation_name = client.meta.method_to_api_mapping[method_name]
+    service_model = client.meta.service_model
+    paginator_model = session.get_paginator_model(
+        service_model.service_name, service_model.api_version
+    )
+    return AioPaginator(
+        method,
+        paginator_model.get_paginator(operation_name),
+        service_model.operation_model(operation_name),
+    )
+
+
+def _get_client_method(
+    client, method_name: str, service_name: str, region_name: str
+) -> Callable:
+    """Return a method of a client whose calls are measured and traced.
+
+    The throttling errors of the client are counted.
+    """
+    client.meta.events.register(
+        "needs-retry", _count_throttles, unique_id="pantomath-throttles"
+    )
+    return _measured(getattr(client, method_name), service_name, region_name)
+
+
+def _rate_limited(method: Callable, wait: Callable[[], Awaitable[None]]) -> Callable:
+    """Wrap a client method so that each call waits for the rate limits first."""
+
+    @functools.wraps(method)
+    async def _rate_limited_method(**kwargs):
+        await wait()
+        return await method(**kwargs)
+
+    return _rate_limited_method
+
 
 async def _call_botocore_method(  # noqa: CFQ002
     session,
-    account_id,
     region_name,
     service_name,
     method_name,
-    add_metadata=True,
     results_filter=None,
     method_parameters=None,
     expected_errors=None,
+    fields=None,
+    account_id=None,
 ):
     if not expected_errors:
         expected_errors = []
@@ -42,67 +412,143 @@ async def _call_botocore_method(  # noqa: CFQ002
         method_parameters = {}
 
     try:
-        config = Config(
-            retries={
-                "max_attempts": 10,
-                "mode": "adaptive",
-            }
-        )
+        usage = _unit_usage.get()
+        deadline = _call_deadline.get()
+        rate_limit = _rate_limit.get()
         async with session.create_client(
-            service_name, config=config, region_name=region_name
+            service_name, config=_CLIENT_CONFIG, region_name=region_name
         ) as client:
+            wait = None
+            if rate_limit is not None:
+                wait = functools.partial(
+                    rate_limit, account_id, region_name, service_name
+                )
+            method = _get_client_method(client, method_name, service_name, region_name)
+            if deadline is not None:
+                create_client = getattr(
+                    session, "create_unpooled_client", session.create_client
+                )
+
+                @contextlib.asynccontextmanager
+                async def _create_hedged_method():
+                    # The hedged calls count in the metrics and the rate limits too
+                    async with create_client(
+                        service_name, config=_CLIENT_CONFIG, region_name=region_name
+                    ) as hedged_client:
+                        hedged_method = _get_client_method(
+                            hedged_client, method_name, service_name, region_name
+                        )
+                        if wait is not None:
+                            hedged_method = _rate_limited(hedged_method, wait)
+                        yield hedged_method
+
+                method = _hedge(
+                    method,
+                    _create_hedged_method,
+                    deadline,
+                    f"{service_name}.{method_name} in {region_name}",
+                )
+            # The deadline of a call starts once the rate limits allow it
+            if wait is not None:
+                method = _rate_limited(method, wait)
+
             if client.can_paginate(method_name):
-                paginator = client.get_paginator(method_name)
+                paginator = _get_paginator(session, client, method_name, method)
                 page_iterator = paginator.paginate(**method_parameters)
             else:
-                method = getattr(client, method_name)
                 response = await method(**method_parameters)
                 page_iterator = AsyncIteratorWrapper([response])
 
             results_filter_expression = jmespath.compile(results_filter)
 
+            # Each page is yielded as a whole so that the rest of the pipeline
+            # processes batches of items instead of individual items.
+            source_name = _source_name.get()
             async for page in page_iterator:
+                page_bytes = int(
+                    page.get("ResponseMetadata", {})
+                    .get("HTTPHeaders", {})
+                    .get("content-length", 0)
+                )
+                if usage is not None:
+                    usage.api_calls[(service_name, method_name)] += 1
+                    usage.response_bytes += page_bytes
+                if source_name is not None:
+                    _PAGES.inc(source=source_name)
+                    _RESPONSE_BYTES.inc(page_bytes, source=source_name)
+
                 items = results_filter_expression.search(page)
-                if items is not None:
-                    for item in items:
-                        if add_metadata:
-                            item["metadata"] = {
-                                "account_id": account_id,
-                                "region": region_name,
-                                "session": session,
-                            }
-                        yield item
+                if not items:
+                    continue
+
+                # Drop the fields that are not used as soon as possible
+                # to reduce the memory held by the items in flight.
+                if fields is not None:
+                    items = _project(items, fields)
+                yield items
     except botocore.exceptions.ClientError as error:
         error_code = error.response["Error"]["Code"]
         if error_code in expected_errors:  # noqa: SIM106
-            item = {}
-            if add_metadata:
-                item["metadata"] = {
-                    "account_id": account_id,
-                    "region": region_name,
-                    "session": session,
-                }
-            yield item
+            yield [{}]
         else:
             raise error
     except Error as error:
         raise error
 
 
-async def _assume_iam_role(iam_role_arn, session):
-    async with session.create_client("sts") as sts:
-        response = await sts.assume_role(
-            RoleArn=iam_role_arn, RoleSessionName="pantomath"
+@loopmonitor.stage("extract")
+async def _get_batches(session, account_id, region_name, **kwargs):
+    async for items in _call_botocore_method(
+        session=session, account_id=account_id, region_name=region_name, **kwargs
+    ):
+        yield AwsResourceBatch(
+            account_id=account_id, region=region_name, session=session, items=items
         )
 
-        new_session = aiobotocore.session.AioSession()  # noqa: SC200
-        new_session.set_credentials(
-            access_key=response["Credentials"]["AccessKeyId"],
-            secret_key=response["Credentials"]["SecretAccessKey"],
-            token=response["Credentials"]["SessionToken"],
+
+class _AssumedRoleProvider(CredentialProvider):
+    """Provider of the credentials of a role, assumed again before they expire.
+
+    :param refresh_using: Coroutine function returning new credentials.
+    """
+
+    METHOD = "sts-assume-role"
+    CANONICAL_NAME = "custom-sts-assume-role"
+
+    def __init__(self, refresh_using: Callable[[], Awaitable[dict]]):
+        """Initialize the object."""
+        super().__init__()
+        self._refresh_using = refresh_using
+
+    async def load(self):
+        """Return the credentials, which are fetched when they are first used."""
+        return AioDeferredRefreshableCredentials(
+            refresh_using=self._refresh_using, method=self.METHOD
         )
 
-        return new_session
+
+async def _assume_iam_role(iam_role_arn, session):
+    async def _fetch_credentials():
+        async with session.create_client("sts") as sts:
+            response = await sts.assume_role(
+                RoleArn=iam_role_arn, RoleSessionName="pantomath"
+            )
+
+        return {
+            "access_key": response["Credentials"]["AccessKeyId"],
+            "secret_key": response["Credentials"]["SecretAccessKey"],
+            "token": response["Credentials"]["SessionToken"],
+            "expiry_time": response["Credentials"]["Expiration"].isoformat(),
+        }
+
+    # The role is assumed again shortly before the credentials expire,
+    # so that sessions can be kept for longer than the credentials last.
+    new_session = aiobotocore.session.AioSession()  # noqa: SC200
+    new_session.get_component("credential_provider").insert_before(
+        "env", _AssumedRoleProvider(_fetch_credentials)
+    )
+
+    return new_session
 
 
 async def _get_account_id(session):
@@ -112,7 +558,7 @@ async def _get_account_id(session):
     return response["Account"]
 
 
-async def _get_available_regions(session, service_name):
+async def _get_available_regions(session, service_name, account_regions=None):
     # KLUDGE: Some global services need to point to a region.
     if service_name in ["cloudfront", "s3"]:
         return ["us-east-1"]
@@ -125,6 +571,13 @@ async def _get_available_regions(session, service_name):
     # the service is available in, ignoring the regions disabled in the account.
     # We need to filter out the disabled regions from the result
     # to get the regions available to us.
+    if account_regions is None:
+        account_regions = await _get_account_regions(session)
+
+    return list(set.intersection(*map(set, [service_regions, account_regions])))
+
+
+async def _get_account_regions(session):
     async with session.create_client("ec2", region_name="us-east-1") as client:
         response = await client.describe_regions(
             Filters=[
@@ -137,9 +590,7 @@ async def _get_available_regions(session, service_name):
                 }
             ],
         )
-    account_regions = sorted([r["RegionName"] for r in response["Regions"]])
-
-    return list(set.intersection(*map(set, [service_regions, account_regions])))
+    return sorted([r["RegionName"] for r in response["Regions"]])
 
 
 async def _get_session(account_config):
@@ -153,7 +604,59 @@ async def _get_session(account_config):
     return session  # noqa: R504
 
 
-def beautify_tags(tags: dict) -> Union[dict, None]:
+class _PooledSession:
+    """Session that keeps its clients open, so that their connections are reused.
+
+    The clients are closed by :meth:`close`.
+
+    :param session: Session to create the clients with.
+    :param endpoint_url: URL the clients send the API calls to, if not the AWS one.
+    """
+
+    def __init__(self, session, endpoint_url: Optional[str] = None):
+        """Initialize the object."""
+        self._session = session
+        self._endpoint_url = endpoint_url
+        self._clients: dict = {}
+        self._exit_stack = contextlib.AsyncExitStack()
+
+    def __getattr__(self, name):
+        """Delegate to the wrapped session."""
+        return getattr(self._session, name)
+
+    @contextlib.asynccontextmanager
+    async def create_client(self, service_name, region_name=None, config=None):
+        """Return an open client, creating it if needed."""
+        key = (service_name, region_name, config)
+        if key not in self._clients:
+            client = await self._exit_stack.enter_async_context(
+                self._session.create_client(
+                    service_name,
+                    region_name=region_name,
+                    config=config,
+                    endpoint_url=self._endpoint_url,
+                )
+            )
+            self._clients.setdefault(key, client)
+
+        yield self._clients[key]
+
+    def create_unpooled_client(self, service_name, region_name=None, config=None):
+        """Return a new client, which is closed when its context exits."""
+        return self._session.create_client(
+            service_name,
+            region_name=region_name,
+            config=config,
+            endpoint_url=self._endpoint_url,
+        )
+
+    async def close(self):
+        """Close the clients."""
+        self._clients.clear()
+        await self._exit_stack.aclose()
+
+
+def beautify_tags(tags: list) -> Union[dict, None]:
     """Transform AWS tags so that they are a list of key pairs."""
     if not tags:
         return None
@@ -169,14 +672,26 @@ def beautify_tags(tags: dict) -> Union[dict, None]:
     return {tag[key_name]: tag[value_name] for tag in tags}
 
 
+@codecs.register(JSON, beautify_tags)
+def encode_tags(tags: list) -> Optional[str]:
+    """Transform AWS tags and serialize them for a JSON column in one go."""
+    beautified_tags = beautify_tags(tags)
+    if beautified_tags is None:
+        return None
+
+    return encode_json(beautified_tags)
+
+
 @operator
-async def from_botocore(
+async def from_botocore(  # noqa: CFQ002
     aws_accounts,
     service_name,
     method_name,
     method_parameters=None,
     results_filter=None,
     regions=None,
+    fields=None,
+    get_session=_get_session,
 ):
     """Yield coroutines that call an AWS API method, one for each region.
 
@@ -186,18 +701,21 @@ async def from_botocore(
     :param method_parameters: Parameters for the botocore method
     :param results_filter: JMESPATH expression to filter the results
     :param regions: List of AWS regions to consider
+    :param fields: Fields to keep in the results. All fields are kept if omitted.
+    :param get_session: Coroutine function returning the session for an account.
     """
     for aws_account in aws_accounts:
-        session = await _get_session(aws_account)
+        session = await get_session(aws_account)
         account_id = await _get_account_id(session)
 
-        if not regions:
-            regions = await _get_available_regions(
+        account_regions = regions
+        if not account_regions:
+            account_regions = await _get_available_regions(
                 session=session, service_name=service_name
             )
 
-        for region in regions:
-            yield _call_botocore_method(
+        for region in account_regions:
+            yield _get_batches(
                 session=session,
                 account_id=account_id,
                 region_name=region,
@@ -205,94 +723,1004 @@ async def from_botocore(
                 method_name=method_name,
                 method_parameters=method_parameters,
                 results_filter=results_filter,
+                fields=fields,
+            )
+
+
+def _compile_template(value) -> Callable[[dict], Any]:  # noqa: CFQ004
+    """Compile parameters with placeholders into a function that renders them."""
+    if isinstance(value, dict):
+        items = [(key, _compile_template(item)) for key, item in value.items()]
+        return lambda source: {key: render(source) for key, render in items}
+
+    if isinstance(value, (list, tuple, set)):
+        container = type(value)
+        renders = [_compile_template(item) for item in value]
+        return lambda source: container(render(source) for render in renders)
+
+    if isinstance(value, str) and ("{" in value or "}" in value):
+        return value.format_map
+
+    return lambda source: value
+
+
+@dataclass(frozen=True)
+class AwsEnricher:
+    """Data enricher compiled from its configuration.
+
+    :param name: Name of the enricher, under which its data is added to the items.
+    :param config: Configuration of the botocore method, without its parameters.
+    :param render_parameters: Function that renders the method parameters
+        for an item.
+    """
+
+    name: str
+    config: dict
+    render_parameters: Callable[..., Any]
+
+
+@dataclass(frozen=True)
+class AwsExecutionPlan:
+    """Everything needed to collect an AWS data source, compiled once and reused.
+
+    :param table: Definition of the table the data source is loaded into.
+    :param columns: Columns of the table, including the default ones, by name.
+    :param codecs: Codecs of the columns, in the same order.
+    :param extract: Function returning the batches of an account and a region.
+    :param enrichers: Data enrichers.
+    """
+
+    table: Table
+    columns: Tuple[DataSourceColumn, ...]
+    codecs: Tuple[Optional[ColumnCodec], ...]
+    extract: Callable
+    enrichers: Tuple[AwsEnricher, ...]
+
+
+async def _create_table(conn, table: Table) -> None:
+    if await conn.run_sync(table.exists):
+        await conn.run_sync(table.drop)
+    await conn.run_sync(table.create)
+
+
+def _get_staging_table(table: Table, run_id: str) -> Table:
+    """Return the table the worker processes of a run load a data source into.
+
+    Its enumerated columns are text, so that it does not own the types of the table.
+    """
+    return Table(
+        f"{table.name}_staging_{run_id[:8]}",
+        MetaData(),
+        *[
+            Column(column.name, Text if isinstance(column.type, Enum) else column.type)
+            for column in table.columns
+        ],
+    )
+
+
+@contextlib.contextmanager
+def _using(usage: Optional[_UnitUsage]):
+    """Attribute the API calls made in the context to a unit."""
+    token = _unit_usage.set(usage)
+    try:
+        yield
+    finally:
+        _unit_usage.reset(token)
+
+
+async def _load_data_source(  # noqa: CFQ002
+    conn,
+    table: Table,
+    data_source,
+    batches,
+    stage: Callable = None,
+    enrich_concurrency: int = DEFAULT_ENRICH_CONCURRENCY,
+    usages: Dict[Tuple[str, str], _UnitUsage] = None,
+) -> None:
+    """Load batches of a data source into a table.
+
+    :param stage: Function applied to the rows of each batch before they are
+        loaded, if any.
+    :param enrich_concurrency: Number of items enriched at the same time.
+    :param usages: Usage of the units the batches come from, by account ID and
+        region, which the enrichment API calls and the rows are counted in.
+    """
+    source_name = data_source.type
+    in_flight = 0
+    # The items of the batches of a data source share the same slots
+    enrich_slots = asyncio.Semaphore(enrich_concurrency)
+    if usages is None:
+        usages = {}
+
+    def _extracted(batch):
+        nonlocal in_flight
+        in_flight += 1
+        _BATCHES_IN_FLIGHT.inc(source=source_name)
+        return batch
+
+    @loopmonitor.stage("enrich")
+    async def _enrich(batch):
+        with tracing.span(
+            "enrich", "enrich", items=len(batch.items)
+        ), _STAGE_DURATION.time(source=source_name, stage="enrich"), _using(
+            usages.get((batch.account_id, batch.region))
+        ):
+            return await data_source.enrich(batch, enrich_slots)
+
+    @loopmonitor.stage("transform")
+    def _transform(batch):
+        nonlocal in_flight
+        with _STAGE_DURATION.time(source=source_name, stage="transform"):
+            rows = data_source.transform(batch)
+        in_flight -= 1
+        _BATCHES_IN_FLIGHT.dec(source=source_name)
+        _ROWS.inc(len(rows), source=source_name)
+        usage = usages.get((batch.account_id, batch.region))
+        if usage is not None:
+            usage.rows += len(rows)
+        return rows
+
+    # The unit of work is a batch of items, usually an API page.
+    pipeline = aiostream.stream.iterate(batches) | pipe.map(_extracted)
+    if data_source.enrich_config:
+        pipeline = pipeline | pipe.map(
+            _enrich, ordered=False, task_limit=enrich_concurrency
+        )
+    pipeline = pipeline | pipe.map(_transform)
+    if stage is not None:
+        pipeline = pipeline | pipe.map(stage)
+    pipeline = pipeline | to_sqlalchemy(conn, table)
+
+    token = _source_name.set(source_name)
+    try:
+        with contextlib.suppress(aiostream.core.StreamEmpty):
+            await pipeline
+    finally:
+        _source_name.reset(token)
+        # The batches of a failed load are not in flight anymore
+        _BATCHES_IN_FLIGHT.dec(in_flight, source=source_name)
+
+
+def _collect_shard(  # noqa: CFQ002
+    config,
+    db_dsn: str,
+    log_level: int,
+    filters,
+    units,
+    run_id: str,
+    trace: bool = False,
+) -> Tuple[dict, List[dict]]:
+    """Collect some units of the data sources in a worker process.
+
+    Return a snapshot of the metrics of the worker process, and its trace events
+    when ``trace`` is set. The units are recorded in the run ``run_id``, and their
+    rows are loaded into the staging tables of the run.
+    """
+
+    async def _async_collect_shard():
+        engine = create_engine(db_dsn)
+        provider = AWSProvider(
+            config=config, db_engine=engine, log_level=log_level, filters=filters
+        )
+        try:
+            await provider._collect_data_sources(units, run_id=run_id, staged=True)
+        finally:
+            await provider.close()
+            await engine.dispose()
+
+    if trace:
+        tracing.start_tracing()
+    try:
+        asyncio.run(_async_collect_shard())
+    finally:
+        tracer = tracing.stop_tracing()
+        # The queued messages are lost when the worker process exits
+        logger.complete()
+
+    return metrics.snapshot(), tracer.events if tracer else []
+
+
+def _shard_by_account(units: List[dict], shard_count: int) -> List[List[dict]]:
+    units_by_account: dict = {}
+    for unit in units:
+        units_by_account.setdefault(unit["account_id"], []).append(unit)
+    accounts = list(units_by_account.values())
+
+    return [
+        [
+            unit
+            for account_units in accounts[index::shard_count]
+            for unit in account_units
+        ]
+        for index in range(min(shard_count, len(accounts)))
+    ]
+
+
+def _get_source_durations(
+    provider: str, units: Iterable[dict], history: dict
+) -> Dict[str, float]:
+    """Return the expected number of seconds of each data source of some units.
+
+    The units of a data source are collected at the same time, so it is expected
+    to last as long as its longest unit in the previous runs. The data sources
+    whose units were never collected are left out.
+    """
+    durations: Dict[str, float] = {}
+    for unit in units:
+        unit_metrics = history.get(
+            (provider, unit["source"], unit["account_id"], unit["region"])
+        )
+        if unit_metrics is not None:
+            durations[unit["source"]] = max(
+                durations.get(unit["source"], 0.0), unit_metrics["duration"]
             )
 
+    return durations
+
+
+def _group_by_source(source_names: List[str], units: List[dict]) -> dict:
+    units_by_source: dict = {name: [] for name in source_names}
+    for unit in units:
+        units_by_source[unit["source"]].append(unit)
+
+    return units_by_source
+
 
 @dataclass(frozen=True)
 @providers.register("aws")
 class AWSProvider(Provider):
     """Provider that interacts with AWS API."""
 
+    _sessions: dict = field(default_factory=dict, init=False, repr=False)
+    _rate_limiter: Optional[RateLimiter] = field(default=None, init=False, repr=False)
+
     def __post_init__(self):
         """Set some fields after the class initialization."""
         super().__post_init__()
         logging.getLogger("botocore").setLevel(self.log_level)
 
-    async def collect(self):  # noqa: D202
-        """Extract, transform and load from the provider data sources into the database."""  # noqa: E501
+        rate_limit_store = self.config["settings"]["rate_limit_store"]
+        if rate_limit_store:
+            builtins.object.__setattr__(
+                self, "_rate_limiter", RateLimiter(rate_limit_store)
+            )
 
-        def _build_table(conn, name, columns, excluded_default_columns):
-            table = Table(name, MetaData(bind=conn))
+    def _get_concurrency(self, name: str, default: int) -> int:
+        concurrency = self.config["settings"][name]
+        return default if concurrency is None else concurrency
 
-            if "account_id" not in excluded_default_columns:
-                columns.append(
-                    DataSourceColumn(
-                        description="The AWS account ID.",
-                        hydrate=jmespath.compile("metadata.account_id"),
-                        index=True,
-                        name="account_id",
-                    )
-                )
+    async def _wait_for_rate_limit(self, account_id: str, region: str, service: str):
+        if self._rate_limiter is None:
+            return
 
-            if "region" not in excluded_default_columns:
-                columns.append(
-                    DataSourceColumn(
-                        description="The AWS region.",
-                        hydrate=jmespath.compile("metadata.region"),
-                        index=True,
-                        name="region",
-                    )
-                )
+        rates = self.config["settings"]["rate_limits"]
+        await self._rate_limiter.acquire(
+            f"{account_id}/{region}/{service}",
+            rates.get(service, rates.get("default", DEFAULT_RATE_LIMIT)),
+        )
+
+    @contextlib.contextmanager
+    def _call_settings(self):
+        """Apply the settings of the provider to the API calls made in the context."""
+        deadline_token = _call_deadline.set(self.config["settings"]["call_deadline"])
+        rate_limit_token = _rate_limit.set(
+            self._wait_for_rate_limit if self._rate_limiter else None
+        )
+        try:
+            yield
+        finally:
+            _rate_limit.reset(rate_limit_token)
+            _call_deadline.reset(deadline_token)
+
+    async def _get_session(self, account_config):
+        key = (account_config.profile, account_config.assume_role)
+        if key not in self._sessions:
+            self._sessions[key] = _PooledSession(
+                await _get_session(account_config),
+                self.config["settings"]["endpoint_url"],
+            )
+
+        return self._sessions[key]
+
+    def _get_source_names(self) -> List[str]:
+        return [
+            name
+            for name in self.config["sources"]
+            if self.filters.match(self.filters.sources, name)
+        ]
 
-            columns = sorted(columns, key=lambda c: dataclasses.asdict(c)["name"])
-            for column in columns:
-                table.append_column(
-                    Column(
-                        column.name,
-                        column.type,
-                        comment=column.description,
-                        index=column.index,
+    async def _get_scheduler(self, units_by_source: dict) -> Scheduler:
+        async with self.db_engine.connect() as conn:
+            history = await get_unit_history(conn)
+
+        source_durations = _get_source_durations(
+            self.type,
+            [unit for units in units_by_source.values() for unit in units],
+            history,
+        )
+        return Scheduler(
+            units_by_source,
+            cost=source_durations.get,
+            api=lambda name: data_sources.get(name).extract_config["service_name"],
+        )
+
+    async def _prepare_table(self, conn, table: Table, units: List[dict]) -> None:
+        if not self.filters.partial:
+            await _create_table(conn, table)
+            return
+
+        # Only the rows of the collected accounts and regions are replaced
+        keys = [name for name in ("account_id", "region") if name in table.c]
+        if not keys:
+            await _create_table(conn, table)
+            return
+
+        await conn.run_sync(table.create, checkfirst=True)
+        if units:
+            await conn.execute(
+                table.delete().where(
+                    tuple_(*[table.c[key] for key in keys]).in_(
+                        sorted({tuple(unit[key] for key in keys) for unit in units})
                     )
                 )
+            )
 
-            return table
+    async def _extract_unit(
+        self, data_source, unit: dict, usage: Optional[_UnitUsage] = None
+    ):
+        """Yield the batches of a unit, until the unit deadline passes.
+
+        The API calls of the unit are counted in ``usage``, if any, along with the
+        start and end of the extraction.
+        """
+        session = await self._get_session(AttrDict(unit["account"]))
+        batches = data_source.extract_region(
+            session=session, account_id=unit["account_id"], region=unit["region"]
+        ).__aiter__()
+
+        timeout = self.config["settings"]["unit_deadline"]
+        durations = _unit_durations.get()
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        # The span is made current only while a batch is awaited, since the steps
+        # of the generator may run in different tasks.
+        span = tracing.start_span(
+            f"{unit['account_id']}/{unit['region']}",
+            "unit",
+            account_id=unit["account_id"],
+            region=unit["region"],
+        )
+        batch_count = 0
+        if usage is not None:
+            usage.started_at = datetime.now(timezone.utc)
+        try:
+            while True:
+                remaining = (
+                    None if timeout is None else started_at + timeout - loop.time()
+                )
+                try:
+                    with tracing.use_span(span), _using(usage):
+                        batch = await asyncio.wait_for(batches.__anext__(), remaining)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError as error:
+                    raise DeadlineExceededError(
+                        f"{get_unit_name(unit)} was not extracted within {timeout}s"
+                    ) from error
+
+                batch_count += 1
+                yield batch
+        finally:
+            # The extraction is closed as soon as the unit ends, whether it is
+            # exhausted, late or no longer consumed.
+            await batches.aclose()
+            if span is not None:
+                span.set(batches=batch_count)
+            tracing.end_span(span)
+            if durations is not None:
+                durations[get_unit_name(unit)] = loop.time() - started_at
+            if usage is not None:
+                usage.finished_at = datetime.now(timezone.utc)
+            _UNITS_EXTRACTED.inc(source=unit["source"], account_id=unit["account_id"])
+
+    async def _extract_units(self, data_source, units: List[dict], usages: dict):
+        for unit in units:
+            yield self._extract_unit(
+                data_source, unit, usages[(unit["account_id"], unit["region"])]
+            )
 
-        async def _process_data_source(name: str, data_source, aws_accounts):
-            async with self.db_engine.begin() as conn:
-                table = _build_table(
-                    columns=data_source.columns,
-                    conn=conn,
-                    excluded_default_columns=data_source.excluded_default_columns,
-                    name=name,
+    async def _record_units(  # noqa: CFQ002
+        self,
+        run_id: str,
+        data_source,
+        units: List[dict],
+        usages: dict,
+        error: Optional[Exception] = None,
+    ) -> None:
+        """Record the units of a data source in a local run, once it is loaded."""
+        extract_method = (
+            data_source.extract_config["service_name"],
+            data_source.extract_config["method_name"],
+        )
+        now = datetime.now(timezone.utc)
+        records = []
+        for unit in units:
+            usage = usages[(unit["account_id"], unit["region"])]
+            records.append(
+                dict(
+                    unit,
+                    provider=self.type,
+                    status=COMPLETED if error is None else FAILED,
+                    error=None if error is None else repr(error),
+                    started_at=usage.started_at,
+                    finished_at=usage.finished_at or now,
+                    **usage.get_metrics(extract_method),
                 )
-                if await conn.run_sync(table.exists):
-                    await conn.run_sync(table.drop)
-                await conn.run_sync(table.create)
-
-                pipeline = (
-                    flatten(data_source.extract(aws_accounts))
-                    | flatmap(data_source.enrich)
-                    | flatmap(data_source.transform)
-                    | to_sqlalchemy(conn, table)
+            )
+
+        await WorkQueue(self.db_engine).record_units(run_id, records)
+
+    async def _collect_data_source(
+        self,
+        name: str,
+        units: List[dict],
+        run_id: Optional[str] = None,
+        staged: bool = False,
+    ):
+        """Collect the units of a data source, in a single transaction.
+
+        The units are recorded in the run ``run_id``, if any, once the transaction
+        ends, so that their rows are counted and their status is the one of
+        the transaction.
+
+        :param staged: Load the rows into the staging table of the run, instead
+            of replacing the ones of the data source table.
+        """
+        data_source = data_sources.get(name)
+        table = data_source.execution_plan.table
+        if staged and run_id is not None:
+            table = _get_staging_table(table, run_id)
+        usages = {(unit["account_id"], unit["region"]): _UnitUsage() for unit in units}
+        with self._call_settings(), tracing.span(name, "source", units=len(units)):
+            try:
+                async with profiling.profile_source(name):
+                    async with self.loads, self.db_engine.begin() as conn:
+                        if not staged:
+                            await self._prepare_table(conn, table, units)
+
+                        await _load_data_source(
+                            conn,
+                            table,
+                            data_source,
+                            flatten(self._extract_units(data_source, units, usages)),
+                            usages=usages,
+                            enrich_concurrency=self._get_concurrency(
+                                "enrich_concurrency", DEFAULT_ENRICH_CONCURRENCY
+                            ),
+                        )
+            except Exception as error:  # noqa: B902
+                if run_id is not None:
+                    await self._record_units(run_id, data_source, units, usages, error)
+                raise
+
+        if run_id is not None:
+            await self._record_units(run_id, data_source, units, usages)
+
+    async def _collect_data_sources(
+        self, units: List[dict], run_id: str = None, staged: bool = False
+    ):
+        """Collect the units of the data sources, each data source in a transaction.
+
+        :param run_id: Run the units are recorded in, if any.
+        :param staged: Load the rows into the staging tables of the run, instead
+            of replacing the ones of the data source tables.
+        """
+
+        async def _process_data_source(name: str):
+            _SOURCES_RUNNING.inc()
+            try:
+                await self._collect_data_source(
+                    name, units_by_source[name], run_id, staged
                 )
-                with contextlib.suppress(aiostream.core.StreamEmpty):
-                    await pipeline
+            except DeadlineExceededError as error:
+                # The transaction is rolled back, so the table keeps its previous rows
+                logger.error(f"{name} was not collected: {error}")
+                late_sources.append(name)
+            finally:
+                _SOURCES_RUNNING.dec()
+                scheduler.done(name)
 
             # KLUDGE: Must yield something so that this function is an async generator
             yield None
 
         async def _get_coros():
-            aws_accounts = self.config["settings"]["accounts"]
-
-            for data_source_name in self.config["sources"]:
-                data_source = data_sources.get(data_source_name)
-                yield _process_data_source(
-                    name=data_source_name,
-                    data_source=data_source,
-                    aws_accounts=aws_accounts,
+            # Data sources are picked as slots free up, so that the scheduler
+            # knows which ones are still running.
+            while scheduler:
+                name = scheduler.dispatch()
+                _SOURCES_PENDING.set(len(scheduler))
+                yield _process_data_source(name=name)
+
+        units_by_source = _group_by_source(self._get_source_names(), units)
+        scheduler = await self._get_scheduler(units_by_source)
+        for unit in units:
+            _UNITS_PLANNED.inc(source=unit["source"], account_id=unit["account_id"])
+        late_sources: List[str] = []
+        durations: dict = {}
+        # The memory used by a data source is only known when it runs alone
+        task_limit = 1 if profiling.is_profiling() else MAX_LOADS
+        token = _unit_durations.set(durations)
+        try:
+            await flatten(_get_coros(), task_limit=task_limit)
+        finally:
+            _unit_durations.reset(token)
+            logger.info(f"Units took {describe_tail(durations)}")
+
+        if late_sources:
+            raise DeadlineExceededError(
+                f"Data sources not collected in time: {', '.join(late_sources)}"
+            )
+
+    async def _publish_staging_tables(
+        self, units_by_source: dict, run_id: str, failed: bool
+    ):
+        """Replace the rows of the data sources with the ones of the staging tables.
+
+        The rows of a data source are replaced in a single transaction, unless
+        a worker process ``failed``, and its staging table is dropped.
+        """
+        for data_source_name, source_units in units_by_source.items():
+            table = data_sources.get(data_source_name).execution_plan.table
+            async with self.db_engine.begin() as conn:
+                staging_table = _get_staging_table(table, run_id)
+                if not failed:
+                    await self._prepare_table(conn, table, source_units)
+                    await conn.execute(
+                        table.insert().from_select(
+                            table.columns.keys(),
+                            select(
+                                *[
+                                    cast(staging_table.c[column.name], column.type)
+                                    for column in table.columns
+                                ]
+                            ),
+                        )
+                    )
+                await conn.run_sync(staging_table.drop, checkfirst=True)
+
+    async def _collect_in_processes(self, units: List[dict], run_id: str):
+        """Collect the units in worker processes, each one collecting some accounts.
+
+        The worker processes load the rows into staging tables, which replace the
+        rows of the data source tables once they all finished. So the tables are
+        never read partially loaded, and they keep their previous rows when
+        a worker process fails, like when collected in a single process.
+        """
+        units_by_source = _group_by_source(self._get_source_names(), units)
+        async with self.db_engine.begin() as conn:
+            for data_source_name in units_by_source:
+                table = data_sources.get(data_source_name).execution_plan.table
+                await _create_table(conn, _get_staging_table(table, run_id))
+
+        try:
+            errors = await self._run_shards(units, run_id)
+        except BaseException:
+            await self._publish_staging_tables(units_by_source, run_id, failed=True)
+            raise
+
+        await self._publish_staging_tables(units_by_source, run_id, failed=bool(errors))
+        if errors:
+            raise errors[0]
+
+    async def _run_shards(self, units: List[dict], run_id: str) -> List[BaseException]:
+        """Collect the shards of units in worker processes.
+
+        Return the errors of the worker processes that failed.
+        """
+        # Work is split by account so that each session is only set up once
+        shards = _shard_by_account(units, self.workers)
+        if not shards:
+            return []
+
+        db_dsn = self.db_engine.url.render_as_string(hide_password=False)
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(
+            max_workers=len(shards),
+            mp_context=multiprocessing.get_context("spawn"),
+            # The worker processes log like this one
+            initializer=functools.partial(
+                logs.configure, self.log_level, **logs.get_sink_options()
+            ),
+        ) as executor:
+            results = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        executor,
+                        _collect_shard,
+                        self.config,
+                        db_dsn,
+                        self.log_level,
+                        self.filters,
+                        shard,
+                        run_id,
+                        tracing.is_tracing(),
+                    )
+                    for shard in shards
+                ],
+                return_exceptions=True,
+            )
+
+        # The metrics and the traces of the worker processes are added
+        # to the ones of this process
+        errors = []
+        for result in results:
+            if isinstance(result, BaseException):
+                errors.append(result)
+            else:
+                snapshot, trace_events = result
+                metrics.merge(snapshot)
+                tracing.add_events(trace_events)
+
+        return errors
+
+    async def _get_account_regions(self, session) -> List[str]:
+        patterns = self.filters.regions
+        # Regions named explicitly spare the discovery of the account regions
+        if patterns and not any(char in "".join(patterns) for char in "*?["):
+            return list(patterns)
+
+        return await _get_account_regions(session)
+
+    async def _get_empty_units(self) -> set:
+        probe_interval = self.config["settings"]["empty_region_probe_interval"]
+        if probe_interval is None:
+            probe_interval = DEFAULT_EMPTY_REGION_PROBE_INTERVAL
+        if not probe_interval:
+            return set()
+
+        async with self.db_engine.connect() as conn:
+            empty_units = await get_empty_units(conn, probe_interval)
+
+        if empty_units:
+            logger.info(
+                f"Skipping {len(empty_units)} (account, region, source) units "
+                f"without resources in the last {probe_interval}s"
+            )
+        return empty_units
+
+    async def _plan_account(
+        self,
+        aws_account,
+        source_names: List[str],
+        history: Optional[dict],
+        empty_units: set,
+    ) -> List[dict]:
+        session = await self._get_session(aws_account)
+        account_id = await _get_account_id(session)
+        if not self.filters.match(
+            self.filters.accounts, account_id, aws_account.profile
+        ):
+            return []
+
+        if aws_account.regions:
+            # The regions listed for an account are always collected
+            account_regions = list(aws_account.regions)
+            empty_units = set()
+        elif history is None:
+            account_regions = await self._get_account_regions(session)
+        else:
+            account_regions = sorted(
+                {
+                    region
+                    for provider, _, history_account_id, region in history
+                    if provider == self.type and history_account_id == account_id
+                }
+            )
+            if not account_regions:
+                # The account was never collected, so all the regions may be enabled
+                account_regions = await session.get_available_regions(
+                    "ec2", partition_name="aws"
+                )
+
+        units = []
+        for data_source_name in source_names:
+            extract_config = data_sources.get(data_source_name).extract_config
+            regions = extract_config.get("regions")
+            if not regions:
+                regions = await _get_available_regions(
+                    session=session,
+                    service_name=extract_config["service_name"],
+                    account_regions=account_regions,
+                )
+
+            for region in sorted(regions):
+                if not self.filters.match(self.filters.regions, region):
+                    continue
+
+                if (self.type, data_source_name, account_id, region) in empty_units:
+                    continue
+
+                units.append(
+                    {
+                        "account": {
+                            "assume_role": aws_account.assume_role,
+                            "profile": aws_account.profile,
+                        },
+                        "account_id": account_id,
+                        "region": region,
+                        "service": extract_config["service_name"],
+                        "source": data_source_name,
+                    }
+                )
+
+        return units
+
+    async def plan(self, history: dict = None):
+        """Return the (account, region, source) units to collect.
+
+        Only the units matching the filters are returned. The accounts that do not
+        match are skipped before their regions are discovered.
+
+        The data sources that held no resources in an account and a region, each
+        time they were collected there in the last ``empty_region_probe_interval``
+        seconds, are skipped there, unless the regions of the account are listed in
+        its configuration.
+
+        :param history: Metrics of the units in the previous runs, as returned by
+            :func:`pantomath.workqueue.get_unit_history`. When given, the regions
+            of the accounts are the ones collected before, instead of being
+            discovered.
+        """
+        source_names = self._get_source_names()
+        empty_units = await self._get_empty_units()
+        slots = asyncio.Semaphore(
+            self._get_concurrency("plan_concurrency", DEFAULT_PLAN_CONCURRENCY)
+        )
+
+        async def _plan_account(aws_account):
+            async with slots:
+                return await self._plan_account(
+                    aws_account, source_names, history, empty_units
+                )
+
+        accounts_units = await asyncio.gather(
+            *[
+                _plan_account(aws_account)
+                for aws_account in self.config["settings"]["accounts"]
+            ]
+        )
+        return [unit for units in accounts_units for unit in units]
+
+    async def collect_unit(self, conn, unit: dict) -> dict:
+        """Extract, transform and stage an (account, region, source) unit.
+
+        Return the numbers of API calls, pages, rows, throttling errors and
+        response bytes of the unit.
+        """
+        data_source = data_sources.get(unit["source"])
+        usage = _UnitUsage()
+        with self._call_settings():
+            await _load_data_source(
+                conn,
+                run_rows,
+                data_source,
+                self._extract_unit(data_source, unit, usage),
+                stage=stage_rows(unit),
+                enrich_concurrency=self._get_concurrency(
+                    "enrich_concurrency", DEFAULT_ENRICH_CONCURRENCY
+                ),
+                usages={(unit["account_id"], unit["region"]): usage},
+            )
+
+        return usage.get_metrics(
+            (unit["service"], data_source.extract_config["method_name"])
+        )
+
+    async def _get_skipped_regions(self, units: List[dict]) -> dict:
+        collected_regions: dict = {}
+        for unit in units:
+            collected_regions.setdefault(unit["account_id"], set()).add(unit["region"])
+
+        # Botocore knows the regions without calling AWS
+        session = aiobotocore.session.AioSession()  # noqa: SC200
+        regions = set(await session.get_available_regions("ec2", partition_name="aws"))
+
+        return {
+            account_id: sorted(regions - account_regions)
+            for account_id, account_regions in collected_regions.items()
+        }
+
+    async def estimate(self) -> Estimate:
+        """Estimate the cost of a collection from the previous runs.
+
+        AWS list and describe APIs are not called: the regions of the accounts are
+        the ones collected in the previous runs. The data sources are assumed to
+        be collected as by :meth:`collect`, with the same number of workers.
+        """
+        async with self.db_engine.connect() as conn:
+            history = await get_unit_history(conn)
+
+        try:
+            units = await self.plan(history=history)
+        finally:
+            await self.close()
+
+        api_calls: Counter = Counter()
+        unknown_units = 0
+        shard_durations = []
+        for shard in _shard_by_account(units, self.workers):
+            for unit in shard:
+                unit_metrics = history.get(
+                    (self.type, unit["source"], unit["account_id"], unit["region"])
                 )
+                if unit_metrics is None:
+                    unknown_units += 1
+                    unit_metrics = {}
+
+                api_calls[unit["service"]] += unit_metrics.get("pages") or 1
+                enrich_config = data_sources.get(unit["source"]).enrich_config
+                for config in enrich_config.values():
+                    api_calls[config["service_name"]] += unit_metrics.get("rows") or 0
+
+            # The data sources are scheduled with the same expected durations
+            source_durations = _get_source_durations(self.type, shard, history)
+            shard_durations.append(
+                estimate_duration(source_durations.values(), slots=MAX_LOADS)
+            )
+
+        return Estimate(
+            units=units,
+            api_calls=dict(api_calls),
+            duration=max(shard_durations, default=0.0),
+            unknown_units=unknown_units,
+            skipped_regions=await self._get_skipped_regions(units),
+        )
+
+    async def publish(self, conn, run_id: str):
+        """Replace the data source tables with the rows staged by a run.
+
+        The tables are replaced in the transaction of the connection, see
+        :meth:`pantomath.workqueue.WorkQueue.publish`.
+        """
+        for data_source_name in self.config["sources"]:
+            table = data_sources.get(data_source_name).execution_plan.table
+            await _create_table(conn, table)
+            await publish_rows(conn, table, run_id, data_source_name)
+
+    async def collect(self):
+        """Extract, transform and load from the provider data sources into the database.
+
+        The run is recorded in the run tables of the work queue, along with the
+        units as their data sources are loaded, so that the next runs are planned
+        and scheduled from it.
+        """  # noqa: E501
+        queue = WorkQueue(self.db_engine)
+        await queue.setup()
+        run_id = await queue.create_local_run()
+        try:
+            with tracing.span("plan", "plan"):
+                units = await self.plan()
+            logger.info(f"Run {run_id} started with {len(units)} units")
+            if self.workers > 1:
+                await self._collect_in_processes(units, run_id)
+            else:
+                await self._collect_data_sources(units, run_id=run_id)
+        finally:
+            await self.close()
+            await queue.finish_run(run_id)
+
+    async def serve(self):
+        """Refresh each data source on its own interval, until cancelled.
+
+        The units to collect are planned once, when the provider starts serving.
+        """
+        intervals = self.config["refresh_intervals"]
+        default_interval = intervals.get("default", DEFAULT_REFRESH_INTERVAL)
+        loop = asyncio.get_running_loop()
+
+        async def _refresh_periodically(name: str):
+            interval = intervals.get(name, default_interval)
+            while True:
+                started_at = loop.time()
+                try:
+                    await self._collect_data_source(name, units_by_source[name])
+                except Exception:  # noqa: B902
+                    logger.exception(f"Refreshing {name} failed")
+                else:
+                    logger.info(f"Refreshed {name} in {loop.time() - started_at:.1f}s")
+
+                await asyncio.sleep(max(0, interval - (loop.time() - started_at)))
 
-        await flatten(_get_coros(), task_limit=20)
+        try:
+            units_by_source = _group_by_source(
+                self._get_source_names(), await self.plan()
+            )
+            await asyncio.gather(
+                *[_refresh_periodically(name) for name in units_by_source]
+            )
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Close the connections to AWS."""
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+def _referenced_fields(node: dict) -> Optional[Set[str]]:  # noqa: CFQ004
+    """Return the top-level fields read by a JMESPath expression.
+
+    ``None`` is returned when the expression may read the whole item.
+    """
+    node_type = node["type"]
+    children = node["children"]
+
+    if node_type == "field":
+        return {node["value"]}
+
+    if node_type == "literal":
+        return set()
+
+    if node_type == "subexpression" and children[0]["type"] in ("current", "identity"):
+        return _referenced_fields(children[1])
+
+    if node_type in (
+        "filter_projection",
+        "flatten",
+        "index_expression",
+        "pipe",
+        "projection",
+        "subexpression",
+        "value_projection",
+    ):
+        # Only the left-most child is evaluated against the item itself
+        return _referenced_fields(children[0])
+
+    if node_type in (
+        "and_expression",
+        "comparator",
+        "function_expression",
+        "key_val_pair",
+        "multi_select_dict",
+        "multi_select_list",
+        "not_expression",
+        "or_expression",
+    ):
+        fields: Set[str] = set()
+        for child in children:
+            child_fields = _referenced_fields(child)
+            if child_fields is None:
+                return None
+            fields |= child_fields
+
+        return fields
+
+    return None
+
+
+def _placeholder_fields(value) -> Optional[Set[str]]:
+    """Return the top-level fields referenced by the placeholders of parameters."""
+    if isinstance(value, dict):
+        value = list(value.values())
+
+    fields: Set[str] = set()
+    if isinstance(value, (list, tuple, set)):
+        for item in value:
+            item_fields = _placeholder_fields(item)
+            if item_fields is None:
+                return None
+            fields |= item_fields
+    elif isinstance(value, str):
+        try:
+            for _, name, _, _ in string.Formatter().parse(value):
+                if name is not None:
+                    fields.add(name.split(".")[0].split("[")[0])
+        except ValueError:
+            return None
+
+    return fields
 
 
 class AwsDataSource(DataSource):
@@ -302,23 +1730,46 @@ class AwsDataSource(DataSource):
     :param enrich_config: Optional list of configuration to data enrichers.
     :param excluded_default_columns: List of default columns to be omitted.
     :param extract_config: Optional list of configuration to data extractors.
+    :param fields: Fields of the raw resources used by the columns and the enrichers.
+        ``None`` means that all the fields are kept.
+    :param execution_plan: Plan compiled from the other attributes, when the
+        data source is instantiated. It is shared by the runs in the process.
+
+    Columns are hydrated with a JMESPath expression evaluated against each item,
+    or with a callable that receives the :class:`AwsResourceBatch` and returns
+    the value shared by all the items of the batch.
     """
 
     enrich_config: dict = field(default_factory=dict, init=True)
     extract_config: dict = field(default_factory=dict, init=False)
+    fields: Optional[frozenset] = field(default=None, init=False)
+    execution_plan: AwsExecutionPlan = field(default=None, init=False)  # type: ignore
 
     def __init__(self):
         """Initialize the object."""
         super().__init__()
 
         columns = []
+        fields: Optional[Set[str]] = set()
         for column in self.columns:
             hydrate = column.hydrate
-            if not hydrate.startswith("resource.") and not hydrate.startswith(
-                tuple(self.enrich_config)
-            ):
+            raw_hydrate: Optional[str] = hydrate
+            if not self.enrich_config:
+                # Raw items are not wrapped when there is nothing to enrich them with
+                if hydrate.startswith("resource."):
+                    hydrate = hydrate[len("resource.") :]
+                raw_hydrate = hydrate
+            elif hydrate.startswith("resource."):
+                raw_hydrate = hydrate[len("resource.") :]
+            elif hydrate.startswith(tuple(self.enrich_config)):
+                raw_hydrate = None
+            else:
                 hydrate = f"resource.{hydrate}"
 
+            if raw_hydrate is not None and fields is not None:
+                column_fields = _referenced_fields(jmespath.compile(raw_hydrate).parsed)
+                fields = None if column_fields is None else fields | column_fields
+
             columns.append(
                 DataSourceColumn(
                     description=column.description,
@@ -332,80 +1783,167 @@ class AwsDataSource(DataSource):
 
         builtins.object.__setattr__(self, "columns", columns)
 
+        for config in self.enrich_config.values():
+            if fields is None:
+                break
+            parameters_fields = _placeholder_fields(config.get("method_parameters"))
+            fields = None if parameters_fields is None else fields | parameters_fields
+
+        if fields is not None:
+            fields.discard("metadata")
+            fields = frozenset(fields)
+        builtins.object.__setattr__(self, "fields", fields)
+        builtins.object.__setattr__(self, "execution_plan", self._compile())
+
         if hasattr(self, "__post_init__") and callable(self.__post_init__):
             self.__post_init__()
 
-    async def enrich(self, source):  # noqa: CFQ004
-        """Enriche data from other sources."""
-        # TODO: Properly name this method
-        async def _wrap_botocore(source, *args, **kwargs):  # noqa: CFQ004
-            # Borrowed from https://stackoverflow.com/a/50815499
-            def recursiveMap(something, func, *args, **kwargs):
-                if isinstance(something, dict):
-                    accumulator = {}
-                    for key, value in something.items():
-                        accumulator[key] = recursiveMap(value, func, *args, **kwargs)
-                    return accumulator
-                elif isinstance(something, (list, tuple, set)):
-                    accumulator = []
-                    for item in something:
-                        accumulator.append(recursiveMap(item, func, *args, **kwargs))
-                    return type(something)(accumulator)
-                else:
-                    return func(something, *args, **kwargs)
+    def _compile(self) -> AwsExecutionPlan:
+        columns = list(self.columns)
+        if "account_id" not in self.excluded_default_columns:
+            columns.append(
+                DataSourceColumn(
+                    description="The AWS account ID.",
+                    hydrate=attrgetter("account_id"),
+                    index=True,
+                    name="account_id",
+                )
+            )
 
-            def replace_placeholders(value, *args, **kwargs):
-                if isinstance(value, str):
-                    return value.format(**kwargs)
-                else:
-                    return value
+        if "region" not in self.excluded_default_columns:
+            columns.append(
+                DataSourceColumn(
+                    description="The AWS region.",
+                    hydrate=attrgetter("region"),
+                    index=True,
+                    name="region",
+                )
+            )
 
-            if "method_parameters" in kwargs:
-                # Replace the placeholders with the item values
-                kwargs["method_parameters"] = recursiveMap(
-                    kwargs["method_parameters"], replace_placeholders, **source
+        columns.sort(key=attrgetter("name"))
+
+        table = Table(self.type, MetaData())
+        for column in columns:
+            table.append_column(
+                Column(
+                    column.name,
+                    column.type,
+                    comment=column.description,
+                    index=column.index,
                 )
+            )
 
-            kwargs["add_metadata"] = False
+        enrichers = []
+        for name, config in self.enrich_config.items():
+            config = dict(config)
+            enrichers.append(
+                AwsEnricher(
+                    name=name,
+                    config=config,
+                    render_parameters=_compile_template(
+                        config.pop("method_parameters", None)
+                    ),
+                )
+            )
+
+        return AwsExecutionPlan(
+            table=table,
+            columns=tuple(columns),
+            codecs=tuple(codecs.get(column) for column in columns),
+            extract=functools.partial(
+                _get_batches, fields=self.fields, **self.extract_config
+            ),
+            enrichers=tuple(enrichers),
+        )
+
+    async def enrich(  # noqa: CFQ004
+        self, batch: AwsResourceBatch, slots: Optional[asyncio.Semaphore] = None
+    ) -> AwsResourceBatch:
+        """Enrich a batch of items with data from other sources.
 
+        :param slots: Semaphore limiting the number of items enriched at the same
+            time, shared by the batches of the data source.
+        """
+
+        @loopmonitor.stage("enrich")
+        async def _call_enricher(enricher: AwsEnricher, source: dict):
             # Return the first element since we are processing a single item at a time
-            return [r async for r in _call_botocore_method(*args, **kwargs)][0]
+            async for page in _call_botocore_method(
+                session=batch.session,
+                account_id=batch.account_id,
+                region_name=batch.region,
+                method_parameters=enricher.render_parameters(source),
+                **enricher.config,
+            ):
+                return page[0]
 
-        coros = []
-        for config in self.enrich_config.values():
-            coros.append(
-                _wrap_botocore(
-                    source=source,
-                    session=source["metadata"]["session"],
-                    account_id=source["metadata"]["account_id"],
-                    region_name=source["metadata"]["region"],
-                    **config,
+            return None
+
+        enrichers = self.execution_plan.enrichers
+        metadata = {"account_id": batch.account_id, "region": batch.region}
+        if slots is None:
+            slots = asyncio.Semaphore(DEFAULT_ENRICH_CONCURRENCY)
+
+        async def _enrich_item(item):
+            source = dict(item, metadata=metadata)
+            async with slots:
+                data = await asyncio.gather(
+                    *[_call_enricher(enricher, source) for enricher in enrichers]
                 )
-            )
-        data = await asyncio.gather(*coros)
-        output = dict(zip(self.enrich_config.keys(), data))
-        output["resource"] = {k: v for k, v in source.items() if k != "metadata"}
-        output["metadata"] = source["metadata"]
+            output = {enricher.name: value for enricher, value in zip(enrichers, data)}
+            output["resource"] = item
 
-        yield output
+            return output
+
+        batch.items = await asyncio.gather(
+            *[_enrich_item(item) for item in batch.items]
+        )
 
-    def extract(self, aws_accounts):
-        """Extract raw data from the data source."""
-        return from_botocore(aws_accounts=aws_accounts, **self.extract_config)
+        return batch
+
+    def extract(  # type: ignore
+        self, aws_accounts, get_session: Callable = _get_session
+    ):
+        """Extract raw data from the data source.
+
+        :param aws_accounts: List of AWS account information
+        :param get_session: Coroutine function returning the session for an account.
+        """
+        return from_botocore(
+            aws_accounts=aws_accounts,
+            fields=self.fields,
+            get_session=get_session,
+            **self.extract_config,
+        )
 
-    async def transform(self, item):
-        """Refine raw data from the data source."""
-        transformed_item = {}
+    def extract_region(self, session, account_id: str, region: str):
+        """Extract raw data from the data source for an account and a region."""
+        return self.execution_plan.extract(
+            session=session, account_id=account_id, region_name=region
+        )
 
-        for column in self.columns:
-            value = column.hydrate.search(item)
+    def transform(self, batch: AwsResourceBatch) -> list:
+        """Refine a batch of raw data from the data source, one column at a time."""
+        items = batch.items
+        names = []
+        values = []
+        for column, codec in zip(
+            self.execution_plan.columns, self.execution_plan.codecs
+        ):
+            # The expressions are compiled by the execution plan
+            hydrate: Any = column.hydrate
+            if callable(hydrate):
+                column_values = [hydrate(batch)] * len(items)
+            else:
+                column_values = [hydrate.search(item) for item in items]
 
-            if value is not None and column.transform is not None:
-                value = column.transform(value)
+            if codec is not None:
+                column_values = codec(column_values)
 
-            transformed_item[column.name] = value
+            names.append(column.name)
+            values.append(column_values)
 
-        yield transformed_item
+        return [dict(zip(names, row)) for row in zip(*values)]
 
 
 # These imports must be at the end of the file to avoid dependency issues
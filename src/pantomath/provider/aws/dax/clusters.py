@@ -63,7 +63,7 @@ class AwsDaxClustersDataSource(AwsDataSource):
     enrich_config: Dict = {
         "tags": {
             "method_name": "list_tags",
-            "method_parameters": {"ResourceName": "{ClusterName}}"},
+            "method_parameters": {"ResourceName": "{ClusterName}"},
             "results_filter": "Tags[]",
             "service_name": "dax",
         },
@@ -0,0 +1,77 @@
+"""Rate limits shared by the processes running on a host."""
+import asyncio
+import sqlite3
+import time
+from contextlib import closing
+from typing import Optional
+
+
+class RateLimiter:
+    """Token buckets stored in a SQLite database, shared by the processes using it.
+
+    Each bucket gains ``rate`` tokens per second, up to ``burst`` tokens. Every
+    call takes a token from its bucket, possibly before the token is available,
+    and waits until then. Calls are thus spaced out across all the processes,
+    in the order they took their tokens.
+
+    :param path: Path of the SQLite database file, created if needed.
+    """
+
+    def __init__(self, path: str):
+        """Initialize the object."""
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL"
+                ")"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # Transactions are started explicitly, see reserve()
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def reserve(
+        self, key: str, rate: float, burst: Optional[float] = None, now: float = None
+    ) -> float:
+        """Take a token from a bucket and return the number of seconds to wait for it.
+
+        :param key: Key of the bucket.
+        :param rate: Number of tokens the bucket gains per second.
+        :param burst: Maximum number of tokens in the bucket. Defaults to ``rate``.
+        :param now: Current time, in seconds since the epoch.
+        """
+        if burst is None:
+            burst = rate
+        if now is None:
+            now = time.time()
+
+        with closing(self._connect()) as conn:
+            # The database is locked until the transaction ends
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens = burst
+                if row is not None:
+                    tokens = min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                tokens -= 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at)"
+                    " VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+        return max(0.0, -tokens / rate)
+
+    async def acquire(self, key: str, rate: float, burst: Optional[float] = None):
+        """Wait until a call is allowed by a bucket, see :meth:`reserve`."""
+        loop = asyncio.get_running_loop()
+        delay = await loop.run_in_executor(None, self.reserve, key, rate, burst)
+        if delay:
+            await asyncio.sleep(delay)
@@ -1,4 +1,5 @@
 """Registry that lazily instantiates and caches objects."""
+from typing import List
 
 
 class CachedRegistry:
@@ -30,6 +31,10 @@ class CachedRegistry:
         if name in self._factories:
             del self._factories[name]
 
+    def names(self) -> List[str]:
+        """Return the names of the registered factories, sorted."""
+        return sorted(self._factories)
+
     def get(self, name: str, *args, **kwargs):
         """Return a object from the registry cache.
 
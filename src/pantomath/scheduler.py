@@ -0,0 +1,101 @@
+"""Scheduling of work according to its expected duration."""
+import heapq
+import math
+from collections import Counter
+from operator import itemgetter
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    Mapping,
+    Optional,
+    TypeVar,
+)
+
+Item = TypeVar("Item")
+
+
+class Scheduler(Generic[Item]):
+    """Dispatch the longest expected work first, keeping apart work on the same API.
+
+    Starting the longest work first (longest-processing-time-first) prevents
+    it from being started last and setting the total duration of a run.
+    Work whose duration is unknown is dispatched first, so that it is measured.
+
+    Work that calls the same API as work already running is held back, as long as
+    other work is available, so that both are not throttled by the same rate limit.
+
+    :param items: Work to dispatch. Ties are dispatched in the given order.
+    :param cost: Function returning the expected duration of some work, if known.
+    :param api: Function returning the API called by some work.
+    """
+
+    def __init__(
+        self,
+        items: Iterable[Item],
+        cost: Callable[[Item], Optional[float]],
+        api: Callable[[Item], Hashable],
+    ):
+        """Initialize the object."""
+
+        def _priority(item):
+            item_cost = cost(item)
+            return (item_cost is not None, -(item_cost or 0))
+
+        self._pending = sorted(items, key=_priority)
+        self._api = api
+        self._running: Dict[Hashable, int] = Counter()
+
+    def __len__(self) -> int:
+        """Return the number of items left to dispatch."""
+        return len(self._pending)
+
+    def dispatch(self) -> Item:
+        """Dispatch the next item, which must be released with :meth:`done`."""
+        index = next(
+            (
+                index
+                for index, item in enumerate(self._pending)
+                if not self._running[self._api(item)]
+            ),
+            0,
+        )
+        item = self._pending.pop(index)
+        self._running[self._api(item)] += 1
+        return item
+
+    def done(self, item: Item) -> None:
+        """Record that an item dispatched by :meth:`dispatch` finished."""
+        self._running[self._api(item)] -= 1
+
+
+def estimate_duration(durations: Iterable[float], slots: int) -> float:
+    """Return the duration of some work dispatched longest first to some slots."""
+    finish_times = [0.0] * slots
+    for duration in sorted(durations, reverse=True):
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+
+    return max(finish_times)
+
+
+def describe_tail(durations: Mapping[str, float], count: int = 5) -> str:
+    """Describe the distribution of the durations of some work and its slowest items.
+
+    :param durations: Number of seconds taken by each item of work, by name.
+    :param count: Number of slowest items to name.
+    """
+    if not durations:
+        return "no work"
+
+    ordered = sorted(durations.values())
+
+    def _percentile(rank: float) -> float:
+        return ordered[math.ceil(rank * len(ordered)) - 1]
+
+    slowest = heapq.nlargest(count, durations.items(), key=itemgetter(1))
+    return f"p50 {_percentile(0.5):.1f}s, p99 {_percentile(0.99):.1f}s, " + (
+        "slowest: "
+        + ", ".join(f"{name} ({duration:.1f}s)" for name, duration in slowest)
+    )
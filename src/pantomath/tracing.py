@@ -0,0 +1,165 @@
+"""Tracing of the runs into files of the Chrome trace event format.
+
+The files can be opened with https://ui.perfetto.dev or ``chrome://tracing``.
+Nothing is recorded unless tracing is started with :func:`start_tracing`.
+"""
+import contextlib
+import json
+import os
+import time
+from contextvars import ContextVar
+from typing import Iterator, List, Optional
+
+
+class Span:
+    """Operation traced from its start to its end.
+
+    :param name: Name of the operation.
+    :param category: Category of the operation, e.g. ``source`` or ``api_call``.
+    :param attributes: Attributes of the operation, shown with it.
+    """
+
+    __slots__ = ("attributes", "category", "lane", "name", "started_at")
+
+    def __init__(self, name: str, category: str, attributes: dict):
+        """Initialize the object."""
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.lane = 0
+
+    def set(self, **attributes) -> None:  # noqa: A003
+        """Set some attributes of the span."""
+        self.attributes.update(attributes)
+
+
+# Span of the operation being run, which the spans started are nested in
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Record spans as trace events.
+
+    Operations run concurrently, so spans are spread over lanes, shown as threads,
+    in which they are properly nested. A span goes in the lane of its parent,
+    unless another span is already open over the parent there.
+    """
+
+    def __init__(self):
+        """Initialize the object."""
+        self.events: List[dict] = []
+        self._lanes: List[List[Span]] = []
+        self._pid = os.getpid()
+
+    def _get_free_lane(self) -> int:
+        for index, lane in enumerate(self._lanes):
+            if not lane:
+                return index
+
+        self._lanes.append([])
+        return len(self._lanes) - 1
+
+    def start(self, span: Span, parent: Optional[Span]) -> None:
+        """Record the start of a span, nested in a parent span."""
+        if parent is not None and self._lanes[parent.lane][-1:] == [parent]:
+            span.lane = parent.lane
+        else:
+            span.lane = self._get_free_lane()
+        self._lanes[span.lane].append(span)
+
+    def end(self, span: Span) -> None:
+        """Record the end of a span."""
+        self._lanes[span.lane].remove(span)
+        self.events.append(
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": int(span.started_at * 1_000_000),
+                "dur": int((time.time() - span.started_at) * 1_000_000),
+                "pid": self._pid,
+                "tid": span.lane,
+                "args": span.attributes,
+            }
+        )
+
+    def write(self, path: str) -> None:
+        """Write the events recorded so far to a file."""
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def start_tracing() -> None:
+    """Start recording spans in the current process."""
+    global _tracer
+    _tracer = Tracer()
+
+
+def stop_tracing() -> Optional[Tracer]:
+    """Stop recording spans and return the tracer that recorded them, if any."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer  # noqa: R504
+
+
+def is_tracing() -> bool:
+    """Return whether spans are recorded in the current process."""
+    return _tracer is not None
+
+
+def add_events(events: List[dict]) -> None:
+    """Add the trace events recorded by another process, if tracing is started."""
+    if _tracer is not None:
+        _tracer.events.extend(events)
+
+
+def start_span(name: str, category: str, **attributes) -> Optional[Span]:
+    """Start a span nested in the current one, without making it current.
+
+    The span must be ended with :func:`end_span`. Nothing is done and ``None`` is
+    returned when tracing is not started.
+    """
+    if _tracer is None:
+        return None
+
+    span = Span(name, category, attributes)
+    _tracer.start(span, _current_span.get())
+    return span
+
+
+def end_span(span: Optional[Span]) -> None:
+    """End a span started by :func:`start_span`."""
+    if span is not None and _tracer is not None:
+        _tracer.end(span)
+
+
+@contextlib.contextmanager
+def use_span(span: Optional[Span]) -> Iterator[None]:
+    """Make a span the current one in the context."""
+    if span is None:
+        yield
+        return
+
+    token = _current_span.set(span)
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **attributes) -> Iterator[Optional[Span]]:
+    """Trace the context as a span nested in the current one.
+
+    ``None`` is yielded instead of the span when tracing is not started.
+    """
+    current = start_span(name, category, **attributes)
+    try:
+        with use_span(current):
+            yield current
+    finally:
+        end_span(current)
@@ -0,0 +1,745 @@
+"""Work queue that lets several collector processes share a collection run."""
+import asyncio
+import contextlib
+import os
+import socket
+import uuid
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    exists,
+    func,
+    inspect,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio.engine import AsyncEngine
+
+from pantomath.datasource.codec import encode_row
+
+metadata = MetaData()
+
+runs = Table(
+    "pantomath_runs",
+    metadata,
+    Column("id", Text, primary_key=True, comment="The run ID."),
+    Column("status", Text, nullable=False, comment="The run status."),
+    Column(
+        "started_at",
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+        comment="The date and time the run started.",
+    ),
+    Column(
+        "finished_at",
+        DateTime(timezone=True),
+        comment="The date and time the run finished.",
+    ),
+    Column(
+        "distributed",
+        Boolean,
+        nullable=False,
+        server_default="true",
+        comment="Whether the run was shared through the work queue. "
+        "The units of the other runs are recorded as they finish.",
+    ),
+)
+
+run_units = Table(
+    "pantomath_run_units",
+    metadata,
+    Column("id", BigInteger, primary_key=True, comment="The unit ID."),
+    Column(
+        "run_id",
+        Text,
+        ForeignKey(runs.c.id, ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+        comment="The run ID.",
+    ),
+    Column("provider", Text, nullable=False, comment="The provider name."),
+    Column("source", Text, nullable=False, comment="The data source name."),
+    Column(
+        "account",
+        JSONB,
+        comment="The configuration of the account to collect the data from.",
+    ),
+    Column("account_id", Text, comment="The account ID."),
+    Column("region", Text, comment="The region."),
+    Column(
+        "service",
+        Text,
+        comment="The service called by the unit, whose rate limits it shares.",
+    ),
+    Column("status", Text, nullable=False, comment="The unit status."),
+    Column(
+        "attempts",
+        Integer,
+        nullable=False,
+        server_default="0",
+        comment="The number of times the unit was claimed.",
+    ),
+    Column("worker_id", Text, comment="The ID of the worker processing the unit."),
+    Column(
+        "lease_expires_at",
+        DateTime(timezone=True),
+        comment="The date and time the worker lease on the unit expires.",
+    ),
+    Column(
+        "heartbeat_at",
+        DateTime(timezone=True),
+        comment="The date and time of the last heartbeat from the worker.",
+    ),
+    Column(
+        "started_at",
+        DateTime(timezone=True),
+        comment="The date and time the last attempt started.",
+    ),
+    Column(
+        "finished_at",
+        DateTime(timezone=True),
+        comment="The date and time the unit finished.",
+    ),
+    Column("error", Text, comment="The last error raised while processing the unit."),
+    Column(
+        "expected_duration",
+        Float,
+        comment="The number of seconds the unit took in the previous runs.",
+    ),
+    Column("api_calls", Integer, comment="The number of API calls made by the unit."),
+    Column(
+        "pages",
+        Integer,
+        comment="The number of pages of resources listed by the unit.",
+    ),
+    Column("rows", Integer, comment="The number of rows loaded by the unit."),
+    Column(
+        "throttles",
+        Integer,
+        comment="The number of API responses with a throttling error.",
+    ),
+    Column(
+        "response_bytes",
+        BigInteger,
+        comment="The number of bytes of the API responses fetched by the unit.",
+    ),
+    Index(
+        "ix_pantomath_run_units_history",
+        "provider",
+        "source",
+        "account_id",
+        "region",
+        "finished_at",
+    ),
+)
+
+run_rows = Table(
+    "pantomath_run_rows",
+    metadata,
+    Column(
+        "run_id",
+        Text,
+        ForeignKey(runs.c.id, ondelete="CASCADE"),
+        nullable=False,
+        comment="The run ID.",
+    ),
+    Column(
+        "unit_id",
+        BigInteger,
+        ForeignKey(run_units.c.id, ondelete="CASCADE"),
+        nullable=False,
+        comment="The ID of the unit that produced the row.",
+    ),
+    Column("source", Text, nullable=False, comment="The data source name."),
+    Column("data", JSONB, nullable=False, comment="The row values."),
+    Index("ix_pantomath_run_rows_run_id_source", "run_id", "source"),
+)
+
+# Columns added to the tables after their creation, with their SQL type
+_ADDED_COLUMNS = [
+    runs.c.distributed,
+    run_units.c.throttles,
+    run_units.c.response_bytes,
+]
+
+# Number of seconds the runs are kept for, with their units and staged rows
+DEFAULT_RETENTION = 30 * 24 * 3600
+
+# Unit and run statuses
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+PUBLISHED = "published"
+
+UnitCollector = Callable[..., Awaitable[Optional[dict]]]
+Publisher = Callable[[Any], Awaitable[None]]
+UnitKey = Tuple[str, str, Optional[str], Optional[str]]
+
+
+def get_worker_id() -> str:
+    """Return an ID that identifies the current process across hosts."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def stage_rows(unit: dict) -> Callable[[List[dict]], List[dict]]:
+    """Return a function that turns rows produced by a unit into staged rows."""
+    template = {
+        "run_id": unit["run_id"],
+        "source": unit["source"],
+        "unit_id": unit["id"],
+    }
+
+    def _stage_rows(rows: List[dict]) -> List[dict]:
+        return [dict(template, data=encode_row(row)) for row in rows]
+
+    return _stage_rows
+
+
+async def publish_rows(conn, table: Table, run_id: str, source: str) -> None:
+    """Move the rows staged by a run for a data source into the data source table."""
+    quote = conn.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column.name) for column in table.columns)
+    await conn.execute(
+        text(
+            f"INSERT INTO {quote(table.name)} ({columns}) "  # nosec
+            f"SELECT {', '.join(f'record.{quote(c.name)}' for c in table.columns)} "
+            f"FROM {run_rows.name}, "
+            f"jsonb_populate_record(NULL::{quote(table.name)}, data) AS record "
+            "WHERE run_id = :run_id AND source = :source"
+        ),
+        {"run_id": run_id, "source": source},
+    )
+    await conn.execute(
+        run_rows.delete()
+        .where(run_rows.c.run_id == run_id)
+        .where(run_rows.c.source == source)
+    )
+
+
+def get_unit_key(unit: dict) -> UnitKey:
+    """Return the key identifying a unit across runs."""
+    return (unit["provider"], unit["source"], unit["account_id"], unit["region"])
+
+
+def get_unit_name(unit) -> str:
+    """Return the name of a unit, as shown to users."""
+    return f"{unit['source']} in {unit['account_id']}/{unit['region']}"
+
+
+async def _has_history(conn) -> bool:
+    return await conn.run_sync(
+        lambda sync_conn: inspect(sync_conn).has_table(run_units.name)
+    )
+
+
+async def get_unit_history(conn) -> Dict[UnitKey, dict]:
+    """Return the metrics of each unit the last time it completed.
+
+    The metrics are the ``duration`` in seconds, and the ``api_calls``, ``pages``
+    and ``rows`` recorded when the unit completed.
+    """
+    if not await _has_history(conn):
+        return {}
+
+    key_columns = [
+        run_units.c.provider,
+        run_units.c.source,
+        run_units.c.account_id,
+        run_units.c.region,
+    ]
+    result = await conn.execute(
+        select(
+            *key_columns,
+            func.extract(
+                "epoch", run_units.c.finished_at - run_units.c.started_at
+            ).label("duration"),
+            run_units.c.api_calls,
+            run_units.c.pages,
+            run_units.c.rows,
+        )
+        .distinct(*key_columns)
+        .where(run_units.c.status == COMPLETED)
+        .order_by(*key_columns, run_units.c.finished_at.desc())
+    )
+    return {
+        (row.provider, row.source, row.account_id, row.region): {
+            "api_calls": row.api_calls,
+            "duration": float(row.duration),
+            "pages": row.pages,
+            "rows": row.rows,
+        }
+        for row in result
+    }
+
+
+async def get_empty_units(conn, period: float) -> Set[UnitKey]:
+    """Return the keys of the units without resources.
+
+    These are the units that loaded no rows each time they completed in the last
+    ``period`` seconds. The units that were not collected in that period, e.g.
+    because of the filters of the runs, are not returned.
+    """
+    if not await _has_history(conn):
+        return set()
+
+    key_columns = [
+        run_units.c.provider,
+        run_units.c.source,
+        run_units.c.account_id,
+        run_units.c.region,
+    ]
+    result = await conn.execute(
+        select(*key_columns)
+        .where(run_units.c.status == COMPLETED)
+        .where(run_units.c.finished_at > func.now() - timedelta(seconds=period))
+        .group_by(*key_columns)
+        # Units completed before their rows were counted are assumed to have some
+        .having(func.max(func.coalesce(run_units.c.rows, 1)) == 0)
+    )
+    return {(row.provider, row.source, row.account_id, row.region) for row in result}
+
+
+class LeaseLostError(Exception):
+    """The lease on a unit was taken over by another worker."""
+
+
+class WorkQueue:
+    """Queue of (account, region, source) units stored in the database.
+
+    The rows loaded by the units are staged in the database, so that an
+    interrupted run can be resumed and its rows published once all the units
+    completed.
+
+    Workers claim units with ``FOR UPDATE SKIP LOCKED`` and hold them with a lease
+    that is extended by heartbeats. Units whose lease expired, e.g. because
+    their worker crashed, are claimed again until they run out of attempts.
+
+    :param engine: Database engine hosting the queue.
+    :param lease_duration: Number of seconds a claimed unit is reserved for.
+    :param max_attempts: Number of times a unit is attempted before it fails.
+    :param poll_interval: Number of seconds to wait for units held by other workers.
+    :param retention: Number of seconds the runs are kept for. Older runs are
+        deleted, with their units and staged rows, when a run is created. The
+        history of the units, used to plan and schedule the next runs, only
+        covers this period.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        lease_duration: int = 60,
+        max_attempts: int = 3,
+        poll_interval: int = 5,
+        retention: int = DEFAULT_RETENTION,
+    ):
+        """Initialize the object."""
+        self.engine = engine
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retention = retention
+
+    def _lease_expiration(self):
+        return func.now() + timedelta(seconds=self.lease_duration)
+
+    async def setup(self) -> None:
+        """Create the queue tables, and their indexes, if they do not exist.
+
+        The columns added to the tables after their creation are added to the
+        existing tables.
+        """
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+            quote = conn.dialect.identifier_preparer.quote
+            for column in _ADDED_COLUMNS:
+                default = column.server_default
+                await conn.execute(
+                    text(
+                        f"ALTER TABLE {quote(column.table.name)} "  # nosec
+                        f"ADD COLUMN IF NOT EXISTS {quote(column.name)} "
+                        f"{column.type.compile(conn.dialect)}"
+                        + (f" DEFAULT {default.arg}" if default is not None else "")
+                        + ("" if column.nullable else " NOT NULL")
+                    )
+                )
+            for index in run_units.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+
+    async def _prune(self, conn) -> None:
+        # The units and staged rows of the runs are deleted in cascade
+        await conn.execute(
+            runs.delete().where(
+                runs.c.started_at < func.now() - timedelta(seconds=self.retention)
+            )
+        )
+
+    async def create_run(self, units: List[dict]) -> str:
+        """Create a run and enqueue its units.
+
+        Units are claimed longest expected first, according to the previous runs.
+
+        :param units: Units with the ``provider``, ``source``, ``account``,
+            ``account_id``, ``region`` and ``service`` keys.
+        """
+        run_id = uuid.uuid4().hex
+        async with self.engine.begin() as conn:
+            await self._prune(conn)
+            history = await get_unit_history(conn)
+            await conn.execute(runs.insert().values(id=run_id, status=RUNNING))
+            if units:
+                await conn.execute(
+                    run_units.insert(),
+                    [
+                        dict(
+                            unit,
+                            expected_duration=history.get(get_unit_key(unit), {}).get(
+                                "duration"
+                            ),
+                            run_id=run_id,
+                            status=PENDING,
+                        )
+                        for unit in units
+                    ],
+                )
+
+        return run_id
+
+    async def create_local_run(self) -> str:
+        """Create a run collected without the queue, whose units are recorded later.
+
+        See :meth:`record_units`.
+        """
+        run_id = uuid.uuid4().hex
+        async with self.engine.begin() as conn:
+            await self._prune(conn)
+            await conn.execute(
+                runs.insert().values(id=run_id, status=RUNNING, distributed=False)
+            )
+
+        return run_id
+
+    async def record_units(self, run_id: str, units: List[dict]) -> None:
+        """Record units of a local run that finished.
+
+        :param units: Units with the ``provider``, ``source``, ``account``,
+            ``account_id``, ``region``, ``service``, ``status``, ``started_at``
+            and ``finished_at`` keys, and optionally ``error`` and the values
+            recorded about the unit, see :meth:`complete`.
+        """
+        if not units:
+            return
+
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                run_units.insert(),
+                [dict(unit, run_id=run_id, attempts=1) for unit in units],
+            )
+
+    async def get_run_status(self, run_id: str) -> Optional[str]:
+        """Return the status of a distributed run, or ``None`` if there is none."""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(runs.c.status)
+                .where(runs.c.id == run_id)
+                .where(runs.c.distributed)
+            )
+            return result.scalar()
+
+    async def resume_run(self, run_id: str) -> None:
+        """Queue the units of a run that did not complete again."""
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(run_units)
+                .where(run_units.c.run_id == run_id)
+                .where(
+                    (run_units.c.status == FAILED)
+                    | (
+                        (run_units.c.status == RUNNING)
+                        & (run_units.c.lease_expires_at < func.now())
+                    )
+                )
+                .values(
+                    attempts=0,
+                    error=None,
+                    finished_at=None,
+                    lease_expires_at=None,
+                    status=PENDING,
+                )
+            )
+            await conn.execute(
+                update(runs)
+                .where(runs.c.id == run_id)
+                .values(status=RUNNING, finished_at=None)
+            )
+
+    async def publish(self, run_id: str, publish: Publisher) -> bool:
+        """Publish the rows staged by a run, unless they already were.
+
+        Return whether the rows were published.
+
+        :param publish: Coroutine function that receives a connection and moves
+            the rows staged by the run into the data source tables using it. It is
+            called in the transaction that marks the run as published, so that an
+            interrupted publication is rolled back as a whole.
+        """
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                select(runs.c.status).where(runs.c.id == run_id).with_for_update()
+            )
+            if result.scalar() == PUBLISHED:
+                return False
+
+            await publish(conn)
+            await conn.execute(
+                update(runs).where(runs.c.id == run_id).values(status=PUBLISHED)
+            )
+
+        return True
+
+    async def get_latest_run_id(self) -> Optional[str]:
+        """Return the ID of the latest run that is still running."""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(runs.c.id)
+                .where(runs.c.status == RUNNING)
+                .where(runs.c.distributed)
+                .order_by(runs.c.started_at.desc())
+                .limit(1)
+            )
+            return result.scalar()
+
+    async def claim(self, run_id: str, worker_id: str) -> Optional[dict]:
+        """Claim the next available unit of a run, if any.
+
+        Units that call the same service, in the same account and region, as
+        a running unit are claimed last, so that they are not throttled
+        together. Otherwise the longest expected units are claimed first.
+        """
+        expired = run_units.c.lease_expires_at < func.now()
+        running = run_units.alias("running")
+        throttled_together = (
+            exists()
+            .where(running.c.run_id == run_units.c.run_id)
+            .where(running.c.status == RUNNING)
+            .where(running.c.account_id == run_units.c.account_id)
+            .where(running.c.region == run_units.c.region)
+            .where(running.c.service == run_units.c.service)
+        )
+        async with self.engine.begin() as conn:
+            # Units abandoned too many times are not retried anymore
+            await conn.execute(
+                update(run_units)
+                .where(run_units.c.run_id == run_id)
+                .where(run_units.c.status == RUNNING)
+                .where(expired)
+                .where(run_units.c.attempts >= self.max_attempts)
+                .values(status=FAILED, finished_at=func.now(), error="Lease expired")
+            )
+
+            claimable = (
+                select(run_units.c.id)
+                .where(run_units.c.run_id == run_id)
+                .where(
+                    (run_units.c.status == PENDING)
+                    | ((run_units.c.status == RUNNING) & expired)
+                )
+                .order_by(
+                    throttled_together,
+                    run_units.c.expected_duration.desc().nullsfirst(),
+                    run_units.c.id,
+                )
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+            result = await conn.execute(
+                update(run_units)
+                .where(run_units.c.id == claimable)
+                .values(
+                    attempts=run_units.c.attempts + 1,
+                    heartbeat_at=func.now(),
+                    lease_expires_at=self._lease_expiration(),
+                    started_at=func.now(),
+                    status=RUNNING,
+                    worker_id=worker_id,
+                )
+                .returning(*run_units.c)
+            )
+            row = result.mappings().first()
+
+        return dict(row) if row else None
+
+    async def heartbeat(self, unit: dict, worker_id: str) -> None:
+        """Extend the lease on a unit."""
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(run_units)
+                .where(run_units.c.id == unit["id"])
+                .where(run_units.c.worker_id == worker_id)
+                .where(run_units.c.status == RUNNING)
+                .values(
+                    heartbeat_at=func.now(), lease_expires_at=self._lease_expiration()
+                )
+            )
+
+    async def complete(
+        self, conn, unit: dict, worker_id: str, metrics: dict = None
+    ) -> None:
+        """Mark a unit as completed.
+
+        This must be called in the transaction that loaded the unit data, so that
+        the data is rolled back if another worker took the unit over.
+
+        :param metrics: Values recorded about the unit, i.e. ``api_calls``,
+            ``pages``, ``rows``, ``throttles`` and ``response_bytes``.
+        """
+        result = await conn.execute(
+            update(run_units)
+            .where(run_units.c.id == unit["id"])
+            .where(run_units.c.worker_id == worker_id)
+            .where(run_units.c.status == RUNNING)
+            .values(
+                status=COMPLETED, finished_at=func.now(), error=None, **(metrics or {})
+            )
+        )
+        if result.rowcount != 1:
+            raise LeaseLostError(f"Lease on unit {unit['id']} was lost")
+
+    async def release(self, unit: dict, worker_id: str, error: Exception) -> None:
+        """Release a unit that failed so that it is retried, if attempts remain."""
+        status = FAILED if unit["attempts"] >= self.max_attempts else PENDING
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(run_units)
+                .where(run_units.c.id == unit["id"])
+                .where(run_units.c.worker_id == worker_id)
+                .where(run_units.c.status == RUNNING)
+                .values(
+                    error=repr(error),
+                    finished_at=func.now() if status == FAILED else None,
+                    lease_expires_at=None,
+                    status=status,
+                )
+            )
+
+    async def count_unfinished(self, run_id: str) -> int:
+        """Return the number of units of a run that are pending or running."""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(func.count())
+                .select_from(run_units)
+                .where(run_units.c.run_id == run_id)
+                .where(run_units.c.status.in_([PENDING, RUNNING]))
+            )
+            return result.scalar()
+
+    async def finish_run(self, run_id: str) -> str:
+        """Record the final status of a run and return it."""
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                select(func.count())
+                .select_from(run_units)
+                .where(run_units.c.run_id == run_id)
+                .where(run_units.c.status == FAILED)
+            )
+            status = FAILED if result.scalar() else COMPLETED
+            await conn.execute(
+                update(runs)
+                .where(runs.c.id == run_id)
+                .where(runs.c.finished_at.is_(None))
+                .values(status=status, finished_at=func.now())
+            )
+
+        return status
+
+    async def get_unit_durations(self, run_id: str) -> Dict[str, float]:
+        """Return the number of seconds each completed unit of a run took, by name."""
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(
+                    run_units.c.source,
+                    run_units.c.account_id,
+                    run_units.c.region,
+                    func.extract(
+                        "epoch", run_units.c.finished_at - run_units.c.started_at
+                    ).label("duration"),
+                )
+                .where(run_units.c.run_id == run_id)
+                .where(run_units.c.status == COMPLETED)
+            )
+            return {
+                get_unit_name(row): float(row["duration"]) for row in result.mappings()
+            }
+
+    async def _process(self, unit: dict, worker_id: str, collect_unit: UnitCollector):
+        async def _keep_alive():
+            while True:
+                await asyncio.sleep(self.lease_duration / 3)
+                await self.heartbeat(unit, worker_id)
+
+        heartbeat = asyncio.create_task(_keep_alive())
+        try:
+            async with self.engine.begin() as conn:
+                try:
+                    metrics = await collect_unit(conn, unit)
+                finally:
+                    # The lease is not extended while the unit is completed or
+                    # released, nor once the unit is processed
+                    heartbeat.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await heartbeat
+                await self.complete(conn, unit, worker_id, metrics)
+        except LeaseLostError as error:
+            logger.warning(str(error))
+        except Exception as error:  # noqa: B902
+            logger.exception(f"Unit {unit['id']} failed")
+            await self.release(unit, worker_id, error)
+
+    async def work(
+        self,
+        run_id: str,
+        worker_id: str,
+        collect_unit: UnitCollector,
+        concurrency: int = 1,
+    ) -> str:
+        """Process the units of a run until none is left, and return the run status.
+
+        :param run_id: ID of the run to process.
+        :param worker_id: ID of the worker.
+        :param collect_unit: Coroutine function that receives a connection
+            and a unit, loads the unit data using the connection and
+            optionally returns metrics to record, see :meth:`complete`.
+        :param concurrency: Number of units to process at the same time.
+        """
+
+        async def _work_loop():
+            while True:
+                unit = await self.claim(run_id, worker_id)
+                if unit is not None:
+                    await self._process(unit, worker_id, collect_unit)
+                elif await self.count_unfinished(run_id):
+                    # Other workers hold the remaining units. Wait in case they crash.
+                    await asyncio.sleep(self.poll_interval)
+                else:
+                    return
+
+        await asyncio.gather(*[_work_loop() for _ in range(concurrency)])
+
+        return await self.finish_run(run_id)
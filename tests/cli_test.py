@@ -0,0 +1,79 @@
+from click.testing import CliRunner
+
+from pantomath import Instruments, cli, loopmonitor, profiling
+from pantomath.provider import Filters
+
+
+class _Pantomath:
+    def __init__(self):
+        self.collected = []
+
+    def collect(self, **kwargs):
+        self.collected.append(kwargs)
+
+
+def test_collect_groups_options(monkeypatch):
+    pantomath = _Pantomath()
+    monkeypatch.setattr(cli, "_get_pantomath", lambda: pantomath)
+
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "collect",
+            "--source",
+            "aws_ec2_*",
+            "--region",
+            "eu-*",
+            "--trace",
+            "trace.json",
+            "--monitor-loop",
+            "0.5",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert pantomath.collected == [
+        {
+            "workers": 1,
+            "distributed": False,
+            "resume": None,
+            "filters": Filters(sources=("aws_ec2_*",), regions=("eu-*",)),
+            "instruments": Instruments(
+                trace_file="trace.json", loop_monitor_threshold=0.5
+            ),
+        }
+    ]
+
+
+def test_collect_rejects_filters_of_distributed_collections():
+    result = CliRunner().invoke(
+        cli.cli, ["collect", "--distributed", "--source", "aws_ec2_*"]
+    )
+
+    assert result.exit_code == 2
+    assert "cannot be used with --distributed" in result.output
+
+
+def test_collect_rejects_profile_on_unsupported_platforms(monkeypatch):
+    monkeypatch.setattr(profiling, "is_supported", lambda: False)
+
+    result = CliRunner().invoke(cli.cli, ["collect", "--profile", "profiles"])
+
+    assert result.exit_code == 2
+    assert "--profile is not supported on this platform" in result.output
+
+
+def test_collect_rejects_monitor_loop_on_unsupported_platforms(monkeypatch):
+    monkeypatch.setattr(loopmonitor, "is_supported", lambda: False)
+
+    result = CliRunner().invoke(cli.cli, ["collect", "--monitor-loop", "0.5"])
+
+    assert result.exit_code == 2
+    assert "not supported on this platform" in result.output
+
+
+def test_collect_rejects_monitor_loop_with_plan():
+    result = CliRunner().invoke(cli.cli, ["collect", "--plan", "--monitor-loop", "0.5"])
+
+    assert result.exit_code == 2
+    assert "--monitor-loop cannot be used with --plan" in result.output
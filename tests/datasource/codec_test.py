@@ -0,0 +1,62 @@
+import datetime
+
+import dateutil.parser
+from sqlalchemy import DateTime, Text
+from sqlalchemy.dialects.postgresql import JSONB
+
+from pantomath.datasource import DataSourceColumn
+from pantomath.datasource.codec import (
+    CodecRegistry,
+    EncodedJson,
+    codecs,
+    parse_timestamp,
+    serialize_to_json,
+)
+
+
+def test_parse_timestamp():
+    for value in [
+        "2021-09-21T12:34:56.789+0000",
+        "2021-09-21T12:34:56.789Z",
+        "2021-09-21T12:34:56+02:00",
+        "2021-09-21T12:34:56.123456789-05:30",
+        "2021-09-21 12:34:56",
+        "Tue, 21 Sep 2021 12:34:56 GMT",
+    ]:
+        assert parse_timestamp(value) == dateutil.parser.parse(value)
+
+
+def test_parse_timestamp_utc():
+    assert parse_timestamp("2021-09-21T12:34:56Z").utcoffset() == datetime.timedelta(0)
+
+
+def test_get_codec():
+    column = DataSourceColumn(description="", hydrate="", name="")
+    assert codecs.get(column) is None
+
+    column = DataSourceColumn(
+        description="",
+        hydrate="",
+        name="",
+        transform=dateutil.parser.parse,
+        type=DateTime(timezone=True),
+    )
+    assert codecs.get(column)(["2021-09-21T12:34:56Z", None]) == [
+        datetime.datetime(2021, 9, 21, 12, 34, 56, tzinfo=datetime.timezone.utc),
+        None,
+    ]
+
+
+def test_json_values_are_encoded_once():
+    column = DataSourceColumn(description="", hydrate="", name="", type=JSONB)
+    (value,) = codecs.get(column)([{"b": 1, "a": 2}])
+    assert isinstance(value, EncodedJson)
+    assert serialize_to_json(value) is value
+    assert serialize_to_json({"b": 1, "a": 2}) == value
+
+
+def test_transform_is_combined_with_type_codec():
+    registry = CodecRegistry()
+    registry.register(Text)(str.upper)
+    column = DataSourceColumn(description="", hydrate="", name="", transform=str.strip)
+    assert registry.get(column)([" a ", None]) == ["A", None]
@@ -0,0 +1,44 @@
+import json
+import logging
+
+import pytest
+from loguru import logger
+
+from pantomath import logs
+
+
+@pytest.fixture(autouse=True)
+def _restore_logging():
+    root_logger = logging.getLogger()
+    handlers, level = list(root_logger.handlers), root_logger.level
+    yield
+    logger.remove()
+    root_logger.handlers[:], root_logger.level = handlers, level
+    logs._sink_options.update(serialize=False, enqueue=False)
+
+
+def test_configure_filters_records_before_they_are_created():
+    logs.configure(logging.ERROR)
+    logs.configure(logging.ERROR)
+
+    assert not logging.getLogger("aiobotocore.endpoint").isEnabledFor(logging.DEBUG)
+    handlers = [
+        handler
+        for handler in logging.getLogger().handlers
+        if isinstance(handler, logs._InterceptHandler)
+    ]
+    assert len(handlers) == 1
+
+
+def test_configure_serialize(capsys):
+    logs.configure(logging.WARNING, serialize=True)
+
+    logging.getLogger("botocore.retries").warning("Throttled %s", "ec2")
+    logging.getLogger("botocore.retries").info("Retried")
+
+    lines = capsys.readouterr().err.splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])["record"]
+    assert record["message"] == "Throttled ec2"
+    assert record["level"]["name"] == "WARNING"
+    assert logs.get_sink_options() == {"serialize": True, "enqueue": False}
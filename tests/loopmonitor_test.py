@@ -0,0 +1,36 @@
+import asyncio
+import contextlib
+import sys
+import time
+from contextvars import ContextVar
+
+import pytest
+
+from pantomath import loopmonitor
+
+_source_name: ContextVar = ContextVar("source_name", default=None)
+loopmonitor.add_source_variable(_source_name)
+
+
+@loopmonitor.stage("transform")
+def _transform():
+    time.sleep(0.3)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Thread signals are not available")
+def test_blocking_callback_reported():
+    monitor = loopmonitor.LoopMonitor(threshold=0.1, interval=0.01)
+
+    async def _collect():
+        task = asyncio.ensure_future(monitor.run())
+        await asyncio.sleep(0.05)
+        _source_name.set("aws_ec2_instances")
+        _transform()
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_collect())
+    assert list(monitor.blocked) == [("aws_ec2_instances", "transform")]
+    assert monitor.blocked[("aws_ec2_instances", "transform")] >= 0.25
@@ -0,0 +1,55 @@
+import pytest
+
+from pantomath.metrics import MetricsRegistry
+
+
+def test_render_prometheus():
+    registry = MetricsRegistry()
+    calls = registry.counter("calls_total", "Number of calls.", ("service",))
+    duration = registry.histogram("duration_seconds", "Duration.", buckets=(1, 5))
+    calls.inc(service="ec2")
+    calls.inc(2, service="ec2")
+    duration.observe(0.5)
+    duration.observe(3)
+
+    assert registry.render_prometheus() == (
+        "# HELP calls_total Number of calls.\n"
+        "# TYPE calls_total counter\n"
+        'calls_total{service="ec2"} 3.0\n'
+        "# HELP duration_seconds Duration.\n"
+        "# TYPE duration_seconds histogram\n"
+        'duration_seconds_bucket{le="1.0"} 1.0\n'
+        'duration_seconds_bucket{le="5.0"} 2.0\n'
+        'duration_seconds_bucket{le="+Inf"} 2.0\n'
+        "duration_seconds_count 2.0\n"
+        "duration_seconds_sum 3.5\n"
+    )
+
+
+def test_merge():
+    registry = MetricsRegistry()
+    calls = registry.counter("calls_total", "Number of calls.", ("service",))
+    calls.inc(service="ec2")
+    snapshot = registry.snapshot()
+    registry.merge(snapshot)
+
+    assert registry.summarize() == {
+        "calls_total": {
+            "description": "Number of calls.",
+            "type": "counter",
+            "values": [{"labels": {"service": "ec2"}, "value": 2}],
+        }
+    }
+
+
+def test_register_again():
+    registry = MetricsRegistry()
+    duration = registry.histogram("duration_seconds", "Duration.", ("service",))
+
+    assert registry.histogram("duration_seconds", "Duration.", ("service",)) is (
+        duration
+    )
+    with pytest.raises(ValueError, match="already registered"):
+        registry.histogram("duration_seconds", "Duration.", ("operation",))
+    with pytest.raises(ValueError, match="already registered"):
+        registry.counter("duration_seconds", "Duration.", ("service",))
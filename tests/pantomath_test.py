@@ -0,0 +1,79 @@
+import asyncio
+
+import click
+import pytest
+from loguru import logger
+
+from pantomath import Pantomath
+from pantomath.provider import providers
+
+
+class _Provider:
+    """Provider recording its collection, in the order of the events of a test."""
+
+    events: list = []
+    started: dict = {}
+
+    def __init__(self, loads, **kwargs):
+        self.loads = loads
+        # The providers are created in the event loop of the collection
+        self.started[self.type] = asyncio.Event()
+
+    async def collect(self):
+        self.events.append(f"{self.type} started")
+        self.started[self.type].set()
+
+
+class _FailingProvider(_Provider):
+    async def collect(self):
+        await super().collect()
+        # Both providers are collected at the same time
+        await self.started["working"].wait()
+        raise RuntimeError("Failing provider")
+
+
+class _WorkingProvider(_Provider):
+    async def collect(self):
+        await super().collect()
+        await self.started["failing"].wait()
+        # The provider is not cancelled when the other one fails
+        await asyncio.sleep(0.05)
+        self.events.append(f"{self.type} collected")
+
+
+def test_providers_are_collected_concurrently(monkeypatch):
+    monkeypatch.setattr(providers, "_cached_items", {})
+    for name, cls in (("failing", _FailingProvider), ("working", _WorkingProvider)):
+        monkeypatch.setitem(providers._factories, name, cls)
+        monkeypatch.setattr(cls, "type", name, raising=False)
+    monkeypatch.setattr(_Provider, "events", [])
+    monkeypatch.setattr(_Provider, "started", {})
+    monkeypatch.setattr(
+        Pantomath,
+        "_load_configuration",
+        lambda self, config_path: {
+            "db": {
+                "host": "localhost",
+                "name": "pantomath",
+                "password": "",
+                "port": 5432,
+                "user": "pantomath",
+            },
+            "metrics": None,
+            "providers": {"failing": {}, "working": {}},
+        },
+    )
+    messages: list = []
+    handler_id = logger.add(messages.append, level="ERROR")
+
+    try:
+        with pytest.raises(click.ClickException, match="providers: failing$"):
+            Pantomath("pantomath.yaml").collect()
+    finally:
+        logger.remove(handler_id)
+
+    assert sorted(_Provider.events[:2]) == ["failing started", "working started"]
+    assert _Provider.events[2:] == ["working collected"]
+    assert providers.get("failing").loads is providers.get("working").loads
+    assert len(messages) == 1
+    assert "Provider failing failed" in messages[0]
@@ -0,0 +1,55 @@
+import asyncio
+import asyncio.events
+import signal
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from pantomath import profiling
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="CPU time interval timers are not available"
+)
+
+
+def test_profile_source(tmp_path):
+    async def _collect():
+        async with profiling.profile_source("aws_ec2_instances"):
+            instances = [{"InstanceId": f"i-{index}"} for index in range(50_000)]
+        assert instances
+
+    profiling.start_profiling()
+    try:
+        asyncio.run(_collect())
+    finally:
+        profiler = profiling.stop_profiling()
+    profiler.write(str(tmp_path))
+
+    assert profiler.sources["aws_ec2_instances"]["peak"] > 5 * 2**20
+    summary = (tmp_path / "summary.txt").read_text()
+    assert "aws_ec2_instances: " in summary
+    assert "profiling_test.py" in summary
+    for line in (tmp_path / "cpu.folded").read_text().splitlines():
+        assert line.startswith(("aws_ec2_instances;", "(other);"))
+
+
+def test_not_profiling():
+    async def _collect():
+        async with profiling.profile_source("aws_ec2_instances"):
+            pass
+
+    asyncio.run(_collect())
+    assert not profiling.is_profiling()
+
+
+def test_sample_in_event_loop():
+    frame = SimpleNamespace(
+        f_back=None,
+        f_code=SimpleNamespace(co_filename=asyncio.events.__file__, co_name="_run"),
+        f_globals={"__name__": "asyncio.events"},
+    )
+    profiler = profiling.Profiler()
+    profiler._sample(signal.SIGPROF, frame)
+
+    assert dict(profiler.samples) == {"(other);asyncio.events:_run": 1}
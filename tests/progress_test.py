@@ -0,0 +1,22 @@
+from pantomath.metrics import MetricsRegistry
+from pantomath.progress import ProgressReporter
+
+
+def test_summarize():
+    registry = MetricsRegistry()
+    units = registry.gauge("pantomath_units_planned", "", ("source", "account_id"))
+    extracted = registry.counter(
+        "pantomath_units_extracted_total", "", ("source", "account_id")
+    )
+    api_calls = registry.counter("pantomath_api_calls_total", "", ("service",))
+    throttles = registry.counter("pantomath_api_throttles_total", "", ("service",))
+    reporter = ProgressReporter(registry=registry)
+    units.inc(2, source="aws_ec2_instances", account_id="111111111111")
+    extracted.inc(source="aws_ec2_instances", account_id="111111111111")
+    api_calls.inc(4, service="ec2")
+    throttles.inc(service="ec2")
+
+    summary = reporter.summarize(reporter._measure())
+    assert "1/2 units extracted" in summary
+    assert "(25.0% throttled)" in summary
+    assert "no DB writes" in summary
@@ -0,0 +1,1007 @@
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import aiobotocore.session
+import aiostream
+import botocore.exceptions
+import jmespath
+import pytest
+from botocore.config import Config
+from botocore.stub import Stubber
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, text
+
+from pantomath import workqueue
+from pantomath.db import create_engine
+from pantomath.provider import Filters, aws, to_sqlalchemy
+from pantomath.provider.aws import (
+    AwsDataSource,
+    AWSProvider,
+    AwsResourceBatch,
+    DeadlineExceededError,
+    _assume_iam_role,
+    _call_botocore_method,
+    _first_success,
+    _get_source_durations,
+    _hedge,
+    _placeholder_fields,
+    _PooledSession,
+    _project,
+    _referenced_fields,
+    data_sources,
+)
+from pantomath.workqueue import WorkQueue
+
+
+@pytest.mark.parametrize(
+    "expression, fields",
+    [
+        ("InstanceId", {"InstanceId"}),
+        ("@.Name", {"Name"}),
+        ("Placement.AvailabilityZone", {"Placement"}),
+        ("Tags[0]", {"Tags"}),
+        ("Tags[*].Key", {"Tags"}),
+        ("Reservations[].Instances[]", {"Reservations"}),
+        ("BlockDeviceMappings[?DeviceName == 'xvda'].Ebs", {"BlockDeviceMappings"}),
+        ("Tags[?Key == 'Name'] | [0].Value", {"Tags"}),
+        ("length(SecurityGroups)", {"SecurityGroups"}),
+        ("join(',', [Name, Engine])", {"Engine", "Name"}),
+        ("{id: Id, size: Size}", {"Id", "Size"}),
+        ("State.Name == 'running' && Monitoring.State", {"Monitoring", "State"}),
+        ("Name || Id", {"Id", "Name"}),
+        ("!Encrypted", {"Encrypted"}),
+        ("`true`", set()),
+    ],
+)
+def test_referenced_fields(expression, fields):
+    assert _referenced_fields(jmespath.compile(expression).parsed) == fields
+
+
+@pytest.mark.parametrize(
+    "expression", ["@", "*", "[?Size > `1`]", "to_string(@)", "sort_by(Tags, &Key)"]
+)
+def test_referenced_fields_whole_item(expression):
+    assert _referenced_fields(jmespath.compile(expression).parsed) is None
+
+
+def test_placeholder_fields():
+    parameters = {"Resource": "{FunctionArn}", "Filters": ["{Config.Name}"], "Max": 1}
+    assert _placeholder_fields(parameters) == {"Config", "FunctionArn"}
+    assert _placeholder_fields("{") is None
+
+
+def test_project():
+    items = [{"Id": "a", "Size": 1, "Unused": "x"}, "not a dict"]
+    assert _project(items, frozenset({"Id", "Size"})) == [
+        {"Id": "a", "Size": 1},
+        "not a dict",
+    ]
+
+
+def test_projection_keeps_the_rows():
+    data_source = data_sources.get("aws_ebs_snapshots")
+    item = {
+        "Description": "Backup",
+        "Encrypted": True,
+        "OwnerId": "123456789012",
+        "Progress": "100%",
+        "SnapshotId": "snap-1",
+        "StartTime": datetime.datetime(2021, 9, 21, tzinfo=datetime.timezone.utc),
+        "State": "completed",
+        "Tags": [{"Key": "Name", "Value": "backup"}],
+        "VolumeId": "vol-1",
+        "VolumeSize": 8,
+    }
+
+    def _transform(items):
+        batch = AwsResourceBatch("123456789012", "eu-west-1", None, items)
+        return data_source.transform(batch)
+
+    assert "OwnerId" not in data_source.fields
+    assert _transform(_project([item], data_source.fields)) == _transform([item])
+
+
+class _Client:
+    """Client whose ``list_tags`` calls take a while, counting the concurrent ones."""
+
+    def __init__(self, delay: float = 0.01):
+        self.meta = SimpleNamespace(
+            events=SimpleNamespace(register=lambda *args, **kwargs: None)
+        )
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+
+    def can_paginate(self, method_name):
+        return False
+
+    async def list_tags(self, **kwargs):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return {"Tags": {"Name": kwargs["Resource"]}}
+
+
+class _Session:
+    def __init__(self, client):
+        self.client = client
+
+    @contextlib.asynccontextmanager
+    async def create_client(self, service_name, region_name=None, config=None):
+        yield self.client
+
+
+class _Connection:
+    def __init__(self):
+        self.rows = []
+        self.chunks = []
+
+    async def run_sync(self, method, *args, **kwargs):
+        # The tables never exist
+        return False
+
+    async def execute(self, statement, rows):
+        self.rows.extend(rows)
+        self.chunks.append(len(rows))
+
+
+async def _get_no_session(self, account_config):
+    return None
+
+
+def _collect(monkeypatch, name, batches, **settings):
+    """Collect batches of items of a data source, returning the connection used."""
+    conn = _Connection()
+
+    @contextlib.asynccontextmanager
+    async def _begin():
+        yield conn
+
+    async def _get_unit_history(conn):
+        return {}
+
+    monkeypatch.setattr(AWSProvider, "_get_session", _get_no_session)
+    # A single unit, whose pages are the batches
+    monkeypatch.setattr(
+        data_sources.get(name),
+        "extract_region",
+        lambda session, account_id, region: aiostream.stream.iterate(batches),
+    )
+    monkeypatch.setattr(aws, "get_unit_history", _get_unit_history)
+
+    async def _test():
+        provider = AWSProvider(
+            config={
+                "settings": dict(
+                    settings,
+                    accounts=[],
+                    call_deadline=None,
+                    rate_limit_store=None,
+                    unit_deadline=None,
+                ),
+                "sources": [name],
+            },
+            db_engine=SimpleNamespace(begin=_begin, connect=_begin),
+        )
+        unit = {
+            "account": {"assume_role": None, "profile": None},
+            "account_id": "000000000000",
+            "region": "eu-west-1",
+            "source": name,
+        }
+        await provider._collect_data_sources([unit])
+        return conn
+
+    return asyncio.run(_test())
+
+
+def test_batches_are_loaded_in_chunks():
+    table = Table("items", MetaData(), Column("id", Integer))
+    conn = _Connection()
+    batches = [
+        [{"id": index} for index in range(start, stop)]
+        for start, stop in [(0, 3), (3, 5), (5, 6), (6, 7)]
+    ]
+
+    async def _load():
+        loaded = aiostream.stream.iterate(batches) | to_sqlalchemy(
+            conn, table, chunk_size=2
+        )
+        return await aiostream.stream.list(loaded)
+
+    chunks = asyncio.run(_load())
+
+    # The chunks span the batches, and the remainder is loaded last
+    assert [[row["id"] for row in chunk] for chunk in chunks] == [
+        [0, 1],
+        [2, 3],
+        [4, 5],
+        [6],
+    ]
+    assert conn.chunks == [2, 2, 2, 1]
+
+
+def test_enrichment_concurrency_is_bounded(monkeypatch):
+    client = _Client()
+    session = _Session(client)
+    batches = [
+        AwsResourceBatch(
+            "123456789012",
+            "eu-west-1",
+            session,
+            [{"FunctionArn": f"arn-{page}-{index}"} for index in range(20)],
+        )
+        for page in range(3)
+    ]
+
+    conn = _collect(monkeypatch, "aws_lambda_functions", batches, enrich_concurrency=4)
+
+    assert client.max_running == 4
+    assert len(conn.rows) == 60
+    assert all(json.loads(row["tags"]) == {"Name": row["arn"]} for row in conn.rows)
+
+
+def test_sources_without_enrichers_are_not_enriched(monkeypatch):
+    data_source = data_sources.get("aws_ebs_snapshots")
+
+    async def _enrich(batch, slots):
+        raise AssertionError("The batch was enriched")
+
+    monkeypatch.setattr(data_source, "enrich", _enrich)
+    batches = [
+        AwsResourceBatch(
+            "123456789012", "eu-west-1", None, [{"SnapshotId": f"snap-{page}"}]
+        )
+        for page in range(2)
+    ]
+
+    conn = _collect(monkeypatch, "aws_ebs_snapshots", batches, enrich_concurrency=None)
+
+    assert not data_source.enrich_config
+    assert [row["snapshot_id"] for row in conn.rows] == ["snap-0", "snap-1"]
+
+
+async def _stub_bucket_tagging_error(error_code):
+    session = aiobotocore.session.AioSession()
+    session.set_credentials("access-key", "secret-key")
+    async with session.create_client("s3", region_name="eu-west-1") as client:
+        with Stubber(client) as stubber:
+            stubber.add_client_error(
+                "get_bucket_tagging", service_error_code=error_code
+            )
+            return [
+                page
+                async for page in _call_botocore_method(
+                    session=_Session(client),
+                    region_name="eu-west-1",
+                    service_name="s3",
+                    method_name="get_bucket_tagging",
+                    results_filter="TagSet",
+                    method_parameters={"Bucket": "bucket"},
+                    expected_errors=["NoSuchTagSet"],
+                )
+            ]
+
+
+def test_expected_errors_yield_an_empty_item():
+    assert asyncio.run(_stub_bucket_tagging_error("NoSuchTagSet")) == [[{}]]
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        asyncio.run(_stub_bucket_tagging_error("AccessDenied"))
+
+
+def _history(*durations):
+    return {
+        ("aws", source, f"{index:012}", "eu-west-1"): {"duration": duration}
+        for index, (source, duration) in enumerate(durations)
+    }
+
+
+def _history_units(history):
+    return [
+        {"source": source, "account_id": account_id, "region": region}
+        for _, source, account_id, region in history
+    ]
+
+
+def test_source_durations_are_their_longest_unit():
+    history = _history(
+        ("aws_ec2_instances", 10.0),
+        ("aws_ec2_instances", 12.0),
+        ("aws_s3_buckets", 20.0),
+    )
+    units = _history_units(history) + [
+        {"source": "aws_ebs_volumes", "account_id": "1", "region": "eu-west-1"}
+    ]
+    # Only the units being collected are costed
+    history[("aws", "aws_rds_instances", "1", "eu-west-1")] = {"duration": 30.0}
+    assert _get_source_durations("aws", units, history) == {
+        "aws_ec2_instances": 12.0,
+        "aws_s3_buckets": 20.0,
+    }
+
+
+def test_source_durations_drive_the_schedule(monkeypatch):
+    # The EC2 units take longer in total, but not each
+    history = _history(
+        ("aws_ec2_instances", 10.0),
+        ("aws_ec2_instances", 10.0),
+        ("aws_ec2_instances", 10.0),
+        ("aws_s3_buckets", 20.0),
+    )
+
+    async def _get_unit_history(conn):
+        return history
+
+    @contextlib.asynccontextmanager
+    async def _connect():
+        yield None
+
+    async def _get_scheduler():
+        provider = AWSProvider(
+            config={"settings": {"rate_limit_store": None}, "sources": []},
+            db_engine=SimpleNamespace(connect=_connect),
+        )
+        units = _history_units(history)
+        return await provider._get_scheduler(
+            {"aws_ec2_instances": units[:3], "aws_s3_buckets": units[3:]}
+        )
+
+    monkeypatch.setattr(aws, "get_unit_history", _get_unit_history)
+    scheduler = asyncio.run(_get_scheduler())
+
+    assert [scheduler.dispatch(), scheduler.dispatch()] == [
+        "aws_s3_buckets",
+        "aws_ec2_instances",
+    ]
+
+
+class _RegionsSession:
+    """Session of an account, in which every service is available in two regions."""
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    @staticmethod
+    async def create(provider, account_config):
+        return _RegionsSession(account_config.profile)
+
+    @staticmethod
+    async def get_account_id(session):
+        return {"history": "000000000001", "new": "000000000002"}[session.profile]
+
+    async def get_available_regions(self, service_name, partition_name=None):
+        return ["eu-west-1", "us-east-1"]
+
+
+def test_estimate_from_the_unit_history(monkeypatch):
+    # The lambda functions are enriched with a ListTags call by row
+    history = {
+        ("aws", "aws_ebs_volumes", "000000000001", "eu-west-1"): {
+            "duration": 10.0,
+            "pages": 3,
+            "rows": 50,
+        },
+        ("aws", "aws_lambda_functions", "000000000001", "eu-west-1"): {
+            "duration": 4.0,
+            "pages": 1,
+            "rows": 20,
+        },
+    }
+
+    async def _get_unit_history(conn):
+        return history
+
+    @contextlib.asynccontextmanager
+    async def _connect():
+        yield None
+
+    monkeypatch.setattr(aws, "get_unit_history", _get_unit_history)
+    monkeypatch.setattr(aws, "_get_account_id", _RegionsSession.get_account_id)
+    monkeypatch.setattr(AWSProvider, "_get_session", _RegionsSession.create)
+
+    async def _estimate():
+        provider = AWSProvider(
+            config={
+                "settings": {
+                    "accounts": [
+                        SimpleNamespace(profile=profile, assume_role=None, regions=None)
+                        for profile in ("history", "new")
+                    ],
+                    "empty_region_probe_interval": 0,
+                    "plan_concurrency": None,
+                    "rate_limit_store": None,
+                },
+                "sources": ["aws_ebs_volumes", "aws_lambda_functions"],
+            },
+            db_engine=SimpleNamespace(connect=_connect),
+        )
+        return await provider.estimate()
+
+    estimate = asyncio.run(_estimate())
+
+    # The account never collected falls back to the regions available to it
+    assert sorted(
+        (unit["account_id"], unit["region"], unit["source"]) for unit in estimate.units
+    ) == [
+        ("000000000001", "eu-west-1", "aws_ebs_volumes"),
+        ("000000000001", "eu-west-1", "aws_lambda_functions"),
+        ("000000000002", "eu-west-1", "aws_ebs_volumes"),
+        ("000000000002", "eu-west-1", "aws_lambda_functions"),
+        ("000000000002", "us-east-1", "aws_ebs_volumes"),
+        ("000000000002", "us-east-1", "aws_lambda_functions"),
+    ]
+    assert estimate.unknown_units == 4
+    # A page is expected for each unit never collected
+    assert estimate.api_calls == {"ec2": 3 + 2, "lambda": 1 + 20 + 2}
+    assert estimate.duration == 10.0
+    assert "us-east-1" in estimate.skipped_regions["000000000001"]
+    assert "us-east-1" not in estimate.skipped_regions["000000000002"]
+
+
+class _ClientFactory:
+    """Session creating clients that record their settings, counting the closed ones."""
+
+    def __init__(self):
+        self.created = []
+        self.closed = 0
+
+    @contextlib.asynccontextmanager
+    async def create_client(
+        self, service_name, region_name=None, config=None, endpoint_url=None
+    ):
+        client = SimpleNamespace(
+            service_name=service_name,
+            region_name=region_name,
+            config=config,
+            endpoint_url=endpoint_url,
+        )
+        self.created.append(client)
+        try:
+            yield client
+        finally:
+            self.closed += 1
+
+
+def test_pooled_session_reuses_clients():
+    config = Config(retries={"max_attempts": 1})
+    keys = [
+        ("ec2", "eu-west-1", None),
+        ("ec2", "eu-west-1", None),
+        ("ec2", "us-east-1", None),
+        ("s3", "eu-west-1", None),
+        ("ec2", "eu-west-1", config),
+        ("ec2", "eu-west-1", config),
+    ]
+
+    async def _test():
+        factory = _ClientFactory()
+        session = _PooledSession(factory, "http://localhost:4566")
+        clients = []
+        for service_name, region_name, client_config in keys:
+            async with session.create_client(
+                service_name, region_name=region_name, config=client_config
+            ) as client:
+                clients.append(client)
+
+        # One client for each (service, region, config), kept open between uses
+        assert clients[0] is clients[1]
+        assert clients[4] is clients[5]
+        assert len(factory.created) == 4
+        assert all(
+            client.endpoint_url == "http://localhost:4566" for client in factory.created
+        )
+        assert factory.closed == 0
+
+        await session.close()
+        assert factory.closed == 4
+
+    asyncio.run(_test())
+
+
+class _StsClient:
+    """Client returning new credentials at each role assumption."""
+
+    def __init__(self, lifetime: datetime.timedelta):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    async def assume_role(self, **kwargs):
+        self.calls += 1
+        return {
+            "Credentials": {
+                "AccessKeyId": f"key-{self.calls}",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": datetime.datetime.now(datetime.timezone.utc)
+                + self.lifetime,
+            }
+        }
+
+
+@pytest.mark.parametrize(
+    "lifetime, access_keys",
+    [
+        (datetime.timedelta(hours=1), ["key-1", "key-1"]),
+        # Credentials about to expire are refreshed before they are used
+        (datetime.timedelta(minutes=5), ["key-1", "key-2"]),
+    ],
+)
+def test_assumed_role_credentials_are_refreshed(lifetime, access_keys):
+    async def _get_access_keys():
+        session = await _assume_iam_role(
+            "arn:aws:iam::123456789012:role/Pantomath", _Session(_StsClient(lifetime))
+        )
+        credentials = await session.get_credentials()
+        return [
+            (await credentials.get_frozen_credentials()).access_key for _ in range(2)
+        ]
+
+    assert asyncio.run(_get_access_keys()) == access_keys
+
+
+async def _respond(result, delay: float):
+    await asyncio.sleep(delay)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def test_first_success_wins_and_cancels_the_others():
+    async def _test():
+        slow = asyncio.ensure_future(_respond("slow", 10))
+        failed = asyncio.ensure_future(_respond(ValueError("failed"), 0))
+        fast = asyncio.ensure_future(_respond("fast", 0.01))
+        assert await _first_success([slow, failed, fast]) == "fast"
+        await asyncio.sleep(0)
+        assert slow.cancelled()
+
+    asyncio.run(_test())
+
+
+def test_first_success_raises_the_first_error():
+    async def _test():
+        calls = [
+            asyncio.ensure_future(_respond(ValueError("second"), 0.02)),
+            asyncio.ensure_future(_respond(ValueError("first"), 0.01)),
+        ]
+        with pytest.raises(ValueError, match="first"):
+            await _first_success(calls)
+
+    asyncio.run(_test())
+
+
+class _HedgedMethods:
+    """Methods of new clients that respond at once, recording when they are created."""
+
+    def __init__(self):
+        self.created_at = []
+
+    @contextlib.asynccontextmanager
+    async def create_method(self):
+        self.created_at.append(asyncio.get_running_loop().time())
+
+        async def describe_volumes(**kwargs):
+            return "hedged"
+
+        yield describe_volumes
+
+
+@pytest.mark.parametrize(
+    "delay, result, hedged", [(0.2, "hedged", True), (0.01, "original", False)]
+)
+def test_hedge_after_the_deadline(delay, result, hedged):
+    async def describe_volumes(**kwargs):
+        return await _respond("original", delay)
+
+    async def _test():
+        methods = _HedgedMethods()
+        method = _hedge(describe_volumes, methods.create_method, 0.05, "ec2")
+        started_at = asyncio.get_running_loop().time()
+        assert await method(MaxResults=10) == result
+        assert len(methods.created_at) == hedged
+        assert all(time - started_at >= 0.05 for time in methods.created_at)
+
+    asyncio.run(_test())
+
+
+def _extractor(closed):
+    """Return an extraction yielding a batch, then another one after a while."""
+
+    async def _extract_region(session, account_id, region):
+        try:
+            yield "batch"
+            await asyncio.sleep(10)
+            yield "late batch"
+        finally:
+            closed.append(region)
+
+    return SimpleNamespace(extract_region=_extract_region)
+
+
+def _get_unit_extractor(monkeypatch, unit_deadline):
+    monkeypatch.setattr(AWSProvider, "_get_session", _get_no_session)
+    provider = AWSProvider(
+        config={
+            "settings": {"rate_limit_store": None, "unit_deadline": unit_deadline},
+            "sources": [],
+        },
+    )
+    unit = {
+        "account": {"profile": "default"},
+        "account_id": "123456789012",
+        "region": "eu-west-1",
+        "source": "aws_ebs_volumes",
+    }
+    return lambda closed: provider._extract_unit(_extractor(closed), unit)
+
+
+def test_unit_deadline_closes_the_extraction(monkeypatch):
+    async def _test():
+        closed: list = []
+        batches = []
+        extract_unit = _get_unit_extractor(monkeypatch, 0.05)
+        with pytest.raises(DeadlineExceededError):
+            async for batch in extract_unit(closed):
+                batches.append(batch)
+
+        assert batches == ["batch"]
+        assert closed == ["eu-west-1"]
+
+    asyncio.run(_test())
+
+
+def test_unit_no_longer_consumed_closes_the_extraction(monkeypatch):
+    async def _test():
+        closed: list = []
+        batches = _get_unit_extractor(monkeypatch, None)(closed)
+        assert await batches.__anext__() == "batch"
+        await batches.aclose()
+        assert closed == ["eu-west-1"]
+
+    asyncio.run(_test())
+
+
+class _ClientSession(_Session):
+    """Session returning a client, and delegating the rest to a real session."""
+
+    def __init__(self, session, client):
+        super().__init__(client)
+        self.session = session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+async def _stub_volume_pages(session, calls, **kwargs):
+    """Return the pages of two stubbed volumes, waiting for the rate limits first."""
+
+    async def _rate_limit(account_id, region_name, service_name):
+        calls.append(service_name)
+
+    async with session.create_client("ec2", region_name="eu-west-1") as client:
+        with Stubber(client) as stubber:
+            stubber.add_response(
+                "describe_volumes",
+                {"Volumes": [{"VolumeId": "vol-1"}], "NextToken": "token"},
+                {},
+            )
+            stubber.add_response(
+                "describe_volumes",
+                {"Volumes": [{"VolumeId": "vol-2"}]},
+                {"NextToken": "token"},
+            )
+            token = aws._rate_limit.set(_rate_limit)
+            try:
+                return [
+                    page
+                    async for page in _call_botocore_method(
+                        session=_ClientSession(session, client),
+                        region_name="eu-west-1",
+                        service_name="ec2",
+                        method_name="describe_volumes",
+                        results_filter="Volumes[].VolumeId",
+                        **kwargs,
+                    )
+                ]
+            finally:
+                aws._rate_limit.reset(token)
+
+
+def _get_session():
+    session = aiobotocore.session.AioSession()
+    session.set_credentials("access-key", "secret-key")
+    return session
+
+
+def test_pages_are_requested_with_the_wrapped_method():
+    calls: list = []
+    pages = asyncio.run(_stub_volume_pages(_get_session(), calls))
+
+    assert pages == [["vol-1"], ["vol-2"]]
+    # Each page waited for the rate limits
+    assert calls == ["ec2", "ec2"]
+
+
+def test_hedged_calls_are_measured_and_rate_limited(monkeypatch):
+    def _hedge_at_once(method, create_method, deadline, description):
+        async def _hedged_method(**kwargs):
+            async with create_method() as hedged_method:
+                return await hedged_method(**kwargs)
+
+        return _hedged_method
+
+    monkeypatch.setattr(aws, "_hedge", _hedge_at_once)
+    labels = ("ec2", "describe_volumes")
+    api_calls = aws._API_CALLS.snapshot().get(labels, 0)
+    calls: list = []
+
+    async def _test():
+        token = aws._call_deadline.set(1)
+        try:
+            return await _stub_volume_pages(_get_session(), calls)
+        finally:
+            aws._call_deadline.reset(token)
+
+    assert asyncio.run(_test()) == [["vol-1"], ["vol-2"]]
+    assert aws._API_CALLS.snapshot()[labels] == api_calls + 2
+    # Each page waited for the rate limits before it was late, and when hedged
+    assert calls == ["ec2"] * 4
+
+
+DSN = os.environ.get("PANTOMATH_TEST_DB_DSN")
+
+_requires_db = pytest.mark.skipif(
+    DSN is None, reason="PANTOMATH_TEST_DB_DSN is not set to a test database"
+)
+
+_SOURCES = ("aws_ebs_snapshots", "aws_ebs_volumes")
+
+
+def _run_with_db(test):
+    """Run a test coroutine function with an engine, in empty tables."""
+
+    async def _main():
+        engine = create_engine(DSN)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(workqueue.metadata.drop_all)
+                for name in _SOURCES:
+                    table = data_sources.get(name).execution_plan.table
+                    await conn.run_sync(table.drop, checkfirst=True)
+            await WorkQueue(engine).setup()
+            return await test(engine)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(_main())
+
+
+def _get_provider(engine, **kwargs):
+    return AWSProvider(
+        config={
+            "settings": {
+                "accounts": [],
+                "call_deadline": None,
+                "enrich_concurrency": None,
+                "rate_limit_store": None,
+                "unit_deadline": None,
+            },
+            "sources": list(_SOURCES),
+        },
+        db_engine=engine,
+        **kwargs,
+    )
+
+
+def _get_units(account_ids, regions):
+    return [
+        {
+            "account": {"assume_role": None, "profile": None},
+            "account_id": account_id,
+            "region": region,
+            "service": "ec2",
+            "source": source,
+        }
+        for source in _SOURCES
+        for account_id in account_ids
+        for region in regions
+    ]
+
+
+def _extract_resources(monkeypatch, generation, failures=None):
+    """Make the EBS data sources extract a resource by unit, of a generation.
+
+    :param failures: Errors raised by the extraction of some units, by data
+        source and account ID.
+    """
+
+    monkeypatch.setattr(AWSProvider, "_get_session", _get_no_session)
+    for name, item in (
+        ("aws_ebs_snapshots", {"Description": f"generation {generation}"}),
+        ("aws_ebs_volumes", {"Size": generation, "State": "available"}),
+    ):
+
+        def _extract_region(session, account_id, region, name=name, item=item):
+            async def _extract():
+                error = (failures or {}).get((name, account_id))
+                if error is not None:
+                    raise error
+
+                resource_id = f"{account_id}/{region}"
+                yield AwsResourceBatch(
+                    account_id,
+                    region,
+                    session,
+                    [dict(item, SnapshotId=resource_id, VolumeId=resource_id)],
+                )
+
+            return _extract()
+
+        monkeypatch.setattr(data_sources.get(name), "extract_region", _extract_region)
+
+
+async def _get_rows(engine) -> dict:
+    rows = {}
+    async with engine.connect() as conn:
+        for name in _SOURCES:
+            result = await conn.execute(
+                text(f"SELECT * FROM {name} ORDER BY account_id, region")
+            )
+            rows[name] = [dict(row) for row in result.mappings()]
+
+    return rows
+
+
+async def _get_table_names(engine) -> set:
+    async with engine.connect() as conn:
+        return set(
+            await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names())
+        )
+
+
+def _run_in_threads(max_workers, mp_context, initializer):
+    """Replace the worker processes with threads, which see the patches of a test."""
+    return ThreadPoolExecutor(max_workers)
+
+
+@_requires_db
+def test_collect_in_processes_loads_the_rows_of_a_single_process(monkeypatch):
+    monkeypatch.setattr(aws, "ProcessPoolExecutor", _run_in_threads)
+    _extract_resources(monkeypatch, 1)
+    units = _get_units(["000000000001", "000000000002", "000000000003"], ["eu-west-1"])
+
+    async def _test(engine):
+        queue = WorkQueue(engine)
+        provider = _get_provider(engine, workers=2)
+        await provider._collect_data_sources(units, await queue.create_local_run())
+        rows = await _get_rows(engine)
+
+        tables = await _get_table_names(engine)
+        await provider._collect_in_processes(units, await queue.create_local_run())
+        assert await _get_rows(engine) == rows
+        # The staging tables are dropped once published
+        assert await _get_table_names(engine) == tables
+
+        return rows
+
+    rows = _run_with_db(_test)
+    assert len(rows["aws_ebs_snapshots"]) == len(rows["aws_ebs_volumes"]) == 3
+    assert {row["state"] for row in rows["aws_ebs_volumes"]} == {"available"}
+
+
+@_requires_db
+def test_collect_in_processes_keeps_the_rows_when_a_worker_fails(monkeypatch):
+    monkeypatch.setattr(aws, "ProcessPoolExecutor", _run_in_threads)
+    units = _get_units(["000000000001", "000000000002"], ["eu-west-1"])
+
+    async def _test(engine):
+        queue = WorkQueue(engine)
+        provider = _get_provider(engine, workers=2)
+        _extract_resources(monkeypatch, 1)
+        await provider._collect_in_processes(units, await queue.create_local_run())
+        rows = await _get_rows(engine)
+
+        _extract_resources(
+            monkeypatch,
+            2,
+            {("aws_ebs_snapshots", "000000000001"): RuntimeError("Failing account")},
+        )
+        with pytest.raises(RuntimeError, match="Failing account"):
+            await provider._collect_in_processes(units, await queue.create_local_run())
+        assert await _get_rows(engine) == rows
+        assert not any("staging" in name for name in await _get_table_names(engine))
+
+    _run_with_db(_test)
+
+
+@_requires_db
+@pytest.mark.parametrize("workers", [1, 2])
+def test_filtered_collect_keeps_the_rows_of_the_other_units(monkeypatch, workers):
+    monkeypatch.setattr(aws, "ProcessPoolExecutor", _run_in_threads)
+    account_ids = ["000000000001", "000000000002"]
+    regions = ["eu-west-1", "us-east-1"]
+
+    async def _collect(provider, units):
+        run_id = await WorkQueue(provider.db_engine).create_local_run()
+        if workers > 1:
+            await provider._collect_in_processes(units, run_id)
+        else:
+            await provider._collect_data_sources(units, run_id)
+
+    async def _test(engine):
+        _extract_resources(monkeypatch, 1)
+        await _collect(
+            _get_provider(engine, workers=workers), _get_units(account_ids, regions)
+        )
+
+        _extract_resources(monkeypatch, 2)
+        provider = _get_provider(
+            engine,
+            workers=workers,
+            filters=Filters(accounts=("000000000002",), regions=("us-east-1",)),
+        )
+        await _collect(provider, _get_units(["000000000002"], ["us-east-1"]))
+
+        return await _get_rows(engine)
+
+    rows = _run_with_db(_test)
+    assert [
+        (row["account_id"], row["region"], row["description"])
+        for row in rows["aws_ebs_snapshots"]
+    ] == [
+        ("000000000001", "eu-west-1", "generation 1"),
+        ("000000000001", "us-east-1", "generation 1"),
+        ("000000000002", "eu-west-1", "generation 1"),
+        ("000000000002", "us-east-1", "generation 2"),
+    ]
+    assert [row["size"] for row in rows["aws_ebs_volumes"]] == [1, 1, 1, 2]
+
+
+def test_execution_plan_is_compiled_once(monkeypatch):
+    compiled = []
+    compile_plan = AwsDataSource._compile
+
+    def _compile(self):
+        compiled.append(self.type)
+        return compile_plan(self)
+
+    monkeypatch.setattr(AwsDataSource, "_compile", _compile)
+    monkeypatch.setattr(data_sources, "_cached_items", {})
+    data_source = data_sources.get("aws_ebs_volumes")
+    plan = data_source.execution_plan
+    batch = AwsResourceBatch("123456789012", "eu-west-1", None, [{"VolumeId": "v"}])
+
+    assert data_source.transform(batch) == data_source.transform(batch)
+    assert data_sources.get("aws_ebs_volumes").execution_plan is plan
+    assert compiled == ["aws_ebs_volumes"]
+
+
+@_requires_db
+def test_data_sources_are_collected_again_with_the_same_tables(monkeypatch):
+    _extract_resources(monkeypatch, 1)
+    units = _get_units(["000000000001"], ["eu-west-1", "us-east-1"])
+    tables = {name: data_sources.get(name).execution_plan.table for name in _SOURCES}
+    columns = {name: list(table.columns.keys()) for name, table in tables.items()}
+
+    async def _test(engine):
+        queue = WorkQueue(engine)
+        provider = _get_provider(engine)
+        await provider._collect_data_sources(units, await queue.create_local_run())
+        _extract_resources(monkeypatch, 2)
+        await provider._collect_data_sources(units, await queue.create_local_run())
+        return await _get_rows(engine)
+
+    rows = _run_with_db(_test)
+    assert [row["size"] for row in rows["aws_ebs_volumes"]] == [2, 2]
+    for name, table in tables.items():
+        assert data_sources.get(name).execution_plan.table is table
+        assert list(table.columns.keys()) == columns[name]
+        assert list(table.metadata.tables) == [name]
@@ -0,0 +1,15 @@
+from pantomath.provider import Filters
+
+
+def test_filters_match():
+    assert Filters.match((), "anything")
+    assert Filters.match(("aws_ec2_*",), "aws_ec2_instances")
+    assert not Filters.match(("aws_ec2_*",), "aws_ebs_volumes")
+    assert Filters.match(("1234*", "prod"), "123456789012", "dev")
+    assert Filters.match(("1234*", "prod"), "999999999999", "prod")
+    assert not Filters.match(("eu-*",), None)
+
+
+def test_filters_partial():
+    assert not Filters(sources=("aws_ec2_*",)).partial
+    assert Filters(regions=("eu-west-1",)).partial
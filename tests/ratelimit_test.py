@@ -0,0 +1,17 @@
+from pantomath.ratelimit import RateLimiter
+
+
+def test_reserve(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "limits.db"))
+    assert limiter.reserve("ec2", rate=2, now=0) == 0
+    assert limiter.reserve("ec2", rate=2, now=0) == 0
+    assert limiter.reserve("ec2", rate=2, now=0) == 0.5
+    assert limiter.reserve("s3", rate=2, now=0) == 0
+    # The bucket refills over time, up to its burst
+    assert limiter.reserve("ec2", rate=2, now=10) == 0
+
+
+def test_shared_between_limiters(tmp_path):
+    path = str(tmp_path / "limits.db")
+    assert RateLimiter(path).reserve("ec2", rate=1, now=0) == 0
+    assert RateLimiter(path).reserve("ec2", rate=1, now=0) == 1
@@ -11,3 +11,13 @@ def test_register():
     registry = CachedRegistry()
     registry.register("dummy", factory)
     assert isinstance(registry.get("dummy"), Dummy)
+
+
+def test_names():
+    class Dummy:
+        pass
+
+    registry = CachedRegistry()
+    registry.register("b", Dummy)
+    registry.register("a", Dummy)
+    assert registry.names() == ["a", "b"]
@@ -0,0 +1,39 @@
+from pantomath.scheduler import Scheduler, describe_tail, estimate_duration
+
+
+def _drain(scheduler):
+    items = []
+    while scheduler:
+        items.append(scheduler.dispatch())
+        scheduler.done(items[-1])
+    return items
+
+
+def test_longest_first():
+    costs = {"a": 1.0, "b": 10.0, "d": 5.0}
+    scheduler = Scheduler("abcd", cost=costs.get, api=str)
+    assert _drain(scheduler) == ["c", "b", "d", "a"]
+
+
+def test_same_api_held_back():
+    costs = {"ec2-1": 3.0, "ec2-2": 2.0, "s3": 1.0}
+    scheduler = Scheduler(costs, cost=costs.get, api=lambda item: item[:2])
+    assert scheduler.dispatch() == "ec2-1"
+    assert scheduler.dispatch() == "s3"
+    # Nothing else is available
+    assert scheduler.dispatch() == "ec2-2"
+    assert not scheduler
+
+
+def test_estimate_duration():
+    assert estimate_duration([], slots=2) == 0
+    assert estimate_duration([3, 3, 2, 2, 2], slots=2) == 7
+    assert estimate_duration([5, 1, 1], slots=4) == 5
+
+
+def test_describe_tail():
+    assert describe_tail({}) == "no work"
+    durations = {f"unit{index}": float(index) for index in range(1, 101)}
+    assert describe_tail(durations, count=2) == (
+        "p50 50.0s, p99 99.0s, slowest: unit100 (100.0s), unit99 (99.0s)"
+    )
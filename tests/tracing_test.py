@@ -0,0 +1,24 @@
+from pantomath import tracing
+
+
+def test_spans_nested_in_lanes():
+    tracing.start_tracing()
+    try:
+        with tracing.span("source", "source"):
+            first = tracing.start_span("first", "unit")
+            # The lane of the source is taken by the first unit
+            second = tracing.start_span("second", "unit", region="eu-west-1")
+            tracing.end_span(second)
+            tracing.end_span(first)
+    finally:
+        tracer = tracing.stop_tracing()
+
+    lanes = {event["name"]: event["tid"] for event in tracer.events}
+    assert lanes == {"source": 0, "first": 0, "second": 1}
+    assert tracer.events[0]["args"] == {"region": "eu-west-1"}
+
+
+def test_not_tracing():
+    with tracing.span("source", "source") as span:
+        assert span is None
+    assert not tracing.is_tracing()
@@ -0,0 +1,455 @@
+import asyncio
+import os
+from datetime import timedelta
+
+import click
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, Text, func, select, update
+from sqlalchemy.engine import make_url
+
+from pantomath import Pantomath
+from pantomath.db import create_engine
+from pantomath.provider.aws import (
+    AWSProvider,
+    AwsResourceBatch,
+    DeadlineExceededError,
+    data_sources,
+)
+from pantomath.workqueue import (
+    COMPLETED,
+    FAILED,
+    PENDING,
+    RUNNING,
+    LeaseLostError,
+    WorkQueue,
+    get_empty_units,
+    metadata,
+    publish_rows,
+    run_rows,
+    run_units,
+    runs,
+    stage_rows,
+)
+
+DSN = os.environ.get("PANTOMATH_TEST_DB_DSN")
+
+pytestmark = pytest.mark.skipif(
+    DSN is None, reason="PANTOMATH_TEST_DB_DSN is not set to a test database"
+)
+
+items = Table(
+    "pantomath_test_items",
+    MetaData(),
+    Column("id", Text),
+    Column("value", Integer),
+)
+
+
+def _run(test, **kwargs):
+    """Run a test coroutine function with a queue in empty tables."""
+
+    async def _main():
+        engine = create_engine(DSN)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(metadata.drop_all)
+                await conn.run_sync(items.drop, checkfirst=True)
+            queue = WorkQueue(engine, **kwargs)
+            await queue.setup()
+            return await test(queue)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(_main())
+
+
+def _units(count):
+    return [
+        {
+            "provider": "aws",
+            "source": "aws_ec2_instances",
+            "account": None,
+            "account_id": f"{index:012}",
+            "region": "eu-west-1",
+            "service": "ec2",
+        }
+        for index in range(count)
+    ]
+
+
+async def _get_statuses(queue, run_id):
+    async with queue.engine.connect() as conn:
+        result = await conn.execute(
+            select(run_units.c.status)
+            .where(run_units.c.run_id == run_id)
+            .order_by(run_units.c.account_id)
+        )
+        return [row.status for row in result]
+
+
+def _stage_collector(collected, failing=()):
+    """Return a unit collector that stages a row per unit, recording the units."""
+
+    async def _collect_unit(conn, unit):
+        collected.append(unit["account_id"])
+        if unit["account_id"] in failing:
+            raise RuntimeError("Failing unit")
+        await conn.execute(
+            run_rows.insert(), stage_rows(unit)([{"id": unit["account_id"]}])
+        )
+
+    return _collect_unit
+
+
+async def _count(queue, table):
+    async with queue.engine.connect() as conn:
+        result = await conn.execute(select(func.count()).select_from(table))
+        return result.scalar()
+
+
+def test_concurrent_claims_never_return_the_same_unit():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(5))
+        claimed = await asyncio.gather(
+            *[queue.claim(run_id, f"worker-{index}") for index in range(10)]
+        )
+        unit_ids = [unit["id"] for unit in claimed if unit is not None]
+        assert len(unit_ids) == len(set(unit_ids)) == 5
+
+    _run(_test)
+
+
+def test_expired_lease_is_claimed_again():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(1))
+        first = await queue.claim(run_id, "worker-1")
+        await asyncio.sleep(0.01)
+        second = await queue.claim(run_id, "worker-2")
+        assert second["id"] == first["id"]
+        assert second["attempts"] == 2
+        assert second["worker_id"] == "worker-2"
+
+        # The first worker cannot complete the unit anymore
+        with pytest.raises(LeaseLostError):
+            async with queue.engine.begin() as conn:
+                await queue.complete(conn, first, "worker-1")
+
+        async with queue.engine.begin() as conn:
+            await queue.complete(conn, second, "worker-2")
+        assert await _get_statuses(queue, run_id) == [COMPLETED]
+
+    _run(_test, lease_duration=0)
+
+
+def test_unit_fails_after_max_attempts_of_expired_leases():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(1))
+        assert await queue.claim(run_id, "worker-1")
+        await asyncio.sleep(0.01)
+        assert await queue.claim(run_id, "worker-2")
+        await asyncio.sleep(0.01)
+        assert await queue.claim(run_id, "worker-3") is None
+        assert await _get_statuses(queue, run_id) == [FAILED]
+        assert await queue.count_unfinished(run_id) == 0
+        assert await queue.finish_run(run_id) == FAILED
+
+    _run(_test, lease_duration=0, max_attempts=2)
+
+
+def test_unit_fails_after_max_attempts_of_errors():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(1))
+        unit = await queue.claim(run_id, "worker")
+        await queue.release(unit, "worker", ValueError("first"))
+        assert await _get_statuses(queue, run_id) == [PENDING]
+
+        unit = await queue.claim(run_id, "worker")
+        await queue.release(unit, "worker", ValueError("second"))
+        assert await _get_statuses(queue, run_id) == [FAILED]
+        assert await queue.claim(run_id, "worker") is None
+
+    _run(_test, max_attempts=2)
+
+
+def test_heartbeat_stops_before_its_unit_is_completed():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(1))
+        heartbeating = asyncio.Event()
+        running = set()
+        completed_while_heartbeating = []
+        complete = queue.complete
+
+        async def _heartbeat(unit, worker_id):
+            running.add(unit["id"])
+            heartbeating.set()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                running.discard(unit["id"])
+
+        async def _complete(conn, unit, worker_id, metrics=None):
+            completed_while_heartbeating.append(unit["id"] in running)
+            await complete(conn, unit, worker_id, metrics)
+
+        async def _collect_unit(conn, unit):
+            await heartbeating.wait()
+
+        queue.heartbeat = _heartbeat
+        queue.complete = _complete
+        assert await queue.work(run_id, "worker", _collect_unit) == COMPLETED
+        assert completed_while_heartbeating == [False]
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    _run(_test, lease_duration=0.03)
+
+
+def test_publish_is_idempotent():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(1))
+        unit = await queue.claim(run_id, "worker")
+        async with queue.engine.begin() as conn:
+            await conn.execute(
+                run_rows.insert(),
+                stage_rows(unit)([{"id": "a", "value": 1}, {"id": "b", "value": 2}]),
+            )
+            await queue.complete(conn, unit, "worker")
+
+        async def _publish(conn):
+            await conn.run_sync(items.drop, checkfirst=True)
+            await conn.run_sync(items.create)
+            await publish_rows(conn, items, run_id, unit["source"])
+
+        async def _interrupted_publish(conn):
+            await _publish(conn)
+            raise RuntimeError("Interrupted")
+
+        # An interrupted publication is rolled back as a whole
+        with pytest.raises(RuntimeError):
+            await queue.publish(run_id, _interrupted_publish)
+        assert await _count(queue, run_rows) == 2
+
+        assert await queue.publish(run_id, _publish)
+        assert not await queue.publish(run_id, _publish)
+        async with queue.engine.connect() as conn:
+            result = await conn.execute(select(items).order_by(items.c.id))
+            assert [tuple(row) for row in result] == [("a", 1), ("b", 2)]
+        assert await _count(queue, run_rows) == 0
+
+    _run(_test)
+
+
+def test_old_runs_are_pruned():
+    async def _test(queue):
+        old_run_id = await queue.create_run(_units(2))
+        unit = await queue.claim(old_run_id, "worker")
+        async with queue.engine.begin() as conn:
+            await conn.execute(run_rows.insert(), stage_rows(unit)([{"id": "a"}]))
+            await conn.execute(
+                update(runs)
+                .where(runs.c.id == old_run_id)
+                .values(started_at=func.now() - timedelta(days=2))
+            )
+
+        run_id = await queue.create_run(_units(1))
+        async with queue.engine.connect() as conn:
+            result = await conn.execute(select(runs.c.id))
+            assert [row.id for row in result] == [run_id]
+        assert await _count(queue, run_units) == 1
+        assert await _count(queue, run_rows) == 0
+
+    _run(_test, retention=24 * 3600)
+
+
+def test_empty_units_are_the_units_without_rows_in_the_period():
+    async def _test(queue):
+        units = _units(4)
+        # Another source of the same service was never collected there
+        units.append(dict(units[0], source="aws_ec2_volumes"))
+        run_id = await queue.create_run(units)
+        rows = {"000000000000": 0, "000000000001": 0, "000000000002": 3}
+        for _ in units:
+            unit = await queue.claim(run_id, "worker")
+            if unit["source"] == "aws_ec2_volumes":
+                continue
+            async with queue.engine.begin() as conn:
+                metrics = {"rows": rows.get(unit["account_id"])}
+                await queue.complete(conn, unit, "worker", metrics)
+        async with queue.engine.begin() as conn:
+            await conn.execute(
+                update(run_units)
+                .where(run_units.c.account_id == "000000000001")
+                .values(finished_at=func.now() - timedelta(days=2))
+            )
+
+        async with queue.engine.connect() as conn:
+            assert await get_empty_units(conn, 24 * 3600) == {
+                ("aws", "aws_ec2_instances", "000000000000", "eu-west-1")
+            }
+
+    _run(_test)
+
+
+def test_resume_failed_run_collects_only_unfinished_units():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(3))
+        collected = []
+        status = await queue.work(
+            run_id, "worker", _stage_collector(collected, failing=("000000000001",))
+        )
+        assert status == FAILED
+        assert await _get_statuses(queue, run_id) == [COMPLETED, FAILED, COMPLETED]
+
+        await queue.resume_run(run_id)
+        assert await queue.get_run_status(run_id) == RUNNING
+        collected.clear()
+        assert await queue.work(run_id, "worker", _stage_collector(collected)) == (
+            COMPLETED
+        )
+        # The units whose rows were staged are not collected again
+        assert collected == ["000000000001"]
+        assert await _count(queue, run_rows) == 3
+
+    _run(_test, max_attempts=1)
+
+
+def test_resume_running_run_queues_abandoned_units_again():
+    async def _test(queue):
+        run_id = await queue.create_run(_units(3))
+        collected = []
+        async with queue.engine.begin() as conn:
+            unit = await queue.claim(run_id, "worker-1")
+            await _stage_collector(collected)(conn, unit)
+            await queue.complete(conn, unit, "worker-1")
+        # This unit is still held by a live worker
+        await queue.claim(run_id, "worker-2")
+        # The lease of this unit expires, as its worker crashed
+        abandoned_queue = WorkQueue(queue.engine, lease_duration=0)
+        await abandoned_queue.claim(run_id, "worker-3")
+        await asyncio.sleep(0.01)
+
+        await queue.resume_run(run_id)
+        assert await _get_statuses(queue, run_id) == [COMPLETED, RUNNING, PENDING]
+        unit = await queue.claim(run_id, "worker-4")
+        assert unit["account_id"] == "000000000002"
+        assert unit["attempts"] == 1
+
+    _run(_test)
+
+
+def test_resume_published_run_is_rejected(tmp_path):
+    async def _test(queue):
+        run_id = await queue.create_run([])
+
+        async def _publish(conn):
+            pass
+
+        await queue.finish_run(run_id)
+        await queue.publish(run_id, _publish)
+        return run_id
+
+    run_id = _run(_test)
+
+    url = make_url(DSN)
+    config_path = tmp_path / "pantomath.yaml"
+    config_path.write_text(
+        f"""
+version: 0.1.0
+db:
+  host: {url.host}
+  port: {url.port or 5432}
+  user: {url.username}
+  password: "{url.password or ''}"
+  name: {url.database}
+providers:
+  aws:
+    settings:
+      accounts: []
+    sources: []
+"""
+    )
+    pantomath = Pantomath(str(config_path))
+    with pytest.raises(click.UsageError, match="already published"):
+        pantomath.collect(resume=run_id)
+    with pytest.raises(click.UsageError, match="does not exist"):
+        pantomath.collect(resume="unknown")
+
+
+def _extract_resources(monkeypatch, late_account_id):
+    """Make the EBS data sources extract a resource by unit.
+
+    The volumes of an account are extracted until cancelled.
+    """
+
+    async def _get_session(self, account_config):
+        return None
+
+    monkeypatch.setattr(AWSProvider, "_get_session", _get_session)
+    for name in ("aws_ebs_snapshots", "aws_ebs_volumes"):
+
+        async def _extract_region(session, account_id, region, name=name):
+            resource_id = f"{account_id}/{region}"
+            yield AwsResourceBatch(
+                account_id,
+                region,
+                session,
+                [{"SnapshotId": resource_id, "VolumeId": resource_id}],
+            )
+            if name == "aws_ebs_volumes" and account_id == late_account_id:
+                await asyncio.Event().wait()
+
+        monkeypatch.setattr(data_sources.get(name), "extract_region", _extract_region)
+
+
+def test_local_run_records_its_units(monkeypatch):
+    _extract_resources(monkeypatch, "000000000001")
+    units = [
+        dict(unit, account={}, source=source)
+        for source in ("aws_ebs_snapshots", "aws_ebs_volumes")
+        for unit in _units(2)
+    ]
+
+    async def _test(queue):
+        async with queue.engine.begin() as conn:
+            for name in ("aws_ebs_snapshots", "aws_ebs_volumes"):
+                table = data_sources.get(name).execution_plan.table
+                await conn.run_sync(table.drop, checkfirst=True)
+        provider = AWSProvider(
+            config={
+                "settings": {
+                    "call_deadline": None,
+                    "enrich_concurrency": None,
+                    "rate_limit_store": None,
+                    "unit_deadline": 0.05,
+                },
+                "sources": ["aws_ebs_snapshots", "aws_ebs_volumes"],
+            },
+            db_engine=queue.engine,
+        )
+        run_id = await queue.create_local_run()
+        with pytest.raises(DeadlineExceededError, match="aws_ebs_volumes$"):
+            await provider._collect_data_sources(units, run_id)
+        assert await queue.finish_run(run_id) == FAILED
+
+        async with queue.engine.connect() as conn:
+            result = await conn.execute(
+                select(run_units)
+                .where(run_units.c.run_id == run_id)
+                .order_by(run_units.c.source, run_units.c.account_id)
+            )
+            return list(result.mappings())
+
+    recorded = _run(_test)
+    assert [(unit["source"], unit["status"]) for unit in recorded] == [
+        ("aws_ebs_snapshots", COMPLETED),
+        ("aws_ebs_snapshots", COMPLETED),
+        ("aws_ebs_volumes", FAILED),
+        ("aws_ebs_volumes", FAILED),
+    ]
+    assert [unit["rows"] for unit in recorded[:2]] == [1, 1]
+    assert all(unit["error"] is None for unit in recorded[:2])
+    # The units of a data source fail together, since they are loaded together
+    assert all("DeadlineExceededError" in unit["error"] for unit in recorded[2:])
+    assert all(
+        unit["started_at"] <= unit["finished_at"] and unit["attempts"] == 1
+        for unit in recorded
+    )